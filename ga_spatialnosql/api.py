@@ -1,8 +1,16 @@
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.http import HttpResponse, HttpResponseBadRequest
-from ga_spatialnosql import connections
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, Http404
+try:
+    from django.http import StreamingHttpResponse
+except ImportError: # before Django 1.5, HttpResponse streams any iterator it is given
+    StreamingHttpResponse = HttpResponse
+from ga_spatialnosql import connections, permissions
+from ga_spatialnosql.models import IngestJob
+from ga_spatialnosql.db.mongo import ValidationError
 from django.views.generic import View
+from bson import json_util
+from itertools import chain
 import json
 from logging import getLogger
 
@@ -22,6 +30,77 @@ def _json_response(request, d, default=None):
     else:
         return HttpResponse(json.dumps(d, default=default), mimetype='application/json' )
 
+def _callback(request):
+    return request.REQUEST.get('jsonp', None) or request.REQUEST.get('callback', None)
+
+# query results are written out a feature at a time as they come off the cursor, gathered into writes of about
+# STREAM_WRITE_SIZE bytes, so neither the result list nor its JSON is ever held in memory whole.
+STREAM_WRITE_SIZE = 65536
+
+STREAM_FORMATS = {
+    # format : (mimetype, head, separator, tail)
+    'json' : ('application/json', '[', ',', ']'),
+    'geojson' : ('application/json', '{"type":"FeatureCollection","features":[', ',', ']}'),
+    'ndjson' : ('application/x-ndjson', '', '\n', '\n'),
+}
+
+def _stream_features(features, head, separator, tail, callback=None, default=json_util.default):
+    buf = [callback + '(' + head if callback else head]
+    size = 0
+    first = True
+    for feature in features:
+        js = json.dumps(feature, default=default)
+        buf.append(js if first else separator + js)
+        first = False
+        size += len(js)
+        if size >= STREAM_WRITE_SIZE:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+
+    if first and not head: # an empty ndjson result is an empty body
+        tail = ''
+    buf.append(tail + ')' if callback else tail)
+    yield ''.join(buf)
+
+def _primed(features):
+    """features, already run as far as the first of them, so that a query that fails fails here"""
+    features = iter(features)
+    try:
+        first = next(features)
+    except StopIteration:
+        return iter(())
+    return chain((first,), features)
+
+def _features_response(request, collection, query):
+    """Stream the results of a query, as a JSON list (format=json, the default), a GeoJSON FeatureCollection
+    (format=geojson) or newline delimited GeoJSON features (format=ndjson).  A query with a limit is read before the
+    response starts, since the X-Next-Page header that lets a client fetch the next page is only known at the end
+    of it; the page is bounded by the limit anyway.  Any other query is run up to its first feature first, so that a
+    bad query or an expired page token gets a 400 rather than a broken 200."""
+    output = request.REQUEST.get('format', 'json')
+    if output not in STREAM_FORMATS:
+        return HttpResponseBadRequest('unknown format {format}'.format(format=output))
+    mimetype, head, separator, tail = STREAM_FORMATS[output]
+    callback = _callback(request) if output != 'ndjson' else None
+
+    page = {}
+    try:
+        if isinstance(query, basestring):
+            query = json.loads(query)
+        features = collection.find_features(query=query, after=request.REQUEST.get('after', None), page=page)
+        if query and query.get('properties', {}).get('limit'):
+            features = list(features)
+        else:
+            features = _primed(features)
+    except (ValidationError, TypeError, ValueError) as e: # a malformed query, or a page token that has expired
+        return HttpResponseBadRequest(str(e))
+
+    response = StreamingHttpResponse(_stream_features(features, head, separator, tail, callback), content_type=mimetype)
+    if page.get('next'):
+        response['X-Next-Page'] = page['next']
+    return response
+
 class UniverseView(View):
     def get(self, request, *args, **kwargs):
         log.debug('listing all connections')
@@ -57,11 +136,15 @@ class DBView(View):
 
     def post(self, request, *args, **kwargs):
         log.debug('creating a new collection for {connection}:{db}:{collection}'.format(**dict(kwargs, collection=request.POST['collection'] )))
-        collection = connections.CONNECTIONS[ kwargs['connection'] ][ kwargs['db'] ][ request.POST['collection'] ]
-        properties = collection.deserialize( request.POST.get('properties', '{}'))
-        log.debug('adding properties {props}'.format(props=properties))
-        for key, value in properties.items():
-            collection[key] = value
+        try:
+            collection = connections.CONNECTIONS[ kwargs['connection'] ][ kwargs['db'] ].collection(request.POST['collection'], index_backend=request.POST.get('index_backend', None))
+            properties = collection.deserialize( request.POST.get('properties', '{}'))
+            log.debug('adding properties {props}'.format(props=properties))
+            with collection.metadata_batch():
+                for key, value in properties.items():
+                    collection[key] = value
+        except ValidationError as e:
+            return HttpResponseBadRequest(str(e))
 
         log.debug('added properties to new collection {conn}:{db}:{coll} properties: {props} '.format(conn=kwargs['connection'], db=kwargs['db'], coll=request.POST['collection'], props=collection.keys()))
         return HttpResponse()
@@ -81,7 +164,7 @@ class CollectionView(View):
 
         collection = connections.CONNECTIONS[ kwargs['connection'] ][ kwargs['db'] ][ kwargs['collection'] ]
         query = request.REQUEST.get('query', None)
-        return _json_response(request, list(collection.find_features(query=query)))
+        return _features_response(request, collection, query)
 
     def post(self, request, *args, **kwargs):
         log.debug('appending an object to collection {connection}:{db}:{collection}'.format(**kwargs))
@@ -95,7 +178,7 @@ class CollectionView(View):
         elif 'query' in request.POST:
             query = request.POST['query']
             log.debug('querying an object from JSON: {query}'.format(query=query))
-            return _json_response(request, list(collection.find_features(query=query)))
+            return _features_response(request, collection, query)
 
     def put(self, request, *args, **kwargs):
         log.debug('updating objects in place on {connection}:{db}:{collection} matching {query}'.format(**dict(kwargs, query=request.REQUEST.get('query', None)) ))
@@ -131,18 +214,21 @@ class CollectionPropertiesView(View):
 
         collection = connections.CONNECTIONS[ kwargs['connection'] ][ kwargs['db'] ][ kwargs['collection'] ]
 
-        if 'dtype' in request.POST and request.POST['dtype'] == 'int':
-            collection[ kwargs['property'] ] = int( request.POST['value'] )
-        elif 'dtype' in request.POST and request.POST['dtype'] == 'float':
-            collection[ kwargs['property'] ] = float( request.POST['value'] )
-        elif 'dtype' in request.POST and request.POST['dtype'] == 'str':
-            collection[ kwargs['property'] ] = request.POST['value']
-        elif 'dtype' in request.POST and request.POST['dtype'] == 'object':
-            collection[ kwargs['property'] ] = collection.deserialize( request.POST['value'] )
-        elif 'dtype' not in request.POST:
-            collection[ kwargs['property'] ] = request.POST['value']
-        else:
-            return HttpResponseBadRequest('unknown datatype for property')
+        try:
+            if 'dtype' in request.POST and request.POST['dtype'] == 'int':
+                collection[ kwargs['property'] ] = int( request.POST['value'] )
+            elif 'dtype' in request.POST and request.POST['dtype'] == 'float':
+                collection[ kwargs['property'] ] = float( request.POST['value'] )
+            elif 'dtype' in request.POST and request.POST['dtype'] == 'str':
+                collection[ kwargs['property'] ] = request.POST['value']
+            elif 'dtype' in request.POST and request.POST['dtype'] == 'object':
+                collection[ kwargs['property'] ] = collection.deserialize( request.POST['value'] )
+            elif 'dtype' not in request.POST:
+                collection[ kwargs['property'] ] = request.POST['value']
+            else:
+                return HttpResponseBadRequest('unknown datatype for property')
+        except ValidationError as e:
+            return HttpResponseBadRequest(str(e))
 
         return HttpResponse()
 
@@ -190,10 +276,36 @@ class ObjectView(View):
 
 
 
+class IngestJobView(View):
+    """Status of the requesting user's background imports: one job's with a job id, otherwise the most recent ones"""
+
+    recent = 50
+
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_authenticated():
+            return HttpResponseForbidden()
+
+        jobs = IngestJob.objects.all() if request.user.is_superuser else IngestJob.objects.filter(user=request.user)
+        if 'job' in kwargs:
+            try:
+                return _json_response(request, jobs.get(pk=kwargs['job']).as_dict())
+            except IngestJob.DoesNotExist:
+                raise Http404
+        return _json_response(request, [job.as_dict() for job in jobs.order_by('-created')[:self.recent]])
+
+    def post(self, request, *args, **kwargs):
+        return HttpResponseBadRequest()
+
+    def put(self, request, *args, **kwargs):
+        return HttpResponseBadRequest()
+
+    def delete(self, request, *args, **kwargs):
+        return HttpResponseBadRequest()
+
 class AuthenticatedDBView(DBView):
-    ALL = 1
-    AUTHENTICATED = 2
-    OWNER = 3
+    ALL = permissions.ALL
+    AUTHENTICATED = permissions.AUTHENTICATED
+    OWNER = permissions.OWNER
 
     default_permissions = {
         'read' : ALL,
@@ -201,115 +313,51 @@ class AuthenticatedDBView(DBView):
         'delete' : OWNER,
     }
 
-    def _check_permissions(self, permission, request, *args, **kwargs):
+    def get_permissions(self, owner):
         metadata_db = settings.MONGODB_ROUTES['ga_spatialnosql'] if 'ga_spatialnosql' in settings.MONGODB_ROUTES else settings.MONGODB_ROUTES['default']
-        owner = kwargs['accessed_username']
         metadata_collection = metadata_db.meta
         metadata_record = metadata_collection.find_one("db_meta_" + owner)
 
         if not metadata_record and User.objects.filter(username=owner).count() > 0:
             metadata_record = {
-                "_id" : kwargs['accessed_username'],
+                "_id" : "db_meta_" + owner,
                 "permissions" : self.default_permissions,
-            )
-            metadata_collection.insert(metadata_record)
-
+            }
+            metadata_collection.save(metadata_record)
+            permissions.invalidate(owner)
         elif not metadata_record:
             raise KeyError("No such user or db")
-        else:
-            permissions = metadata_record['permissions']
-
-            return any((
-                permissions[permission] == AuthenticatedDBView.ALL,
-                permissions[permission] == self.OWNER and request.user.username == owner,
-                permissions[permission] == None and request.user.username == owner,
-                permissions[permission] == self.AUTHENTICATED and request.user.is_authenticated(),
-                request.user.is_superuser(),
-                'admin_ga_spatialnosql' in {(grp.name for grp in request.user.groups)},
-                ('user:' + request.user.username) in permissions[permission],
-                {("group:" + grp.name for grp in request.user.groups)}.intersection(permissions[permission])
-            ))
+        return metadata_record['permissions']
+
+    def _check_permissions(self, permission, request, *args, **kwargs):
+        owner = kwargs['accessed_username']
+        return permissions.check(request.user, permission, owner, None, lambda: self.get_permissions(owner))
 
     def get(self, request, *args, **kwargs):
         if self._check_permissions('read',request, *args, **kwargs):
             return super(AuthenticatedDBView, self).get(request, *args, **kwargs)
+        return HttpResponseForbidden()
 
     def post(self, request, *args, **kwargs):
         if self._check_permissions('write',request, *args, **kwargs):
-            return super(AuthenticatedDBView, self).get(request, *args, **kwargs)
+            return super(AuthenticatedDBView, self).post(request, *args, **kwargs)
+        return HttpResponseForbidden()
 
     def put(self, request, *args, **kwargs):
         if self._check_permissions('write',request, *args, **kwargs):
-            return super(AuthenticatedDBView, self).get(request, *args, **kwargs)
+            return super(AuthenticatedDBView, self).put(request, *args, **kwargs)
+        return HttpResponseForbidden()
 
     def delete(self, request, *args, **kwargs):
         if self._check_permissions('delete',request, *args, **kwargs):
-            return super(AuthenticatedDBView, self).get(request, *args, **kwargs)
+            return super(AuthenticatedDBView, self).delete(request, *args, **kwargs)
+        return HttpResponseForbidden()
 
-
-class AuthenticatedCollectionView(CollectionView):
-    ALL = 1
-    AUTHENTICATED = 2
-    OWNER = 3
-
-    PERMISSIONS_KEY='permissions'
-
-    default_permissions = {
-        'read' : ALL,
-        'write' : OWNER,
-        'delete' : OWNER,
-        }
-
-    def get_collection(self, request, *args, **kwargs):
-        accessed_username = kwargs['accessed_username'] # this will become the database name
-        accessed_user = User.objects.get(username=accessed_username)  # we need check to see what connection group this user is in
-        connection_group = accessed_user.groups.filter(name__startswith = 'ga_spatialnosql_')[0].name[len('ga_spatialnosql_'):]
-
-        # collection = connection=connection_group;db=accessed_username;collection=kwargs.collection
-        return connections.CONNECTIONS[ connection_group ][ accessed_username ][ kwargs['collection'] ]
-
-    def get_permissions(self, request, collection, *args, **kwargs):
-        return collection[self.PERMISSIONS_KEY] if self.PERMISSIONS_KEY in self.PERMISSIONS_KEY else self.default_permissions
-
-    def _check_permissions(self, permission, request, *args, **kwargs):
-        collection = self.get_collection(request, *args, **kwargs)
-        permissions = self.get_permissions(request, collection, *args, **kwargs)
-        owner = kwargs['accessed_username']
-
-        return any((
-            permissions[permission] == AuthenticatedObjectView.ALL,
-            permissions[permission] == self.OWNER and request.user.username == owner,
-            permissions[permission] == self.AUTHENTICATED and request.user.is_authenticated(),
-            permissions[permission] == None and request.user.username == owner,
-            request.user.is_superuser(),
-            'admin_ga_spatialnosql' in {(grp.name for grp in request.user.groups)},
-            ('user:' + request.user.username) in permissions[permission],
-            set(['group:' + grp.name for grp in request.user.groups]).intersection(permissions[permission])
-            ))
-
-    def get(self, request, *args, **kwargs):
-        if self._check_permissions('read', request, *args, **kwargs):
-            return super(AuthenticatedCollectionView, self).get(request, *args, **kwargs)
-
-    def post(self, request, *args, **kwargs):
-        if self._check_permissions('write', request, *args, **kwargs):
-            return super(AuthenticatedCollectionView, self).post(request, *args, **kwargs)
-
-    def put(self, request, *args, **kwargs):
-        if self._check_permissions('write', request, *args, **kwargs):
-            return super(AuthenticatedCollectionView, self).put(request, *args, **kwargs)
-
-    def delete(self, request, *args, **kwargs):
-        if self._check_permissions('delete', request, *args, **kwargs):
-            return super(AuthenticatedCollectionView, self).delete(request, *args, **kwargs)
-
-
-
-
-class AuthenticatedObjectView(ObjectView):
-    ALL = 1
-    AUTHENTICATED = 2
-    OWNER = 3
+class CollectionPermissionsMixin(object):
+    """Permission checks shared by the views of a user's collections, their properties and their objects"""
+    ALL = permissions.ALL
+    AUTHENTICATED = permissions.AUTHENTICATED
+    OWNER = permissions.OWNER
 
     PERMISSIONS_KEY='permissions'
 
@@ -321,101 +369,43 @@ class AuthenticatedObjectView(ObjectView):
 
     def get_collection(self, request, *args, **kwargs):
         accessed_username = kwargs['accessed_username'] # this will become the database name
-        accessed_user = User.objects.get(username=accessed_username)  # we need check to see what connection group this user is in
-        connection_group = accessed_user.groups.filter(name__startswith = 'ga_spatialnosql_')[0].name[len('ga_spatialnosql_'):]
+        connection_group = permissions.connection_group(accessed_username) # the connection group this user is in
 
         # collection = connection=connection_group;db=accessed_username;collection=kwargs.collection
         return connections.CONNECTIONS[ connection_group ][ accessed_username ][ kwargs['collection'] ]
 
     def get_permissions(self, request, collection, *args, **kwargs):
-        return collection[self.PERMISSIONS_KEY] if self.PERMISSIONS_KEY in self.PERMISSIONS_KEY else self.default_permissions
+        return collection[self.PERMISSIONS_KEY] if self.PERMISSIONS_KEY in collection else self.default_permissions
 
     def _check_permissions(self, permission, request, *args, **kwargs):
-        collection = self.get_collection(request, *args, **kwargs)
-        permissions = self.get_permissions(request, collection, *args, **kwargs)
-        owner = kwargs['accessed_username']
-
-        return any((
-            permissions[permission] == AuthenticatedObjectView.ALL,
-            permissions[permission] == self.OWNER and request.user.username == owner,
-            permissions[permission] == self.AUTHENTICATED and request.user.is_authenticated(),
-            permissions[permission] == None and request.user.username == owner,
-            request.user.is_superuser(),
-            'admin_ga_spatialnosql' in {(grp.name for grp in request.user.groups)},
-            ('user:' + request.user.username) in permissions[permission],
-            set(['group:' + grp.name for grp in request.user.groups]).intersection(permissions[permission])
-        ))
+        return permissions.check(request.user, permission, kwargs['accessed_username'], kwargs['collection'],
+            lambda: self.get_permissions(request, self.get_collection(request, *args, **kwargs), *args, **kwargs))
 
     def get(self, request, *args, **kwargs):
         if self._check_permissions('read', request, *args, **kwargs):
-            return super(AuthenticatedObjectView, self).get(request, *args, **kwargs)
+            return super(CollectionPermissionsMixin, self).get(request, *args, **kwargs)
+        return HttpResponseForbidden()
 
     def post(self, request, *args, **kwargs):
         if self._check_permissions('write', request, *args, **kwargs):
-            return super(AuthenticatedObjectView, self).post(request, *args, **kwargs)
+            return super(CollectionPermissionsMixin, self).post(request, *args, **kwargs)
+        return HttpResponseForbidden()
 
     def put(self, request, *args, **kwargs):
         if self._check_permissions('write', request, *args, **kwargs):
-            return super(AuthenticatedObjectView, self).put(request, *args, **kwargs)
+            return super(CollectionPermissionsMixin, self).put(request, *args, **kwargs)
+        return HttpResponseForbidden()
 
     def delete(self, request, *args, **kwargs):
         if self._check_permissions('delete', request, *args, **kwargs):
-            return super(AuthenticatedObjectView, self).delete(request, *args, **kwargs)
-
-
-
-class AuthenticatedCollectionPropertiesView(CollectionPropertiesView):
-    ALL = 1
-    AUTHENTICATED = 2
-    OWNER = 3
-
-    PERMISSIONS_KEY='permissions'
-
-    default_permissions = {
-        'read' : ALL,
-        'write' : OWNER,
-        'delete' : OWNER,
-        }
-
-    def get_collection(self, request, *args, **kwargs):
-        accessed_username = kwargs['accessed_username'] # this will become the database name
-        accessed_user = User.objects.get(username=accessed_username)  # we need check to see what connection group this user is in
-        connection_group = accessed_user.groups.filter(name__startswith = 'ga_spatialnosql_')[0].name[len('ga_spatialnosql_'):]
-
-        # collection = connection=connection_group;db=accessed_username;collection=kwargs.collection
-        return connections.CONNECTIONS[ connection_group ][ accessed_username ][ kwargs['collection'] ]
-
-    def get_permissions(self, request, collection, *args, **kwargs):
-        return collection[self.PERMISSIONS_KEY] if self.PERMISSIONS_KEY in self.PERMISSIONS_KEY else self.default_permissions
-
-    def _check_permissions(self, permission, request, *args, **kwargs):
-        collection = self.get_collection(request, *args, **kwargs)
-        permissions = self.get_permissions(request, collection, *args, **kwargs)
-        owner = kwargs['accessed_username']
-
-        return any((
-            permissions[permission] == AuthenticatedObjectView.ALL,
-            permissions[permission] == self.OWNER and request.user.username == owner,
-            permissions[permission] == self.AUTHENTICATED and request.user.is_authenticated(),
-            permissions[permission] == None and request.user.username == owner,
-            request.user.is_superuser(),
-            'admin_ga_spatialnosql' in {(grp.name for grp in request.user.groups)},
-            ('user:' + request.user.username) in permissions[permission],
-            set(['group:' + grp.name for grp in request.user.groups]).intersection(permissions[permission])
-            ))
-
-    def get(self, request, *args, **kwargs):
-        if self._check_permissions('read', request, *args, **kwargs):
-            return super(AuthenticatedCollectionPropertiesView, self).get(request, *args, **kwargs)
+            return super(CollectionPermissionsMixin, self).delete(request, *args, **kwargs)
+        return HttpResponseForbidden()
 
-    def post(self, request, *args, **kwargs):
-        if self._check_permissions('write', request, *args, **kwargs):
-            return super(AuthenticatedCollectionPropertiesView, self).post(request, *args, **kwargs)
+class AuthenticatedCollectionView(CollectionPermissionsMixin, CollectionView):
+    pass
 
-    def put(self, request, *args, **kwargs):
-        if self._check_permissions('write', request, *args, **kwargs):
-            return super(AuthenticatedCollectionPropertiesView, self).put(request, *args, **kwargs)
+class AuthenticatedObjectView(CollectionPermissionsMixin, ObjectView):
+    pass
 
-    def delete(self, request, *args, **kwargs):
-        if self._check_permissions('delete', request, *args, **kwargs):
-            return super(AuthenticatedCollectionPropertiesView, self).delete(request, *args, **kwargs)
+class AuthenticatedCollectionPropertiesView(CollectionPermissionsMixin, CollectionPropertiesView):
+    pass
@@ -8,6 +8,58 @@ INDEX_PATH = "/Users/jeff/Source/geoanalytics/ga/"
 DEFAULT_SRID = 4326
 DEFAULT_DB_QUOTA = 2**30*5 # five gigabytes
 
+# spatial index implementations a collection can be created with.  The chosen backend is stored in the collection
+# metadata, so it only needs to be given when a collection is first created.
+INDEX_BACKENDS = {
+    'spatialite' : 'ga_spatialnosql.index.GeoIndex',
+    'memory' : 'ga_spatialnosql.memindex.MemoryGeoIndex',
+    'snapshot' : 'ga_spatialnosql.snapshot.SnapshotGeoIndex',
+}
+DEFAULT_INDEX_BACKEND = 'spatialite'
+SNAPSHOT_MERGE_THRESHOLD = 50000 # rows in a snapshot index's delta before it is merged into a new snapshot
+
+# query planning for queries with both a geo_spec and an attribute spec
+PLANNER_ATTRIBUTE_PROBE = 1000 # attribute matches are counted up to this many; fewer than this can be fetched first
+PLANNER_STATISTICS_TTL = 300 # seconds before index statistics are rebuilt
+PLANNER_STALE_FRACTION = 0.1 # rows written, as a fraction of those the statistics were built from, before they are rebuilt early
+PLANNER_SAMPLE_SIZE = 10000 # envelopes sampled from the index to build statistics
+PLANNER_HISTOGRAM_CELLS = 32
+
+# spatial query results are fetched from Mongo in chunks on a shared thread pool
+FETCH_WORKERS = 8 # threads in the pool, shared by every query in the process
+FETCH_PREFETCH = 4 # chunks a query fetches ahead of the one being read; 0 fetches serially
+QUERY_CACHE_ENTRIES = 256 # spatial query results cached per process; 0 turns the cache off
+QUERY_CACHE_BYTES = 64 * 1024 * 1024 # BSON bytes of cached results at most
+QUERY_CACHE_RESULT_BYTES = 8 * 1024 * 1024 # results bigger than this aren't cached
+QUERY_CACHE_TTL = 60.0 # seconds a cached result is used; bounds how stale writes from other processes leave it
+
+# streaming ingest of large GeoJSON files
+INGEST_BATCH_SIZE = 1000 # features inserted into Mongo and the index at a time
+INGEST_QUEUE_BATCHES = 4 # parsed batches waiting to be inserted before the parser waits for the database
+INGEST_READ_SIZE = 65536 # bytes read from the stream at a time
+OGR_IMPORT_PROCESSES = None # worker processes importing the layers of an upload; None uses one per core
+
+# uploads through the views are imported by a background worker pool instead of during the request
+INGEST_WORKERS = 2 # imports that run at once in each web process
+INGEST_SPOOL_PATH = None # where uploads wait for a worker; None uses the system temp directory
+INGEST_PROGRESS_INTERVAL = 1.0 # seconds between progress updates to a job's record
+
+# geometry encoding for bulk inserts can run on a pool of worker processes
+ENCODE_PROCESSES = 0 # worker processes used by insert_features unless it is given processes; 0 encodes in process
+ENCODE_BATCH_SIZE = 500 # geometries sent to a worker at a time
+
+# single-row index inserts and deletes from concurrent writers are committed in groups, sharing one fsync
+GROUP_COMMIT = True
+GROUP_COMMIT_MAX_BATCH = 1000 # writes in one commit at most
+GROUP_COMMIT_MAX_DELAY = 0.0 # seconds a commit may wait for more writes to join it; 0 commits as soon as it can
+INDEX_MAX_READERS = 16 # threads reading one index file at once; the rest wait for a turn
+INDEX_BUSY_TIMEOUT = 30.0 # seconds an index connection waits on a lock held by another process
+TOMBSTONE_COMPACT_THRESHOLD = 100000 # tombstoned index rows that start a background compaction
+TOMBSTONE_COMPACT_BATCH = 10000 # tombstoned rows purged per compaction transaction
+METADATA_TTL = 5.0 # seconds an open collection trusts its cached metadata before rereading it
+PERMISSION_CACHE_TTL = 60.0 # seconds a permission decision, or a user's groups, are trusted before being looked up again
+PERMISSION_CACHE_ENTRIES = 10000 # entries each permission cache keeps; the oldest are dropped beyond it
+
 
 APP_LOGGING = {
     'ga_spatialnosql.db.mongo' : {
@@ -0,0 +1,78 @@
+__author__ = 'jeff'
+
+from itertools import islice
+import binascii
+
+class Bitmap(object):
+    """A set of small non-negative integers, such as index row numbers, kept as the bits of one long.  Union,
+    intersection and difference run in C over the whole set at once, and a million rows cost 125KB instead of
+    the tens of megabytes a set of id strings would."""
+
+    __slots__ = ('bits',)
+
+    def __init__(self, bits=0L):
+        self.bits = bits
+
+    @classmethod
+    def from_rows(cls, rows):
+        if isinstance(rows, Bitmap):
+            return rows
+        # setting bits one at a time on a long copies it each time, so build the bytes and convert once
+        buf = bytearray()
+        for row in rows:
+            byte = row >> 3
+            if byte >= len(buf):
+                buf.extend('\0' * (byte - len(buf) + 1))
+            buf[byte] |= 1 << (row & 7)
+        if not buf:
+            return cls()
+        buf.reverse()
+        return cls(long(binascii.hexlify(buf), 16))
+
+    def __iter__(self):
+        """Rows in increasing order"""
+        if not self.bits:
+            return
+        hexed = '%x' % self.bits
+        buf = bytearray(binascii.unhexlify(('0' if len(hexed) % 2 else '') + hexed))
+        buf.reverse()
+        for byte, value in enumerate(buf):
+            if value:
+                for bit in xrange(8):
+                    if value & (1 << bit):
+                        yield (byte << 3) | bit
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def __nonzero__(self):
+        return self.bits != 0
+
+    def __contains__(self, row):
+        return row >= 0 and bool(self.bits >> row & 1)
+
+    def after(self, row):
+        """The rows greater than row"""
+        return Bitmap(self.bits >> (row + 1) << (row + 1)) if row >= 0 else self
+
+    def first(self, n):
+        """The n smallest rows"""
+        return Bitmap.from_rows(islice(self, n))
+
+    def __and__(self, other):
+        return Bitmap(self.bits & other.bits)
+
+    def __or__(self, other):
+        return Bitmap(self.bits | other.bits)
+
+    def __sub__(self, other):
+        return Bitmap(self.bits & ~other.bits)
+
+    def __eq__(self, other):
+        return isinstance(other, Bitmap) and self.bits == other.bits
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Bitmap({rows})'.format(rows=list(self))
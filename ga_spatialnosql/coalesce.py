@@ -0,0 +1,125 @@
+__author__ = 'jeff'
+
+from ga_spatialnosql import app_settings as settings
+from threading import Thread, Event, Lock
+from Queue import Queue, Empty
+from logging import getLogger
+import time
+
+log = getLogger(__name__)
+
+# Group commit for single-row index writes.  Writers queue their statement and wait; one writer thread per index runs
+# everything queued in a single transaction on the index's write connection and acknowledges each write once that transaction is committed.  While
+# one commit is being synced, the writes that arrive meanwhile queue up and become the next group, so under
+# concurrent load many writes share each fsync, and a lone writer waits no longer than for its own commit.
+
+class _Write(object):
+    __slots__ = ('statement', 'params', 'done', 'error')
+
+    def __init__(self, statement, params):
+        self.statement = statement
+        self.params = params
+        self.done = Event()
+        self.error = None
+
+class WriteCoalescer(object):
+    """Commits writes to the index behind a ConnectionPool in groups of up to max_batch.  A group is committed as
+    soon as the writer thread is free, or, with a max_delay, after waiting up to that many seconds for the group to
+    fill.  Groups are committed through the pool's writer, under its write lock, so they take their turn with every
+    other write to the index instead of contending with it for SQLite's lock."""
+
+    def __init__(self, pool, max_batch=None, max_delay=None):
+        self.pool = pool
+        self.path = pool.path
+        self.max_batch = max_batch or settings.GROUP_COMMIT_MAX_BATCH
+        self.max_delay = settings.GROUP_COMMIT_MAX_DELAY if max_delay is None else max_delay
+        self.writes = 0
+        self.commits = 0
+        self._queue = Queue()
+        self._thread = None
+        self._lock = Lock()
+
+    def write(self, statement, params=()):
+        """Execute statement with params in the next group and return once it has been committed, raising whatever
+        error the statement raised"""
+        write = _Write(statement, params)
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, args=(self._queue,), name='group commit for ' + self.path)
+                self._thread.daemon = True
+                self._thread.start()
+            self._queue.put(write)
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+
+    def close(self):
+        """Commit whatever is queued and stop the writer thread"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._queue.put(None) # after every write queued so far
+                self._queue = Queue() # writes from now on start a new thread
+        if thread is not None:
+            thread.join()
+
+    def stats(self):
+        return {
+            'writes' : self.writes,
+            'commits' : self.commits,
+            'writes_per_commit' : float(self.writes) / self.commits if self.commits else 0.0,
+        }
+
+    def _run(self, queue):
+        stopping = False
+        while not stopping:
+            group = [queue.get()]
+            if group[0] is None:
+                break
+
+            deadline = time.time() + self.max_delay
+            while len(group) < self.max_batch:
+                try:
+                    write = queue.get(True, max(0, deadline - time.time()))
+                except Empty:
+                    break
+                if write is None:
+                    stopping = True
+                    break
+                group.append(write)
+
+            self._commit(group)
+
+    def _commit(self, group):
+        try:
+            conn = self.pool.acquire(editing=True)
+        except Exception as e:
+            for write in group:
+                write.error = e
+                write.done.set()
+            return
+
+        try:
+            try:
+                c = conn.cursor()
+                for write in group:
+                    c.execute(write.statement, write.params)
+                conn.commit()
+                self.commits += 1
+            except Exception:
+                conn.rollback()
+                # one bad write mustn't fail the rest of its group, so the group is retried a write at a time
+                for write in group:
+                    try:
+                        conn.execute(write.statement, write.params)
+                        conn.commit()
+                    except Exception as e:
+                        conn.rollback()
+                        write.error = e
+                    self.commits += 1
+        finally:
+            self.pool.release(editing=True)
+
+        self.writes += len(group)
+        for write in group:
+            write.done.set()
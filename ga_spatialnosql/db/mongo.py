@@ -1,7 +1,14 @@
 from django.contrib.gis.gdal.error import OGRException
 from django.contrib.gis.gdal import SpatialReference
-from ga_spatialnosql.index import GeoIndex
 from ga_spatialnosql import app_settings as settings
+from ga_spatialnosql.planner import QueryPlanner, ATTRIBUTE, INTERSECT
+from ga_spatialnosql.bitmap import Bitmap
+from ga_spatialnosql.wkb import WKBGeometry, geos_geometry, encode_geometries, is_empty
+from ga_spatialnosql.reproject import reproject_geojson
+from ga_spatialnosql.ingest import ingest
+from ga_spatialnosql.querycache import query_cache, normalized, write_generation, wrote
+from ga_spatialnosql import permissions
+from django.utils.importlib import import_module
 from bson import objectid
 import json
 from bson import json_util
@@ -9,6 +16,15 @@ from django.contrib.gis.geos import GEOSGeometry
 import UserDict
 from pymongo.errors import AutoReconnect
 from logging import getLogger
+from ga_spatialnosql.utils import chunk
+from itertools import islice
+from functools import wraps
+from threading import Thread, Lock, RLock, local
+from multiprocessing.pool import ThreadPool
+from collections import deque
+from Queue import Queue
+from hashlib import sha1
+import time
 
 log = getLogger(__name__)
 
@@ -18,9 +34,67 @@ def _from_objectid(oid):
 def _to_objectid(oid):
     return objectid.ObjectId(oid)
 
+def index_backend_class(name=None):
+    """The GeoIndex implementation registered under name in INDEX_BACKENDS, or the default one"""
+    module, cls = settings.INDEX_BACKENDS[name or settings.DEFAULT_INDEX_BACKEND].rsplit('.', 1)
+    return getattr(import_module(module), cls)
+
 def _fix_dict_geometry(g):
     if isinstance(g, dict):
-        return GEOSGeometry(json.dumps(g))
+        return geos_geometry(g)
+
+def _operator(name):
+    # geo_spec operators may be written mongo style, as '$within', or plain, as query documents do
+    return name[1:] if name.startswith('$') else name
+
+def _arguments(args):
+    return args if isinstance(args, tuple) or isinstance(args, list) else [args]
+
+# stored on features whose geometry has been through update(), so that an update that leaves a geometry as it was
+# doesn't reindex it
+GEOMETRY_HASH = '_geometry_hash'
+
+def _geometry_hash(feature):
+    return sha1(json.dumps([feature.get('geometry'), feature.get('crs')], sort_keys=True, default=json_util.default)).hexdigest()
+
+def _touches_geometry(document):
+    """Whether a Mongo update document can change a feature's geometry or crs"""
+    if not any(key.startswith('$') for key in document):
+        return True # a whole replacement document
+    for operator, fields in document.items():
+        names = list(fields) + (list(fields.values()) if operator == '$rename' else [])
+        if any(name.split('.', 1)[0] in ('geometry', 'crs') for name in names):
+            return True
+    return False
+
+def _sort_value(document, key):
+    value = document
+    for name in key.split('.'):
+        if not isinstance(value, dict) or name not in value:
+            return None # missing fields sort with nulls, first, as they do in Mongo
+        value = value[name]
+    return value
+
+def _sorted(documents, sort):
+    """documents in the order a pymongo sort, a key or a list of (key, direction), puts them in.  Values of different
+    types are compared as Python compares them, not in Mongo's type order."""
+    if isinstance(sort, basestring):
+        sort = [(sort, 1)]
+    documents = list(documents)
+    for key, direction in reversed(sort): # sorts are stable, so each pass keeps the order of the keys after it
+        documents.sort(key=lambda doc: _sort_value(doc, key), reverse=direction < 0)
+    return documents
+
+def _writes(method):
+    # wraps a collection method that changes features, so that query results cached before or during it aren't used
+    @wraps(method)
+    def write(self, *args, **kwargs):
+        self._wrote()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._wrote()
+    return write
 
 def _chunk(seq, size=1000):
     chunk = []
@@ -35,82 +109,298 @@ def _chunk(seq, size=1000):
     if chunk:
         yield chunk
 
+# Mongo fetches for large results are spread over one thread pool shared by every collection in the process, so the
+# number of concurrent fetches stays bounded however many queries are running.  Index lookups stay on the calling
+# thread, since index connections can't be shared between threads.
+_fetch_pool = None
+_fetch_pool_lock = Lock()
+
+def _fetch_threads():
+    global _fetch_pool
+    with _fetch_pool_lock:
+        if _fetch_pool is None:
+            _fetch_pool = ThreadPool(settings.FETCH_WORKERS)
+        return _fetch_pool
+
+# Collection handles are shared by every request in the process.  Opening one reads its metadata, may create the
+# collection, and opens its index, so each is opened once and kept until the collection is dropped or cleared.
+# Metadata written through a handle updates the cached copy as it is saved; metadata written by other processes is
+# reread at most every METADATA_TTL seconds, and a collection another process has dropped or recreated gets a new
+# handle then.
+_handles = {}
+_handles_lock = RLock()
+
+def _handle_key(db, collection=None):
+    return (id(db.connection), db.name) if collection is None else (id(db.connection), db.name, collection)
+
+def open_collection(db, collection, index_path=None, srid=None, index_backend=None, clear=False):
+    """The process-wide GeoJSONCollection for collection in the pymongo database db, opening it if need be.  With
+    clear, the collection is dropped and recreated empty, and the new handle replaces the open one."""
+    _check_backend(index_backend)
+    key = _handle_key(db, collection)
+    with _handles_lock:
+        if clear:
+            handle = GeoJSONCollection(db, collection, index_path, srid, clear=True, index_backend=index_backend)
+            invalidate(db, collection) # anything registered while it was recreated belongs to the old collection
+            _handles[key] = handle
+            return handle
+
+        handle = _handles.get(key)
+        if handle is not None and not handle.refresh():
+            invalidate(db, collection)
+            handle = None
+        if handle is None:
+            handle = _handles[key] = GeoJSONCollection(db, collection, index_path, srid, index_backend=index_backend)
+        return handle
+
+def invalidate(db, collection=None):
+    """Forget the open handle for collection, or for every collection in db.  Their indices are left open, since
+    other requests may still be reading through them, and are closed when the handles are collected; nothing held
+    back in them is ever written out, as it would land on whatever index replaces theirs."""
+    with _handles_lock:
+        if collection is None:
+            prefix = _handle_key(db)
+            keys = [key for key in _handles if key[:2] == prefix]
+        else:
+            keys = [_handle_key(db, collection)]
+        handles = [_handles.pop(key) for key in keys if key in _handles]
+    for handle in handles:
+        handle.index.discard()
+
 class ValidationError(Exception):
     pass
 
+def _check_backend(name):
+    if name is not None and name not in settings.INDEX_BACKENDS:
+        raise ValidationError('{name!r} is not an index backend: use one of {names}'.format(name=name, names=', '.join(sorted(settings.INDEX_BACKENDS))))
+
+def _check_property(key, value):
+    # properties are written as 'properties.<key>' fields, where a '.' would make a path and a leading '$' an operator,
+    # so names Mongo couldn't store whole are refused, at any depth, as saving the whole document used to
+    if not isinstance(key, basestring) or '.' in key or key.startswith('$'):
+        raise ValidationError("{key!r} can't be a property name: names must be strings without '.' or a leading '$'".format(key=key))
+    _check_values(value)
+
+def _check_geometry(geometry):
+    # an empty geometry has no envelope, which every index backend files rows under, so it's refused before anything
+    # is stored.  Encoding may run later on a worker pool, too late to refuse the feature cleanly.
+    if geometry is None or (geometry.empty if isinstance(geometry, GEOSGeometry) else is_empty(geometry)):
+        raise ValidationError("features need a geometry with coordinates; empty geometries can't be indexed")
+
+def _check_values(value):
+    if isinstance(value, dict):
+        for key, v in value.items():
+            _check_property(key, v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _check_values(v)
+
+class MetadataBatch(object):
+    """Holds back the metadata writes a thread makes to a collection until its outermost batch ends, then writes them
+    as one update.  Handles are shared between threads, and writes made on other threads go ahead as usual."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __enter__(self):
+        with self.collection._meta_lock:
+            self.collection._pending().depth += 1
+            self.collection._batches += 1
+        return self
+
+    def __exit__(self, extype, ex, val):
+        with self.collection._meta_lock:
+            pending = self.collection._pending()
+            pending.depth -= 1
+            self.collection._batches -= 1
+            if not pending.depth:
+                self.collection.flush()
+
 class GeoJSONCollection(object, UserDict.DictMixin):
     def _normalize_srs(self, fcrs):
         # untested, but finished
 
-        crs = None
-        reproject = False # assume we're not going to reproject unless proven otherwise
+        if fcrs == self.srid: # already in our own CRS, as features we've stored say they are
+            return self.srid, False
 
+        crs = fcrs
         try: # look for a CRS in the feature or featurecollection
-            if (isinstance(fcrs, str) or isinstance(fcrs, unicode)) :  # if it's a string, we can check to see if it matches the original.
-                crs = SpatialReference(str(fcrs))                                                              # if it doesn't, set a new one
-                reproject = True                                                                          # and reproject
-            elif isinstance(fcrs, int) and fcrs == self.srid:
-                reproject = False
-            elif not isinstance(fcrs, SpatialReference):                                                  # if it's not a string, make sure it's a SpatialReference object.
+            if isinstance(fcrs, dict) and fcrs.get('type') == 'name':                                      # a GeoJSON named crs, such as EPSG:4326
+                crs = fcrs['properties']['name']
+            if isinstance(crs, (str, unicode, int, long)):                                               # a string or srid, which may match our own.
+                crs = SpatialReference(str(crs) if isinstance(crs, unicode) else crs)
+            elif not isinstance(crs, SpatialReference):                                                  # if it's not a string, make sure it's a SpatialReference object.
                 raise ValidationError("feature's 'crs' cannot be interpreted as a SpatialReference by OGR") # otherwise whine.
-            else:
-                crs = fcrs
         except OGRException as e:
-            raise ValidationError("feature's 'crs' cannot be interpreted as a SpatialReference by OGR:\n"+ str(e) + "\n" + fcrs)
+            raise ValidationError("feature's 'crs' cannot be interpreted as a SpatialReference by OGR:\n{e}\n{crs}".format(e=e, crs=fcrs))
 
-        return reproject, crs
+        reproject = crs.srid != self.srid # only reproject if the crs isn't the one we store in
+        return crs, reproject
 
-    def _get_real_geometry(self, feature):
+    def _get_real_geometry(self, feature, processes=0, encode=True):
         # untested, but finished
         # start by assuming we're just using our own CRS.
         fc = feature['type'] == 'FeatureCollection' # if we have a feature collection we have to iterate over all the features
         crs, reproject = self._normalize_srs(feature['crs']) if 'crs' in feature else (self.srid, False)
 
         if fc: # if we have a feature collection, collect the geometry
+            for f in feature['features']:
+                _check_geometry(f['geometry'])
             if reproject:                                        # if we have to reproject
-                for i, f in enumerate(feature['features']):      # iterate over all the features
-                    geometry = f['geometry'] if isinstance(f['geometry'], GEOSGeometry) else GEOSGeometry(json.dumps(f['geometry']))
-                    geometry.transform(self.srid)              # transform their geometry in place
-                    f['geometry'] = json.loads(geometry.json) # and change the geometry itself in the data
+                for f in feature['features']:
+                    if isinstance(f['geometry'], GEOSGeometry):
+                        f['geometry'] = json.loads(f['geometry'].json)
+                # every coordinate in the collection is transformed in one call and written back into the data
+                reproject_geojson([f['geometry'] for f in feature['features']], crs, self.srid)
                 feature['crs'] = self.srid
-            geometry = (GEOSGeometry(json.dumps(fs['geometry']), srid=crs) for fs in feature['features'])
+            # the index only needs WKB and an envelope, so features are encoded straight from their GeoJSON
+            geometry = encode_geometries((fs['geometry'] for fs in feature['features']), self.srid, processes)
         else: # we have only a single feature
-            geometry = feature['geometry'] if isinstance(feature['geometry'], GEOSGeometry) else GEOSGeometry(json.dumps(feature['geometry']))
-            if reproject:
-                geometry.transform(self.srid)                    # reproject the feature if necessary
-                feature['geometry'] = json.loads(geometry.json) # and change the geometry itself in the data.
+            _check_geometry(feature['geometry'])
+            if reproject:                                        # reproject the feature if necessary, changing the geometry in the data
+                if isinstance(feature['geometry'], GEOSGeometry):
+                    feature['geometry'] = json.loads(feature['geometry'].json)
+                reproject_geojson([feature['geometry']], crs, self.srid)
                 feature['crs'] = self.srid
+            geometry = feature['geometry'] if isinstance(feature['geometry'], GEOSGeometry) or not encode else WKBGeometry.from_geojson(feature['geometry'], self.srid)
 
         return fc, feature, geometry                            # return a tuple of featurecollection:bool, the original dict, and the GEOS geometry.
 
-    def __init__(self, db, collection, index_path=None, srid=None, fc=None, clear=False):
+    def __init__(self, db, collection, index_path=None, srid=None, fc=None, clear=False, bulk_load=False, index_backend=None):
+        _check_backend(index_backend)
         # pull collection metadata from the database if it exists
         if clear:
-            GeoIndex(index_path, collection, _from_objectid, _to_objectid, srid=srid if srid else 4326).drop()
+            invalidate(db, collection)
+            permissions.invalidate(db.name, collection)
+            previous = db.geojson__meta.find_one(collection)
+            # the old index is whatever backend the collection was made with, not the one it's being recreated with
+            backend = previous.get('index_backend') if previous else index_backend
+            index_backend_class(backend).destroy(index_path, collection)
             db[collection].drop()
             db.geojson__meta.remove(collection)
 
+        self._db = db
+        self.name = collection
+        self._local = local() # the fields each thread has changed, and how deep in metadata batches it is
+        self._batches = 0 # open on any thread; the cached metadata isn't reread while there are any
+        self._meta_lock = RLock()
         self.collection_metadata = db.geojson__meta
-        self.meta = db.geojson__meta.find_one(collection) or {
-            'srid' : srid,
-            'index_path' : index_path,
-            '_id' : collection,
-            'properties' : {}
-        }
-        self.collection_metadata.save(self.meta)
-        if collection not in db.collection_names():
-            db.create_collection(collection)
+        self.meta = db.geojson__meta.find_one(collection)
+        self.loaded = time.time()
+        if self.meta is None:
+            self.meta = {
+                'srid' : srid,
+                'index_path' : index_path,
+                '_id' : collection,
+                'index_backend' : index_backend or settings.DEFAULT_INDEX_BACKEND,
+                'created' : objectid.ObjectId(), # tells handles in other processes the collection was recreated
+                '_version' : 0, # counts metadata writes, so handles reread the document only when it has changed
+                'properties' : {}
+            }
+            self.collection_metadata.save(self.meta)
+            if collection not in db.collection_names():
+                db.create_collection(collection)
 
 
         if fc and not self.meta['srid'] and 'crs' in fc:
             self.srid = fc['crs'] # however this means crs must conform to an integer srid.  This is not preferred by the spec but necessary here.
 
         # instantiate GeoIndex for collection
-        self.index = GeoIndex(index_path, collection, _from_objectid, _to_objectid, srid=srid if srid else 4326)
+        self.index = index_backend_class(self.meta.get('index_backend'))(index_path, collection, _from_objectid, _to_objectid, srid=srid if srid else 4326)
         self.coll = db[collection]
+        self.planner = QueryPlanner(self.index, self.coll)
+        self.last_plan = None
 
         if fc:
-            self.insert_features(fc, replace=True)
+            self.insert_features(fc, replace=True, bulk_load=bulk_load)
+
+    def refresh(self):
+        """Check metadata older than METADATA_TTL against the database, rereading it if its version has moved on.
+        False if the collection has since been dropped or recreated, and this handle is no longer any use."""
+        if time.time() - self.loaded < settings.METADATA_TTL:
+            return True
+        with self._meta_lock:
+            stamp = self.collection_metadata.find_one(self.name, fields=['created', '_version'])
+            if stamp is None or stamp.get('created') != self.meta.get('created'):
+                return False
+            if stamp.get('_version') != self.meta.get('_version') and not self._batches:
+                meta = self.collection_metadata.find_one(self.name)
+                if meta is None:
+                    return False
+                self.meta = meta
+            self.loaded = time.time()
+        return True
+
+    def _generation_key(self):
+        return (self._db.name, self.name, self.meta.get('created'))
+
+    @property
+    def generation(self):
+        """Bumped around every write to the collection, through any handle in this process, so that cached query
+        results from before it are never used"""
+        return write_generation(self._generation_key())
+
+    def _wrote(self):
+        wrote(self._generation_key())
+
+    def cache_stats(self):
+        """Hits, misses and size of the query result cache, which is shared by every collection in the process"""
+        return query_cache().stats()
+
+    def metadata_batch(self):
+        """A context in which metadata changes are only written, together, when it ends"""
+        return MetadataBatch(self)
+
+    def _pending(self):
+        pending = self._local
+        if not hasattr(pending, 'fields'):
+            pending.fields = set()
+            pending.depth = 0
+        return pending
+
+    def _changed(self, field):
+        with self._meta_lock:
+            pending = self._pending()
+            pending.fields.add(field)
+            if not pending.depth:
+                self.flush()
+
+    def _meta_value(self, field):
+        value = self.meta
+        for name in field.split('.'):
+            if name not in value:
+                return False, None
+            value = value[name]
+        return True, value
+
+    def flush(self):
+        """Write the metadata fields this thread has changed with one $set and $unset, rather than saving the whole
+        document"""
+        with self._meta_lock:
+            pending = self._pending()
+            fields, pending.fields = pending.fields, set()
+            sets, unsets = {}, {}
+            for field in fields:
+                if any(field.startswith(parent + '.') for parent in fields): # written whole with its parent
+                    continue
+                found, value = self._meta_value(field)
+                if found:
+                    sets[field] = value
+                else:
+                    unsets[field] = 1
+            if not (sets or unsets):
+                return
+
+            update = {'$inc' : {'_version' : 1}}
+            if sets:
+                update['$set'] = sets
+            if unsets:
+                update['$unset'] = unsets
+            # a handle outlives the collection it was opened on, so nothing is written over a recreated collection
+            self.collection_metadata.update({'_id' : self.meta['_id'], 'created' : self.meta.get('created')}, update)
+            self.meta['_version'] = self.meta.get('_version', 0) + 1
+            if any(field in ('properties', 'properties.permissions') or field.startswith('properties.permissions.') for field in fields):
+                permissions.invalidate(self._db.name, self.name) # decisions made on the old permissions
 
     @property
     def srid(self):
@@ -119,23 +409,28 @@ class GeoJSONCollection(object, UserDict.DictMixin):
     @srid.setter
     def srid(self, srid):
         self.meta['srid'] = srid
-        self.collection_metadata.save(self.meta)
+        self._changed('srid')
 
     def __setitem__(self, key, value):
+        _check_property(key, value)
         self.meta['properties'][key] = value
-        self.collection_metadata.save(self.meta)
+        self._changed('properties.' + key)
 
     def __getitem__(self, key):
         return self.meta['properties'][key]
 
     def __delitem__(self, key):
         del self.meta['properties'][key]
-        self.collection_metadata.save(self.meta)
+        self._changed('properties.' + key)
 
     def keys(self):
         return self.meta['properties'].keys()
 
     def drop(self):
+        if hasattr(self, '_db'):
+            invalidate(self._db, self.name)
+            permissions.invalidate(self._db.name, self.name)
+
         if hasattr(self, 'index'):
             self.index.drop()
 
@@ -145,10 +440,17 @@ class GeoJSONCollection(object, UserDict.DictMixin):
         if hasattr(self, 'meta'):
             self.collection_metadata.remove(self.meta['_id'])
 
-    def insert_features(self, fc, replace=False, **kwargs):
+    @_writes
+    def insert_features(self, fc, replace=False, bulk_load=False, processes=None, **kwargs):
+        """Insert a FeatureCollection, a feature, or a list of features.  processes is the number of worker processes
+        that encode the geometries of a collection or list for the index, ENCODE_PROCESSES if it isn't given."""
+        if bulk_load:
+            with self.index.bulk_load():
+                return self.insert_features(fc, replace=replace, processes=processes, **kwargs)
 
+        processes = settings.ENCODE_PROCESSES if processes is None else processes
         if(hasattr(fc, 'keys')):
-            is_fc, fc, geometry = self._get_real_geometry(fc)
+            is_fc, fc, geometry = self._get_real_geometry(fc, processes)
 
             if is_fc:
                 features = fc['features']
@@ -159,14 +461,16 @@ class GeoJSONCollection(object, UserDict.DictMixin):
                 fc['crs'] = self.srid
 
                 if replace:
+                    _check_values(fc)
                     self.meta['properties'] = fc
-                    self.collection_metadata.save(self.meta)
+                    self._changed('properties')
                 else:
-                    for k, v in filter(lambda (x,y): x not in ('crs','type'), fc.items()):
-                        if k not in self:
-                            self[k] = v
-                        elif v != self[k]:
-                            raise KeyError("{k} already in feature collection and is not equal")
+                    with self.metadata_batch():
+                        for k, v in filter(lambda (x,y): x not in ('crs','type'), fc.items()):
+                            if k not in self:
+                                self[k] = v
+                            elif v != self[k]:
+                                raise KeyError("{k} already in feature collection and is not equal")
 
                 fcid = self.meta['_id']
                 for f in features:
@@ -185,62 +489,290 @@ class GeoJSONCollection(object, UserDict.DictMixin):
 
 
                 self.index.bulk_insert(zip(ids, geometry))
+                self.planner.wrote(len(ids))
             else:
                 oid = self.coll.insert(fc, **kwargs)
                 self.index.insert(oid, geometry)
+                self.planner.wrote()
         else:
             fs = []
             gs = []
             for f in fc:
-                _, f, geometry = self._get_real_geometry(f)
+                _, f, geometry = self._get_real_geometry(f, encode=not processes)
                 fs.append(f)
                 gs.append(geometry)
                 f['_parent'] = self.meta["_id"]
-
+            if processes:
+                gs = encode_geometries(gs, self.srid, processes)
 
             oids = self.coll.insert(fs)
             self.index.bulk_insert(zip(oids, gs))
+            self.planner.wrote(len(oids))
+
 
+    def insert_stream(self, stream, batch_size=None, bulk_load=False, progress=None):
+        """Insert the features in a GeoJSON or GeoJSONSeq file or stream, however large, in batches.  Returns the
+        ingest statistics; progress is called with them after each batch."""
+        return ingest(self, stream, batch_size=batch_size, bulk_load=bulk_load, progress=progress)
 
+    @_writes
     def delete_feature(self, oid):
         self.index.delete(oid)
         self.coll.remove(oid)
 
+    @_writes
     def delete_features(self, geo_spec=None, spec=None):
-        # TODO use a generator function so I can use bulk_delete()
-
+        """Delete the features matching a query.  They are tombstoned in the index a chunk at a time, one transaction
+        per chunk, and purged from it later by compaction."""
         features = _chunk(f['_id'] for f in self.find_features(geo_spec=geo_spec, spec=spec, fields=['_id']))
         for chunk in features:
-            for f in chunk:
-                self.index.delete(f)
+            self.index.tombstone(chunk)
             self.coll.remove({"_id" : { "$in" : chunk}})
+            self.planner.wrote(len(chunk))
+
+    @_writes
+    def delete_region(self, geom, srid=None):
+        """Delete every feature whose geometry intersects geom.  The index finds and tombstones them itself, in one
+        transaction, and only the documents are removed from Mongo.  Returns the number deleted."""
+        oids = self.index.delete_region(geom, srid)
+        self.planner.wrote(len(oids))
+        for chunk in _chunk(oids):
+            self.coll.remove({"_id" : { "$in" : chunk}})
+        return len(oids)
 
-    def update(self, spec, document, upsert=False, manipulate=False, safe=False, multi=False, no_geometry=False, **kwargs):
-        # TODO use a generator function so I can use bulk insert
-        self.coll.update(spec, document, upsert, manipulate, safe, multi, **kwargs)
-        features = self.coll.find(spec)
+    def compact(self):
+        """Purge deleted features from the index now, rather than waiting for background compaction"""
+        return self.index.compact()
 
-        if no_geometry is False:
-            for feature in features:
+    @_writes
+    def update(self, spec, document, upsert=False, manipulate=False, safe=False, multi=False, no_geometry=False, **kwargs):
+        """Apply a Mongo update.  Updates that can't change geometry leave the index alone; otherwise the features
+        whose geometry did change are reindexed together, and nothing else is rewritten."""
+        if no_geometry or not _touches_geometry(document):
+            return self.coll.update(spec, document, upsert, manipulate, safe, multi, **kwargs)
+
+        # the spec may not match the documents once they're updated, so they're found first, and the update is applied
+        # to exactly those: whatever the spec matches by the time it runs, only they are reindexed
+        ids = [doc['_id'] for doc in self.coll.find(spec, fields=['_id']).limit(0 if multi else 1)]
+        if ids or not upsert:
+            result = self.coll.update({'_id' : {'$in' : ids}}, document, False, manipulate, safe, multi, **kwargs)
+        else:
+            result = self.coll.update(spec, document, upsert, manipulate, safe, multi, **kwargs)
+            upserted = result.get('upserted') if isinstance(result, dict) else None
+            ids = [upserted] if upserted is not None else [doc['_id'] for doc in self.coll.find(spec, fields=['_id']).limit(1)]
+        self._reindex_changed(ids)
+        return result
+
+    def _reindex_changed(self, ids):
+        """Bring the index up to date with the geometries of the features ids, touching only the ones that changed"""
+        for group in _chunk(ids):
+            changed, removed = [], []
+            for feature in self.coll.find({'_id' : {'$in' : group}}, fields=['type', 'geometry', 'crs', GEOMETRY_HASH]):
+                if feature.get('geometry') is None:
+                    removed.append(feature['_id'])
+                elif _geometry_hash(feature) != feature.get(GEOMETRY_HASH):
+                    changed.append(feature)
+
+            geometries = []
+            for feature in changed:
+                crs = feature.get('crs')
                 _, feature, geometry = self._get_real_geometry(feature)
-                self.coll.save(feature)
-                self.index.insert(feature['_id'], geometry)
-
-
-
-    def _find_geo(self, geo_spec):
-        geo_ids = None
-        for operator, geometry in geo_spec.items():
-            if not (isinstance(geometry, tuple) or isinstance(geometry, list)):
-                geometry = [geometry]
-            if geo_ids is None:
-                geo_ids = set(self.index.__getattribute__(operator[1:])(*geometry))
+                geometries.append((feature['_id'], geometry))
+                stored = {GEOMETRY_HASH : _geometry_hash(feature)}
+                if feature.get('crs') != crs: # reprojected into the collection's srid
+                    stored.update(geometry=feature['geometry'], crs=feature['crs'])
+                self.coll.update({'_id' : feature['_id']}, {'$set' : stored})
+
+            if removed:
+                self.index.bulk_delete(removed)
+            if geometries:
+                self.index.bulk_upsert(geometries)
+            self.planner.wrote(len(removed) + len(geometries))
+
+
+
+    def _evaluate(self, geo_spec, rows=None, after=None, limit=None):
+        """Bitmap of the index rows matching geo_spec, out of rows if it is given.  The terms of a geo_spec are ANDed
+        most selective first, and each term only tests the rows that survived the ones before it.  Besides the index
+        operators, '$or' and '$and' take a list of geo_specs and '$not' takes a geo_spec.  after and limit page
+        through the result in row order, and are pushed down into the index where they can be."""
+        terms = geo_spec.items()
+        if len(terms) > 1: # a lone term needs no estimate, which could mean building the statistics
+            terms.sort(key=lambda (operator, args): (_operator(operator) == 'not', self.planner.term_estimate(operator, args)))
+        for n, (operator, args) in enumerate(terms):
+            if rows is not None and not rows:
+                break
+
+            operator = _operator(operator)
+            if operator == 'or':
+                matched = Bitmap()
+                for alternative in args:
+                    matched |= self._evaluate(alternative, rows, after)
+                rows = matched
+            elif operator == 'and':
+                for term in args:
+                    rows = self._evaluate(term, rows, after)
+            elif operator == 'not':
+                rows = (Bitmap.from_rows(self.index.all_rows()) if rows is None else rows) - self._evaluate(args, rows, after)
             else:
-                geo_ids = geo_ids.intersection(set(self.index.__getattribute__(operator)(*geometry)))
-
-        if geo_ids is None:
-            geo_ids = set()
-        return geo_ids
+                # only the last term can stop at limit; earlier ones have to pass on everything that might survive
+                rows = Bitmap.from_rows(getattr(self.index, operator)(*_arguments(args), candidates=rows, rows=True, after=after, limit=limit if n == len(terms) - 1 else None))
+
+        if rows is None:
+            return Bitmap()
+        if after is not None:
+            rows = rows.after(after)
+        return rows.first(limit) if limit else rows
+
+    def _find_geo_rows(self, geo_spec, candidates=None, after=None, limit=None):
+        rows = None if candidates is None else Bitmap.from_rows(self.index.rows_of(candidates))
+        return self._evaluate(geo_spec, rows, after, limit)
+
+    def _find_geo(self, geo_spec, candidates=None):
+        """The ids matching geo_spec, out of the ids in candidates if it is given"""
+        with self.index.pinned():
+            return list(self.index.ids_of(self._find_geo_rows(geo_spec, candidates)))
+
+    def plan(self, geo_spec, spec):
+        """How find_features runs a query with both a geo_spec and a spec.  The returned dict holds the 'strategy' and
+        the estimates it was chosen from; see ga_spatialnosql.planner."""
+        return self.planner.plan(dict((_operator(operator), _arguments(args)) for operator, args in geo_spec.items()), spec)
+
+    def _attribute_ids(self, spec):
+        return [doc['_id'] for doc in self.coll.find(spec, fields=['_id'])]
+
+    def _find_planned(self, geo_spec, spec, after=None):
+        plan = self.last_plan = self.plan(geo_spec, spec)
+        log.debug('query plan for {name}: {plan}'.format(name=self.meta['_id'], plan=plan))
+
+        if plan['strategy'] == ATTRIBUTE:
+            return self._find_geo_rows(geo_spec, candidates=self._attribute_ids(spec), after=after)
+
+        if plan['strategy'] == INTERSECT:
+            # Mongo is queried on a thread while the index is searched here, since index connections can't be shared
+            # between threads
+            fetched = {}
+            def fetch():
+                try:
+                    fetched['ids'] = self._attribute_ids(spec)
+                except Exception as e:
+                    fetched['error'] = e
+            fetcher = Thread(target=fetch)
+            fetcher.start()
+            geo_rows = self._find_geo_rows(geo_spec, after=after)
+            fetcher.join()
+            if 'error' in fetched:
+                raise fetched['error']
+            return geo_rows & Bitmap.from_rows(self.index.rows_of(fetched['ids']))
+
+        return self._find_geo_rows(geo_spec, after=after)
+
+    def _fetch_ids(self, ids, spec, find, size=1000, ordered=True, prefetch=None):
+        """Yield the documents for ids, fetched from Mongo in $in chunks of size.  Up to prefetch chunks are
+        fetched ahead on the shared fetch pool while earlier ones are consumed.  Ordered results come out in row
+        order, which paging depends on; unordered ones come a chunk at a time in whatever order the fetches finish."""
+        prefetch = settings.FETCH_PREFETCH if prefetch is None else prefetch
+
+        def fetch(ids):
+            in_chunk = { "_id" : { "$in" : ids }}
+            docs = dict((doc['_id'], doc) for doc in find({"$and" : [spec, in_chunk]} if spec else in_chunk))
+            # documents come back from Mongo in no particular order, so each chunk is put back into row order
+            return [docs[oid] for oid in ids if oid in docs]
+
+        chunks = chunk(ids, size)
+        if not prefetch:
+            for ids in chunks:
+                for doc in fetch(ids):
+                    yield doc
+            return
+
+        pool = _fetch_threads()
+        if ordered:
+            pending = deque()
+            for ids in chunks:
+                pending.append(pool.apply_async(fetch, (ids,)))
+                if len(pending) > prefetch:
+                    for doc in pending.popleft().get():
+                        yield doc
+            while pending:
+                for doc in pending.popleft().get():
+                    yield doc
+            return
+
+        done = Queue()
+        def fetch_into_queue(ids):
+            try:
+                done.put((fetch(ids), None))
+            except Exception as e:
+                done.put((None, e))
+
+        chunks = iter(chunks)
+        running = 0
+        while True:
+            for ids in islice(chunks, prefetch + 1 - running):
+                pool.apply_async(fetch_into_queue, (ids,))
+                running += 1
+            if not running:
+                return
+
+            docs, error = done.get()
+            running -= 1
+            if error:
+                raise error
+            for doc in docs:
+                yield doc
+
+    def _page_token(self, doc, geo, epoch=None):
+        # spatial tokens are index row numbers, stamped with the row epoch of the index the query ran against when it
+        # has one: a backend that renumbers its rows changes its epoch, and tokens from before that are refused rather
+        # than misread.  The row is looked up again once the documents are out, and if the index has been renumbered
+        # since, the token still carries the query's epoch, so it is refused too.
+        if geo:
+            with self.index.pinned():
+                rows = self.index.rows_of([doc['_id']])
+            return 'r{row}{epoch}'.format(row=rows[0], epoch='.' + epoch if epoch else '') if rows else None
+        return str(doc['_id'])
+
+    def _parse_page_token(self, after, geo):
+        if after is None:
+            return None
+        try:
+            if geo:
+                if not after.startswith('r'):
+                    raise ValueError(after)
+                row, _, epoch = after[1:].partition('.')
+                row = int(row)
+            else:
+                return _to_objectid(after)
+        except (ValueError, TypeError, objectid.InvalidId):
+            raise ValidationError('{after} is not a page token for this query'.format(after=after))
+        if epoch != self.index.row_epoch():
+            raise ValidationError('{after} is from before the index was renumbered; start paging again'.format(after=after))
+        return row
+
+    def _find_nearest(self, geo_spec, spec, limit, find):
+        # nearest-neighbour queries come back from the index in distance order.  Candidates are fetched from Mongo a
+        # chunk at a time and yielded in that order, so a spec that rejects some of them just pulls in the next ones.
+        geo_spec = dict((_operator(operator), args) for operator, args in geo_spec.items())
+        args = geo_spec.pop('nearest')
+        if not (isinstance(args, tuple) or isinstance(args, list)):
+            args = [args]
+        geom = args[0]
+        k = limit or (args[1] if len(args) > 1 else None)
+
+        allowed = set(self._find_geo(geo_spec)) if geo_spec else None # nearest() itself deals in ids, not rows
+        candidates = (oid for oid in self.index.nearest(geom) if allowed is None or oid in allowed)
+
+        found = 0
+        for chunk in _chunk(candidates, size=min(k or 1000, 1000)):
+            in_chunk = { "_id" : { "$in" : chunk }}
+            docs = dict((doc['_id'], doc) for doc in find({"$and" : [spec, in_chunk]} if spec else in_chunk))
+            for oid in chunk:
+                if oid in docs:
+                    yield docs[oid]
+                    found += 1
+                    if found == k:
+                        return
 
     def find_as_collection(self, **kawrgs):
         ret = {
@@ -252,104 +784,152 @@ class GeoJSONCollection(object, UserDict.DictMixin):
         return ret
 
     def find_features(self, query=None, geo_spec=None, spec=None, fields=None, skip=0, limit=0, timeout=True, snapshot=False, tailable=False, sort=None, max_scan=None,
-             as_class=None, slave_okay=False, await_data=False, partial=False, manipulate=True, **kwargs):
+             as_class=None, slave_okay=False, await_data=False, partial=False, manipulate=True, after=None, page=None, ordered=True, prefetch=None, **kwargs):
+        """Yield the features matching a query, given either as a GeoJSON query document or as a geo_spec and a
+        Mongo spec.  To page through a large result, pass a dict as page: once the results are exhausted, page['next']
+        holds a token that, passed back as after with the same query, continues where this page stopped.
+
+        Spatial results are fetched from Mongo prefetch chunks ahead (FETCH_PREFETCH by default, 0 to fetch serially).
+        With ordered=False they are yielded as the fetches complete rather than in index order; skip and paging need
+        a stable order, so they keep results ordered regardless.  A sorted spatial query is fetched whole and sorted
+        after fetching, and pages by skip and limit only.
+
+        Spatial query results are cached (see querycache), keyed by the query and this collection's write
+        generation."""
 
         if query:
             if isinstance(query, str) or isinstance(query, unicode):
                 query = json.loads(query)
             try:
-                spec = query['properties']['query'] if 'query' in query['properties'] else None
-                fields = query['properties']['fields'] if 'fields' in query['properties'] else None
-                skip = query['properties']['skip'] if 'skip' in query['properties'] else None
-                limit = query['properties']['limit'] if 'limit' in query['properties'] else None
-                timeout = query['properties']['timeout'] if 'timeout' in query['properties'] else None
-                snapshot = query['properties']['snapshot'] if 'snapshot' in query['properties'] else None
-                sort = query['properties']['sort'] if 'sort' in query['properties'] else None
-                max_scan = query['properties']['max_scan'] if 'max_scan' in query['properties'] else None
-                slave_okay = query['properties']['slave_okay'] if 'slave_okay' in query['properties'] else None
-                manipulate = query['properties']['manipulate'] if 'manipulate' in query['properties'] else None
-                tailable = query['properties']['tailable'] if 'tailable' in query['properties'] else None
-                as_class = query['properties']['as_class'] if 'as_class' in query['properties'] else None
-                await_data = query['properties']['await_data'] if 'await_data' in query['properties'] else None
-                partial = query['properties']['partial'] if 'partial' in query['properties'] else None
-                srid = int(query['properties']['srid']) if 'srid' in query['properties'] else self.coll.srid
-                srid = int(query['crs']) if 'crs' in query['properties'] and srid is None else self.coll.srid
+                props = query['properties']
+                spec = props.get('query', None)
+                fields = props.get('fields', fields)
+                skip = props.get('skip', skip)
+                limit = props.get('limit', limit)
+                timeout = props.get('timeout', timeout)
+                snapshot = props.get('snapshot', snapshot)
+                sort = props.get('sort', sort)
+                max_scan = props.get('max_scan', max_scan)
+                slave_okay = props.get('slave_okay', slave_okay)
+                manipulate = props.get('manipulate', manipulate)
+                tailable = props.get('tailable', tailable)
+                as_class = props.get('as_class', as_class)
+                await_data = props.get('await_data', await_data)
+                partial = props.get('partial', partial)
+                after = props.get('after', after)
+                srid = int(props['srid']) if 'srid' in props else int(query['crs']) if 'crs' in query else self.srid
                 query_type = query['type'] if 'type' in query else None
                 if query_type == 'Feature':
                     if query['geometry']['type'] == 'GeometryCollection':
-                        geoms = [GEOSGeometry(json.dumps(g), srid) for g in query['geometry']['geometries']]
-                        operators = query['properties']['geographic_operators']
-                        geo_spec = dict(zip(operators, geoms))
+                        geoms = [geos_geometry(g, srid) for g in query['geometry']['geometries']]
+                        operators = props['geographic_operators']
+                        if props.get('geographic_join', 'and') == 'or':
+                            geo_spec = { '$or' : [{ operator : geom } for operator, geom in zip(operators, geoms)] }
+                        else:
+                            geo_spec = dict(zip(operators, geoms))
                     else:
-                        geom = GEOSGeometry(json.dumps(query['geometry'], srid))
-                        geo_spec = { query['properties']['geographic_operator'] : [geom] }
-                        if "relation" in query['properties'] and query['properties']['geoegraphic_operator'] == 'relate':
-                            geo_spec['relate'].append( query['properties']['relation'] )
+                        geom = geos_geometry(query['geometry'], srid)
+                        operator = props['geographic_operator']
+                        geo_spec = { operator : [geom] }
+                        if operator == 'relate':
+                            geo_spec[operator] = [props['relation'], geom]
+                        elif operator == 'nearest' and 'k' in props:
+                            geo_spec[operator].append(int(props['k']))
+                        elif operator == 'dwithin':
+                            geo_spec[operator].append(float(props['distance']))
             except KeyError as e:
                 raise TypeError("""Query must be either a GeoJSON document or in GeoJSON style with a "properties" attribute at minimum.""")
 
-        if geo_spec and spec:
-            geo_ids = _chunk(self._find_geo(geo_spec))
-            for chunk in geo_ids:
-                r = self.coll.find(
-                        {"$and" : [spec, { "_id" : { "$in" : chunk }}]},
-                    fields=fields,
-                    skip=skip,
-                    timeout=timeout,
-                    snapshot=snapshot,
-                    tailable=tailable,
-                    sort=sort,
-                    max_scan=max_scan,
-                    as_class=as_class,
-                    slave_okay=slave_okay,
-                    await_data=await_data,
-                    partial=partial,
-                    manipulate=manipulate,
-                    **kwargs
-                )
-                for i in r:
-                    yield i
+        options = dict(
+            fields=fields,
+            timeout=timeout,
+            snapshot=snapshot,
+            tailable=tailable,
+            sort=sort,
+            max_scan=max_scan,
+            as_class=as_class,
+            slave_okay=slave_okay,
+            await_data=await_data,
+            partial=partial,
+            manipulate=manipulate,
+            **kwargs
+        )
+        find = lambda mongo_spec, **extra: self.coll.find(spec=mongo_spec, **dict(options, **extra))
+        skip = skip or 0
+        end = skip + limit if limit else None
+
+        cache = query_cache() if geo_spec and not (tailable or await_data) and settings.QUERY_CACHE_ENTRIES else None
+        if cache:
+            # page tokens are only good for the row epoch they were made in
+            key = self._generation_key() + (self.generation, self.index.row_epoch(), normalized(geo_spec), normalized(spec),
+                normalized(fields), skip, limit, normalized(sort), after, ordered)
+            cached = cache.get(key, as_class)
+            if cached is not None:
+                documents, next_page = cached
+                for doc in documents:
+                    yield doc
+                if page is not None:
+                    page['next'] = next_page
+                return
+            collector = cache.collector()
+
+        # the rows a spatial query deals in have to mean the same features from evaluating the geo_spec to resolving
+        # them to ids, so the index holds its row numbering still until they are resolved.  It lets go before any
+        # document is fetched, rather than tie up a read slot and transaction for as long as the caller reads.
+        epoch = None
+        if geo_spec and 'nearest' in map(_operator, geo_spec.keys()):
+            if sort:
+                raise ValidationError('nearest-neighbour results come in distance order and can\'t be sorted')
+            # distance order has no keyset, so nearest queries page with skip and limit only
+            results = islice(self._find_nearest(geo_spec, spec, end or 0, find), skip, None)
+            geo = None
+        elif geo_spec and sort:
+            # documents are fetched in chunks by index row, so Mongo can't sort them.  The whole result is fetched
+            # and sorted here, and pages by skip and limit, since page tokens follow row order.
+            if after is not None:
+                raise ValidationError('sorted spatial queries page with skip and limit, not page tokens')
+            with self.index.pinned():
+                rows = self._find_planned(geo_spec, spec, None) if spec else self._find_geo_rows(geo_spec)
+                ids = list(self.index.ids_of(rows))
+            results = islice(_sorted(self._fetch_ids(ids, spec, find, ordered=False, prefetch=prefetch), sort), skip, end)
+            geo = None
         elif geo_spec:
-            geo_ids = _chunk(self._find_geo(geo_spec))
-            for chunk in geo_ids:
-                r = self.coll.find(
-                    spec={ '_id' : {'$in' : chunk}},
-                    fields=fields,
-                    skip=skip,
-                    timeout=timeout,
-                    snapshot=snapshot,
-                    tailable=tailable,
-                    sort=sort,
-                    max_scan=max_scan,
-                    as_class=as_class,
-                    slave_okay=slave_okay,
-                    await_data=await_data,
-                    partial=partial,
-                    manipulate=manipulate,
-                    **kwargs
-                )
-                for i in r:
-                    yield i
+            # skip and limit count over the whole result, in index row order.  Without a spec they go into the index
+            # query itself; with one, chunks are fetched only until the page is full.
+            geo = True
+            with self.index.pinned():
+                epoch = self.index.row_epoch()
+                after = self._parse_page_token(after, geo)
+                if spec:
+                    rows = self._find_planned(geo_spec, spec, after)
+                else:
+                    rows = self._find_geo_rows(geo_spec, after=after, limit=end)
+                ids = list(self.index.ids_of(rows))
+            ordered = ordered or bool(skip) or page is not None
+            results = islice(self._fetch_ids(ids, spec, find, size=min(end or 1000, 1000), ordered=ordered, prefetch=prefetch), skip, end)
         else:
-            iter = self.coll.find(
-                spec=spec,
-                fields=fields,
-                skip=skip,
-                limit=limit,
-                timeout=timeout,
-                snapshot=snapshot,
-                tailable=tailable,
-                sort=sort,
-                max_scan=max_scan,
-                as_class=as_class,
-                slave_okay=slave_okay,
-                await_data=await_data,
-                partial=partial,
-                manipulate=manipulate,
-                **kwargs
-            )
-            for o in iter:
-                yield o
+            geo = False
+            after = self._parse_page_token(after, geo)
+            if after is not None:
+                # keyset paging runs in _id order, so a deep page is an index seek rather than a long skip
+                spec = {"$and" : [spec, {"_id" : {"$gt" : after}}]} if spec else {"_id" : {"$gt" : after}}
+            paged = after is not None or page is not None
+            results = find(spec, skip=skip, limit=limit, sort=sort or ([('_id', 1)] if paged else None))
+
+        last = None
+        found = 0
+        for doc in results:
+            last = doc
+            found += 1
+            if cache:
+                collector.add(doc)
+            yield doc
+
+        next_page = self._page_token(last, geo, epoch) if geo is not None and limit and found == limit and '_id' in last else None
+        if page is not None:
+            page['next'] = next_page
+        if cache:
+            cache.put(key, collector, next_page)
 
     def get(self, key):
         return self.coll.find_one(key)
@@ -408,14 +988,16 @@ class GeoJSONCollection(object, UserDict.DictMixin):
         return json.loads(js, object_hook=json_util.object_hook)
 
 class Database(object, UserDict.DictMixin):
-    def __init__(self, db):
+    def __init__(self, db, index_backend=None):
         self._db = db
-        self._collections = {}
+        self._index_backend = index_backend
 
     def __getitem__(self, key):
-        if key not in self._collections:
-            self._collections[key] = GeoJSONCollection(self._db, key, settings.INDEX_PATH, settings.DEFAULT_SRID)
-        return self._collections[key]
+        return self.collection(key)
+
+    def collection(self, key, index_backend=None):
+        """Open a collection, creating it with the given index backend (or this database's default) if it is new"""
+        return open_collection(self._db, key, settings.INDEX_PATH, settings.DEFAULT_SRID, index_backend=index_backend or self._index_backend)
 
     def __setitem__(self, key, value):
         if value is not None:
@@ -432,9 +1014,12 @@ class Database(object, UserDict.DictMixin):
 class Connection(object, UserDict.DictMixin):
     def __init__(self, connection):
         self._connection = connection
+        self._databases = {}
 
     def __getitem__(self, key):
-        return Database(self._connection[key])
+        if key not in self._databases:
+            self._databases[key] = Database(self._connection[key])
+        return self._databases[key]
 
     def __setitem__(self, key, value):
         if value is not None:
@@ -443,6 +1028,8 @@ class Connection(object, UserDict.DictMixin):
             a = self._connection[key]
 
     def __delitem__(self, key):
+        invalidate(self._connection[key])
+        self._databases.pop(key, None)
         self._connection.drop_database(key)
 
     def keys(self):
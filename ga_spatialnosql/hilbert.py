@@ -0,0 +1,58 @@
+__author__ = 'jeff'
+
+# Hilbert curve ordering for envelopes.  Sorting rows along the curve before they reach an R-tree keeps spatially
+# close rows close together on disk and in the tree, which is what makes packed and bulk-built trees efficient.
+
+HILBERT_ORDER = 16
+
+def hilbert_index(x, y, order=HILBERT_ORDER):
+    """Distance along a Hilbert curve of the given order for the integer cell (x, y), 0 <= x, y < 2**order"""
+    n = 1 << order
+    d = 0
+    s = n >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return d
+
+def extent_of(extents):
+    """Combined (xmin, ymin, xmax, ymax) of a sequence of extents, or None if it is empty"""
+    xmin = ymin = float('inf')
+    xmax = ymax = float('-inf')
+    for exmin, eymin, exmax, eymax in extents:
+        if exmin < xmin: xmin = exmin
+        if eymin < ymin: ymin = eymin
+        if exmax > xmax: xmax = exmax
+        if eymax > ymax: ymax = eymax
+    if xmin > xmax:
+        return None
+    return xmin, ymin, xmax, ymax
+
+def hilbert_keys(extents, bounds=None, order=HILBERT_ORDER):
+    """Hilbert index of the center of each extent, scaled to a grid spanning bounds (defaults to the extents' own)"""
+    extents = list(extents)
+    bounds = bounds or extent_of(extents)
+    if bounds is None:
+        return []
+
+    bxmin, bymin, bxmax, bymax = bounds
+    cells = float((1 << order) - 1) # extents may be integers, which mustn't divide down to a zero scale
+    sx = cells / (bxmax - bxmin) if bxmax > bxmin else 0.0
+    sy = cells / (bymax - bymin) if bymax > bymin else 0.0
+    return [hilbert_index(
+        int(((xmin + xmax) / 2.0 - bxmin) * sx),
+        int(((ymin + ymax) / 2.0 - bymin) * sy),
+        order) for xmin, ymin, xmax, ymax in extents]
+
+def hilbert_sort(items, extent, bounds=None, order=HILBERT_ORDER):
+    """Sort items along the Hilbert curve.  extent is a function returning an item's (xmin, ymin, xmax, ymax)"""
+    items = list(items)
+    keys = hilbert_keys((extent(item) for item in items), bounds, order)
+    return [item for _, item in sorted(zip(keys, items), key=lambda pair: pair[0])]
@@ -1,20 +1,120 @@
 from pyspatialite._spatialite import IntegrityError
+from itertools import islice, count
+from threading import local, Lock, RLock, BoundedSemaphore, Thread, current_thread, enumerate as threads
 import os
+import struct
+import time
 from pyspatialite import dbapi2 as db
+from ga_spatialnosql.hilbert import hilbert_sort
+from ga_spatialnosql.rtree import write_snapshot, best_first, expanded, ITEM, NODE
+from ga_spatialnosql.utils import chunk, relation_needs_intersection
+from ga_spatialnosql.coalesce import WriteCoalescer
+from ga_spatialnosql import app_settings as settings
+from logging import getLogger
+
+log = getLogger(__name__)
+
+class ConnectionPool(object):
+    """Connections to one index file.  Each thread reads through its own connection, in a read transaction that
+    sees a consistent snapshot of the database from its first read until its outermost cursor is done, and at most
+    readers threads read at once.  Writes all go through one connection, one transaction at a time.  The database is
+    put in WAL mode so that readers and the writer don't block one another."""
+
+    def __init__(self, path, readers=None, timeout=None):
+        self.path = path
+        self.timeout = settings.INDEX_BUSY_TIMEOUT if timeout is None else timeout
+        self._readers = BoundedSemaphore(readers or settings.INDEX_MAX_READERS)
+        self._write_lock = RLock()
+        self._local = local()
+        self._connections = {}
+        self._connections_lock = Lock()
+        self.writer = self._connect()
+        self.writer.execute('PRAGMA journal_mode=WAL')
+
+    def _connect(self, isolation_level=''):
+        # connections are only ever used by one thread at a time, but may be closed from another
+        return db.connect(self.path, timeout=self.timeout, check_same_thread=False, isolation_level=isolation_level)
+
+    def _reader(self):
+        conn = self._connect(isolation_level=None) # transactions are begun and ended explicitly, around snapshots
+        with self._connections_lock:
+            live = set(t.ident for t in threads())
+            for ident in [ident for ident in self._connections if ident not in live]:
+                self._connections.pop(ident).close() # the reader of a thread that has finished
+            self._connections[current_thread().ident] = conn
+        return conn
+
+    def acquire(self, editing=False):
+        local = self._local
+        if editing:
+            self._write_lock.acquire()
+            local.writing = getattr(local, 'writing', 0) + 1
+            return self.writer
+
+        if not getattr(local, 'reading', 0):
+            # threads holding the other read slots may be waiting for the write lock this thread holds
+            local.counted = not getattr(local, 'writing', 0)
+            if local.counted:
+                self._readers.acquire()
+            try:
+                if getattr(local, 'conn', None) is None:
+                    local.conn = self._reader()
+                local.conn.execute('BEGIN')
+            except:
+                if local.counted:
+                    self._readers.release()
+                raise
+            local.reading = 0
+        local.reading += 1
+        return local.conn
+
+    def release(self, editing=False):
+        local = self._local
+        if editing:
+            local.writing -= 1
+            self._write_lock.release()
+            return
+
+        local.reading -= 1
+        if not local.reading:
+            try:
+                local.conn.execute('COMMIT') # ends the snapshot
+            finally:
+                if local.counted:
+                    self._readers.release()
+
+    def writing(self):
+        """Whether this thread holds the write lock"""
+        return getattr(self._local, 'writing', 0) > 0
+
+    def close(self):
+        with self._connections_lock:
+            connections, self._connections = self._connections, {}
+        for conn in connections.values():
+            conn.close()
+        self.writer.close()
 
 class Transaction(object):
-    def __init__(self, db, editing=False):
-        self.db = db
+    def __init__(self, pool, editing=False):
+        self.pool = pool
         self.editing = editing
+        self.cursor = None
 
     def __enter__(self):
+        self.db = self.pool.acquire(self.editing)
         self.cursor = self.db.cursor()
         return self
 
     def __exit__(self, extype, ex, val):
-        if self.editing:
-            self.db.commit()
+        try:
+            if self.editing:
+                if extype is None:
+                    self.db.commit()
+                else:
+                    self.db.rollback()
             self.cursor.close()
+        finally:
+            self.pool.release(self.editing)
 
     def execute(self, *args, **kwargs):
         self.cursor.execute(*args, **kwargs)
@@ -36,52 +136,141 @@ class Transaction(object):
     def __iter__(self):
         for item in self.cursor:
             yield item
-        self.cursor.close()
 
-    def __del__(self):
-        self.cursor.close()
+class BulkLoad(object):
+    """Fast load mode for a GeoIndex.  While active, the R-tree triggers and the duplicate oid index are dropped,
+    SQLite runs without fsyncs, and incoming rows are sorted along a Hilbert curve batch by batch.  On exit the
+    R-tree is rebuilt from the table in a single pass and the original pragmas are restored.
 
-def _select_basic(function):
-    def selection(self, geom, srid=None):
-        if srid:
-            geom.srid = srid
-        elif not hasattr(geom, 'srid'):
-            geom.srid = self.srid
-        elif not geom.srid or geom.srid == -1:
-            geom.srid = self.srid
+    The pragmas are the writer connection's, which every other write to the index goes through too, group commits
+    included.  So the load holds the pool's write lock from start to finish, and nothing else is committed without
+    fsyncs: other threads' writes wait for the load to end."""
 
-        with self.cursor() as c:
-            c.execute('select oid from spatialindex_geometry where {function}(geom, GeomFromWkb(?, ?))'.format(function=function), (geom.wkb, geom.srid))
-            for item in c:
-                yield self._to_id(item[0])
+    def __init__(self, index, batch_size=50000):
+        self.index = index
+        self.batch_size = batch_size
+        self.rows = 0
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self.started = time.time()
+        self.index.pool.acquire(editing=True)
+        try:
+            # pragmas are per connection, and it's the writer's that matter
+            self.pragmas = dict((pragma, self.index.db.execute('PRAGMA ' + pragma).fetchone()[0]) for pragma in ('synchronous', 'journal_mode'))
+
+            self.index.db.execute('PRAGMA synchronous=OFF')
+            if self.pragmas['journal_mode'] != 'wal': # leaving WAL would need every reader connection closed
+                self.index.db.execute('PRAGMA journal_mode=MEMORY')
+            with self.index.transaction() as c:
+                c.execute("SELECT DisableSpatialIndex('spatialindex_geometry', 'geom')")
+                c.execute('DROP TABLE IF EXISTS idx_spatialindex_geometry_geom')
+                c.execute('DROP INDEX IF EXISTS forward_index')
+        except:
+            self._restore()
+            raise
+
+        self.index._bulk_load = self
+        return self
+
+    def _restore(self):
+        try:
+            for pragma in ('journal_mode', 'synchronous'):
+                if pragma in getattr(self, 'pragmas', {}):
+                    self.index.db.execute('PRAGMA {pragma}={value}'.format(pragma=pragma, value=self.pragmas[pragma]))
+        finally:
+            self.index.pool.release(editing=True)
+
+    def __exit__(self, extype, ex, val):
+        self.index._bulk_load = None
+        try:
+            with self.index.transaction() as c:
+                c.execute("SELECT CreateSpatialIndex('spatialindex_geometry', 'geom')")
+                c.execute("CREATE INDEX IF NOT EXISTS forward_index ON spatialindex_geometry (oid)")
+        finally:
+            self._restore()
+
+        self.seconds = time.time() - self.started
+        self.index.last_load = self.stats()
+        log.info('bulk loaded {rows} rows into {path} in {seconds:.1f}s ({rows_per_second:.0f} rows/sec)'.format(path=self.index.index_path, **self.index.last_load))
+
+    @property
+    def rows_per_second(self):
+        elapsed = self.seconds or (time.time() - self.started)
+        return self.rows / elapsed if elapsed else 0.0
+
+    def stats(self):
+        return {
+            'rows' : self.rows,
+            'seconds' : self.seconds,
+            'rows_per_second' : self.rows_per_second
+        }
+
+    def insert(self, oids_and_geoms):
+        index = self.index
+        for batch in chunk(oids_and_geoms, self.batch_size):
+            batch = hilbert_sort(batch, lambda (oid, geom): geom.extent)
+            with index.transaction() as c:
+                c.executemany('INSERT INTO spatialindex_geometry (oid, geom) VALUES (?,GeomFromWKB(?, ?))', ((index._from_id(oid), geom.wkb, index.srid) for oid, geom in batch))
+            self.rows += len(batch)
+
+# layout of the SQLite R-tree's node blobs: a depth (meaningful in the root only) and a cell count, followed by cells
+# of a rowid or child node number and the box as xmin, xmax, ymin, ymax
+RTREE_NODE_HEADER = struct.Struct('>HH')
+RTREE_CELL = struct.Struct('>q4f')
+
+# candidate filter against the R-tree.  SpatiaLite never consults the spatial index on its own, so every predicate
+# query first narrows rows to those whose MBR overlaps the query MBR and only then runs the exact GEOS predicate.
+MBR_FILTER = 'spatialindex_geometry.rowid in (select pkid from idx_spatialindex_geometry_geom where xmin <= ? and xmax >= ? and ymin <= ? and ymax >= ?)'
+
+# SQLite limits the number of bound parameters in a statement.  Candidate lists up to this size are bound inline and
+# larger ones are loaded into a temp table, so the candidate constraint is always part of the one predicate query.
+MAX_CANDIDATES_PER_QUERY = 500
+
+_temp_tables = count()
+
+# rows deleted lazily are tombstoned by rowid and hidden from every query until compaction purges them from the table
+# and the R-tree.  A trigger drops a row's tombstone whenever the row itself is deleted, so a tombstone never outlives
+# its row and can't hide a later row that reuses the rowid.
+LIVE = 'spatialindex_geometry.rowid not in (select row from tombstones)'
+
+def _select_basic(function, filtered=True):
+    def selection(self, geom, srid=None, candidates=None, rows=False, after=None, limit=None):
+        geom = self._with_srid(geom, srid)
+        return self._select('{function}(geom, GeomFromWkb(?, ?))'.format(function=function), (geom.wkb, geom.srid), geom, filtered, candidates=candidates, rows=rows, after=after, limit=limit)
 
     return selection
 
 def _select_relate(relation):
-    def selection(self, geom, srid=None):
-        if srid:
-            geom.srid = srid
-        elif not hasattr(geom, 'srid'):
-            geom.srid = self.srid
-        elif not geom.srid or geom.srid == -1:
-            geom.srid = self.srid
-
-        with self.cursor() as c:
-            c.execute('select oid from spatialindex_geometry where Relate(geom, GeomFromWkb(?, ?), ?)', (geom.wkb, geom.srid, relation))
-            for item in c:
-                yield self._to_id(item[0])
+    def selection(self, geom, srid=None, candidates=None, rows=False, after=None, limit=None):
+        return self.relate(relation, geom, srid, candidates, rows, after, limit)
 
     return selection
 
 
+def _unlink_database(path):
+    # a WAL database is three files, and a stale -wal beside a new database file of the same name would be replayed
+    # into it
+    for name in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(name):
+            os.unlink(name)
+
 class GeoIndex(object):
-    def __init__(self, path, name, from_id, to_id, srid=4326, clear=False, cardinality=2):
-        self.index_path = os.path.join(path, name + '.spatialite')
+    file_extension = '.spatialite'
+
+    def __init__(self, path, name, from_id, to_id, srid=4326, clear=False, cardinality=2, use_index=True, group_commit=None):
+        self.index_path = os.path.join(path, name + self.file_extension)
         self._from_id = from_id
         self._to_id = to_id
         self.srid = srid
         self.clear = clear
         self.cardinality=cardinality
+        self.use_index = use_index
+        self.last_load = None
+        self._bulk_load = None
+        self.group_commit = settings.GROUP_COMMIT if group_commit is None else group_commit
+        self._writer = None
+        self._compactor = None
 
         if clear:
             self.drop()
@@ -90,7 +279,8 @@ class GeoIndex(object):
 
     def open(self):
         new = not os.path.exists(self.index_path)
-        self.db = db.connect(self.index_path)
+        self.pool = ConnectionPool(self.index_path)
+        self.db = self.pool.writer
 
         if new:
             with self.transaction() as c:
@@ -100,93 +290,377 @@ class GeoIndex(object):
                 c.execute("SELECT CreateSpatialIndex('spatialindex_geometry', 'geom')")
                 c.execute("CREATE INDEX forward_index ON spatialindex_geometry (oid)")
 
+        with self.transaction() as c: # indices made before tombstones need the table too
+            c.execute('CREATE TABLE IF NOT EXISTS tombstones (row integer primary key)')
+            c.execute('CREATE TRIGGER IF NOT EXISTS tombstones_purged AFTER DELETE ON spatialindex_geometry BEGIN DELETE FROM tombstones WHERE row = old.rowid; END')
+
+        if self.group_commit:
+            self._writer = WriteCoalescer(self.pool)
+
     @property
     def bounds(self):
         with self.cursor() as c:
-            c.execute('''SELECT
-                MIN(idx.xmin) As bxmin,
-                MIN(idx.ymin) As bymin,
-                MAX(idx.xmax) As bxmax,
-                MAX(idx.ymax) As bymax
-            from spatialindex_geometry as t
-            INNER JOIN idx_spatialindex_geometry_geom as idx on t.rowid = idx.pkid''')
+            if self._rtree_ready():
+                c.execute('''SELECT
+                    MIN(idx.xmin) As bxmin,
+                    MIN(idx.ymin) As bymin,
+                    MAX(idx.xmax) As bxmax,
+                    MAX(idx.ymax) As bymax
+                from spatialindex_geometry
+                INNER JOIN idx_spatialindex_geometry_geom as idx on spatialindex_geometry.rowid = idx.pkid
+                where ''' + LIVE)
+            else: # no R-tree while a bulk load runs, so the extents are worked out from the geometries
+                c.execute('select MIN(MbrMinX(geom)), MIN(MbrMinY(geom)), MAX(MbrMaxX(geom)), MAX(MbrMaxY(geom)) from spatialindex_geometry where ' + LIVE)
             return c.fetchall()[0]
 
+    def envelopes(self, sample=None):
+        """(xmin, ymin, xmax, ymax) of live geometries, read straight from the R-tree, or from the geometries while a
+        bulk load has dropped it.  With sample, roughly that many evenly spread rows are returned instead of all of
+        them."""
+        step = max(1, self.count() // sample) if sample else 1
+        with self.cursor() as c: # the R-tree is looked for in the same read transaction it is read in
+            if self._rtree_ready():
+                c.execute('''select idx.xmin, idx.ymin, idx.xmax, idx.ymax from idx_spatialindex_geometry_geom as idx
+                    inner join spatialindex_geometry on spatialindex_geometry.rowid = idx.pkid
+                    where idx.pkid % ? = 0 and ''' + LIVE, (step,))
+            else:
+                c.execute('select MbrMinX(geom), MbrMinY(geom), MbrMaxX(geom), MbrMaxY(geom) from spatialindex_geometry where rowid % ? = 0 and ' + LIVE, (step,))
+            return c.fetchall()
 
     def close(self):
-        self.db.close()
+        if self._compactor:
+            self._compactor.join()
+        if self._writer:
+            self._writer.close()
+        self.pool.close()
+
+    def discard(self):
+        pass # every write is committed as it is made, so nothing is held back to throw away
+
+    def pinned(self):
+        """A context for the whole of a query that deals in row numbers.  Rowids are never renumbered, but a row can
+        be purged and its rowid handed to a new row, so the query reads from one snapshot of the index throughout."""
+        return self.cursor()
+
+    def row_epoch(self):
+        """Changes whenever row numbers stop meaning what they did.  Rowids only ever go to rows added after every
+        existing one, so a row number stays a good place to resume paging from."""
+        return ''
+
+    def export_snapshot(self, path=None):
+        """Write the whole index to a packed, read-only R-tree file for SnapshotGeoIndex readers to mmap"""
+        path = path or os.path.splitext(self.index_path)[0] + '.snapshot'
+        with self.cursor() as c:
+            c.execute('select oid, AsBinary(geom), MbrMinX(geom), MbrMinY(geom), MbrMaxX(geom), MbrMaxY(geom) from spatialindex_geometry where ' + LIVE)
+            write_snapshot(path, ((oid, wkb, (xmin, ymin, xmax, ymax)) for oid, wkb, xmin, ymin, xmax, ymax in c), self.srid)
+        return path
 
     def drop(self):
-        if os.path.exists(self.index_path):
-            os.unlink(self.index_path)
+        if hasattr(self, 'pool'): # not yet, when dropped by clear=True
+            self.close() # commit what's queued and let go of every connection before the files go
+        _unlink_database(self.index_path)
+
+    @classmethod
+    def destroy(cls, path, name):
+        """Delete the stored index called name, without opening it"""
+        _unlink_database(os.path.join(path, name + cls.file_extension))
 
     def __del__(self):
-        self.db.close()
+        if hasattr(self, 'pool'):
+            self.pool.close()
 
     def cursor(self):
-        transaction = Transaction(self.db)
-        return transaction
+        return Transaction(self.pool)
 
     def transaction(self):
-        return Transaction(self.db, editing=True)
+        return Transaction(self.pool, editing=True)
+
+    def _rtree_ready(self):
+        """Whether the R-tree can be used.  A bulk load, possibly by another process, drops it until the load ends."""
+        if not self.use_index:
+            return False
+        with self.cursor() as c:
+            c.execute("select 1 from sqlite_master where name = 'idx_spatialindex_geometry_geom'")
+            return c.fetchone() is not None
 
     def clear(self):
         with self.transaction() as c:
             c.execute('delete from spatialindex_geometry')
 
-    def bulk_insert(self, oids_and_geoms):
-        try:
-            with self.transaction() as c:
-                c.executemany('INSERT INTO spatialindex_geometry (oid, geom) VALUES (?,GeomFromWKB(?, ?))', ((self._from_id(oid), geom.wkb, self.srid) for oid, geom in oids_and_geoms))
-        except IntegrityError:
-            print [o for o,g  in oids_and_geoms]
-
-    def insert(self, oid, geom, srid=None):
+    def _with_srid(self, geom, srid=None):
         if srid:
             geom.srid = srid
         elif not hasattr(geom, 'srid'):
             geom.srid = self.srid
         elif not geom.srid or geom.srid == -1:
             geom.srid = self.srid
+        return geom
+
+    def _where(self, predicate, params, geom, filtered=True, extent=None):
+        """Build the where clause for an exact predicate, preceded by the R-tree candidate filter unless the
+        predicate can match geometries outside the query's MBR or the index has been switched off."""
+        params = list(params)
+        if not (filtered and self._rtree_ready()):
+            return predicate, params
+
+        xmin, ymin, xmax, ymax = extent or geom.extent
+        return MBR_FILTER + ' and ' + predicate, [xmax, xmin, ymax, ymin] + params
+
+    def _candidate_filter(self, column, keys):
+        """A where clause limiting column to keys, its parameters, and the temp table holding the keys if one was
+        needed"""
+        if len(keys) <= MAX_CANDIDATES_PER_QUERY:
+            return '{column} in ({marks})'.format(column=column, marks=','.join('?' * len(keys))), keys, None
+
+        # temp tables belong to a connection, so the keys go in through the same read connection the query uses
+        table = 'candidates_{n}'.format(n=next(_temp_tables))
+        with self.cursor() as c:
+            c.execute('create temp table {table} (key primary key)'.format(table=table))
+            c.executemany('insert or ignore into temp.{table} (key) values (?)'.format(table=table), ((key,) for key in keys))
+        return '{column} in (select key from temp.{table})'.format(column=column, table=table), [], table
+
+    def _drop_candidates(self, table):
+        if table:
+            with self.cursor() as c:
+                c.execute('drop table if exists temp.{table}'.format(table=table))
+
+    def _select(self, predicate, params, geom, filtered=True, extent=None, candidates=None, rows=False, after=None, limit=None):
+        """Yield the ids of rows matching an exact predicate, or their rowids if rows is set.  With candidates (ids,
+        or rowids if rows is set) only those rows are tested, instead of the ones the R-tree finds.  after and limit
+        page through the results in rowid order, in SQL, so a page costs the same however deep it is."""
+        column = 'rowid' if rows else 'oid'
+        table = None
+        if candidates is None:
+            where, params = self._where(predicate, params, geom, filtered, extent)
+        else:
+            keys = list(candidates) if rows else [self._from_id(oid) for oid in candidates]
+            if not keys:
+                return
+            where, keys, table = self._candidate_filter(column, keys)
+            where, params = where + ' and ' + predicate, keys + list(params)
+
+        where += ' and ' + LIVE
+        if after is not None:
+            where, params = where + ' and rowid > ?', params + [after]
+        if after is not None or limit:
+            where += ' order by rowid'
+        if limit:
+            where, params = where + ' limit ?', params + [limit]
 
-        with self.transaction() as c:
-            c.execute('insert into spatialindex_geometry (oid, geom) values (?, GeomFromWKB(?, ?))', (self._from_id(oid), geom.wkb, geom.srid))
+        try:
+            with self.cursor() as c:
+                c.execute('select {column} from spatialindex_geometry where {where}'.format(column=column, where=where), params)
+                for item in c:
+                    yield item[0] if rows else self._to_id(item[0])
+        finally:
+            self._drop_candidates(table)
+
+    def all_rows(self):
+        """Every rowid in the index.  Rowids are what the predicates return when called with rows=True"""
+        with self.cursor() as c:
+            c.execute('select rowid from spatialindex_geometry where {live} order by rowid'.format(live=LIVE))
+            return [row[0] for row in c]
+
+    def rows_of(self, oids):
+        keys = [self._from_id(oid) for oid in oids]
+        if not keys:
+            return []
+        where, keys, table = self._candidate_filter('oid', keys)
+        try:
+            with self.cursor() as c:
+                c.execute('select rowid from spatialindex_geometry where {where} and {live}'.format(where=where, live=LIVE), keys)
+                return [row[0] for row in c]
+        finally:
+            self._drop_candidates(table)
+
+    def ids_of(self, rows):
+        """Yield the ids of rowids given in increasing order, such as a Bitmap's"""
+        for group in chunk(rows, MAX_CANDIDATES_PER_QUERY):
+            with self.cursor() as c:
+                c.execute('select oid from spatialindex_geometry where rowid in ({marks}) order by rowid'.format(marks=','.join('?' * len(group))), group)
+                for item in c:
+                    yield self._to_id(item[0])
+
+    def bulk_load(self, batch_size=50000):
+        return BulkLoad(self, batch_size)
+
+    def bulk_insert(self, oids_and_geoms):
+        oids_and_geoms = list(oids_and_geoms)
+        self._purge_tombstoned([oid for oid, geom in oids_and_geoms])
+        if self._bulk_load:
+            return self._bulk_load.insert(oids_and_geoms)
+
+        with self.transaction() as c: # a duplicate oid rolls the whole batch back and raises IntegrityError
+            c.executemany('INSERT INTO spatialindex_geometry (oid, geom) VALUES (?,GeomFromWKB(?, ?))', ((self._from_id(oid), geom.wkb, self.srid) for oid, geom in oids_and_geoms))
+
+    def _write(self, statement, params):
+        """Run a single-row write, through group commit unless it's off or a bulk load is running.  A thread already
+        in a write transaction writes in it, since the group it would join can't commit until that transaction ends."""
+        if self._writer and not self._bulk_load and not self.pool.writing():
+            self._writer.write(statement, params)
+        else:
+            with self.transaction() as c:
+                c.execute(statement, params)
+
+    def insert(self, oid, geom, srid=None):
+        geom = self._with_srid(geom, srid)
+        statement = 'insert into spatialindex_geometry (oid, geom) values (?, GeomFromWKB(?, ?))'
+        try:
+            self._write(statement, (self._from_id(oid), geom.wkb, geom.srid))
+        except IntegrityError:
+            if not self._purge_tombstoned([oid]): # a tombstoned id can be reused once its old row is gone
+                raise
+            self._write(statement, (self._from_id(oid), geom.wkb, geom.srid))
 
     def exists(self, oid):
         oid = self._from_id(oid)
         with self.cursor() as c:
-            c.execute('select oid from spatialindex_geometry where oid = ?', (oid,))
-            return c.cursor.arraysize > 0
+            c.execute('select oid from spatialindex_geometry where oid = ? and ' + LIVE, (oid,))
+            return c.fetchone() is not None
 
     def delete(self, oid):
-        with self.transaction() as c:
-            c.execute('delete from spatialindex_geometry where oid=?', (self._from_id(oid),))
+        self._write('delete from spatialindex_geometry where oid=?', (self._from_id(oid),))
 
     def bulk_delete(self, oids):
         with self.transaction() as c:
             c.executemany('delete from spatialindex_geometry where oid=?', ((self._from_id(oid),) for oid in oids))
 
-    def count(self, geom=None):
+    def tombstone(self, oids):
+        """Delete lazily: hide the rows of oids from queries now, in one transaction, and leave purging them from the
+        table and the R-tree to compaction"""
+        with self.transaction() as c:
+            c.executemany('insert or ignore into tombstones (row) select rowid from spatialindex_geometry where oid = ?', ((self._from_id(oid),) for oid in oids))
+        self._maybe_compact()
+
+    def delete_region(self, geom, srid=None):
+        """Tombstone every row whose geometry intersects geom, without the rows ever leaving the index, and return
+        their ids"""
+        geom = self._with_srid(geom, srid)
+        where, params = self._where('Intersects(geom, GeomFromWkb(?, ?))', (geom.wkb, geom.srid), geom)
+        with self.transaction() as c:
+            c.execute('select rowid, oid from spatialindex_geometry where {where} and {live}'.format(where=where, live=LIVE), params)
+            found = c.fetchall()
+            c.executemany('insert or ignore into tombstones (row) values (?)', ((row,) for row, oid in found))
+        self._maybe_compact()
+        return [self._to_id(oid) for row, oid in found]
+
+    def tombstones(self):
+        with self.cursor() as c:
+            c.execute('select count(*) from tombstones')
+            return c.fetchone()[0]
+
+    def compact(self, batch_size=None):
+        """Purge tombstoned rows from the table and the R-tree, a transaction of batch_size rows at a time so writers
+        are never held up for long.  Returns the number of rows purged."""
+        batch_size = batch_size or settings.TOMBSTONE_COMPACT_BATCH
+        purged = 0
+        while True:
+            with self.transaction() as c:
+                c.execute('delete from spatialindex_geometry where rowid in (select row from tombstones order by row limit ?)', (batch_size,))
+                rows = c.cursor.rowcount
+            if rows <= 0:
+                break
+            purged += rows
+        if purged:
+            log.info('compacted {n} tombstoned rows out of {path}'.format(n=purged, path=self.index_path))
+        return purged
+
+    def _maybe_compact(self):
+        if self._compactor and self._compactor.is_alive():
+            return
+        if self.tombstones() >= settings.TOMBSTONE_COMPACT_THRESHOLD:
+            self._compactor = Thread(target=self.compact, name='compaction of ' + self.index_path)
+            self._compactor.daemon = True
+            self._compactor.start()
+
+    def _purge_tombstoned(self, oids):
+        """Delete tombstoned rows under any of oids now, so the ids can be indexed again.  The number purged."""
+        with self.cursor() as c:
+            if c.execute('select 1 from tombstones limit 1').fetchone() is None:
+                return 0
+        with self.transaction() as c:
+            c.executemany('delete from spatialindex_geometry where oid = ? and rowid in (select row from tombstones)', ((self._from_id(oid),) for oid in oids))
+            return c.cursor.rowcount
+
+    def bulk_upsert(self, oids_and_geoms):
+        """Insert geometries, replacing any already indexed under their oids, in one transaction"""
+        oids_and_geoms = list(oids_and_geoms)
+        # a delete and insert rather than INSERT OR REPLACE, whose implicit delete skips SpatiaLite's R-tree triggers
+        with self.transaction() as c:
+            c.executemany('delete from spatialindex_geometry where oid=?', ((self._from_id(oid),) for oid, geom in oids_and_geoms))
+            c.executemany('INSERT INTO spatialindex_geometry (oid, geom) VALUES (?,GeomFromWKB(?, ?))', ((self._from_id(oid), geom.wkb, self.srid) for oid, geom in oids_and_geoms))
+
+    def count(self, geom=None, srid=None):
         with self.cursor() as c:
             if geom is None:
-                c.execute('select count(oid) from spatialindex_geometry')
+                c.execute('select count(oid) from spatialindex_geometry where ' + LIVE)
                 return c.fetchone()[0]
             else:
-                c.execute('select count(oid) from spatialindex_geometry where Within(geom, GeomFromWkb(?, ?))', (geom.wkb, geom.srid))
+                geom = self._with_srid(geom, srid)
+                where, params = self._where('Within(geom, GeomFromWkb(?, ?))', (geom.wkb, geom.srid), geom)
+                c.execute('select count(oid) from spatialindex_geometry where {where} and {live}'.format(where=where, live=LIVE), params)
                 return c.fetchone()[0]
 
-    def relate(self, relation, geom, srid=None):
-        if srid:
-            geom.srid = srid
-        elif not hasattr(geom, 'srid'):
-            geom.srid = self.srid
-        elif not geom.srid or geom.srid == -1:
-            geom.srid = self.srid
+    def relate(self, relation, geom, srid=None, candidates=None, rows=False, after=None, limit=None):
+        geom = self._with_srid(geom, srid)
+        return self._select('Relate(geom, GeomFromWkb(?, ?), ?)', (geom.wkb, geom.srid, relation), geom, relation_needs_intersection(relation), candidates=candidates, rows=rows, after=after, limit=limit)
+
+    def dwithin(self, geom, distance, srid=None, candidates=None, rows=False, after=None, limit=None):
+        """Stored geometries within distance of geom.  The R-tree is searched with the query's envelope grown by
+        distance, so no buffer geometry is ever built."""
+        geom = self._with_srid(geom, srid)
+        return self._select('Distance(geom, GeomFromWkb(?, ?)) <= ?', (geom.wkb, geom.srid, distance), geom, extent=expanded(geom.extent, distance), candidates=candidates, rows=rows, after=after, limit=limit)
+
+    def _rtree_node(self, nodeno, depth):
+        with self.cursor() as c:
+            c.execute('select data from idx_spatialindex_geometry_geom_node where nodeno = ?', (nodeno,))
+            row = c.fetchone()
+        if row is None:
+            return []
+
+        data = str(row[0])
+        _, cells = RTREE_NODE_HEADER.unpack_from(data, 0)
+        entries = []
+        for i in xrange(cells):
+            ref, xmin, xmax, ymin, ymax = RTREE_CELL.unpack_from(data, RTREE_NODE_HEADER.size + i * RTREE_CELL.size)
+            entries.append(((xmin, ymin, xmax, ymax), ITEM, ref) if depth == 0 else ((xmin, ymin, xmax, ymax), NODE, (ref, depth - 1)))
+        return entries
+
+    def _nearest(self, geom):
+        if not self._rtree_ready():
+            with self.cursor() as c:
+                c.execute('select oid, Distance(geom, GeomFromWkb(?, ?)) as d from spatialindex_geometry where {live} order by d'.format(live=LIVE), (geom.wkb, geom.srid))
+                for oid, d in c:
+                    yield oid, d
+            return
 
         with self.cursor() as c:
-            c.execute('select oid from spatialindex_geometry where Relate(geom, GeomFromWkb(?, ?), ?)', (geom, geom.srid, relation))
-            for item in c:
-                yield self._to_id(item)
+            c.execute('select data from idx_spatialindex_geometry_geom_node where nodeno = 1')
+            root = c.fetchone()
+        if root is None:
+            return
+        depth, = struct.unpack_from('>H', str(root[0]), 0)
+
+        oids = {}
+        def distance(rowid):
+            with self.cursor() as c:
+                c.execute('select oid, Distance(geom, GeomFromWkb(?, ?)) from spatialindex_geometry where rowid = ? and ' + LIVE, (geom.wkb, geom.srid, rowid))
+                row = c.fetchone()
+            if row is None:
+                return None
+            oids[rowid] = row[0]
+            return row[1]
+
+        for rowid, d in best_first(geom.extent, [(geom.extent, NODE, (1, depth))], lambda (nodeno, depth): self._rtree_node(nodeno, depth), distance):
+            yield oids.pop(rowid), d
+
+    def nearest(self, geom, k=None, srid=None, with_distance=False):
+        """The k stored geometries nearest to geom (all of them if k is None), nearest first.  Walks the R-tree
+        best-first, ordered by box distance, and refines each candidate to its exact distance before returning it."""
+        geom = self._with_srid(geom, srid)
+        results = self._nearest(geom)
+        for oid, d in (islice(results, k) if k else results):
+            yield (self._to_id(oid), d) if with_distance else self._to_id(oid)
 
     bbcontains = _select_basic("mbrcontains")
     bboverlaps = _select_basic('mbroverlaps')
@@ -197,7 +671,7 @@ class GeoIndex(object):
     coveredby = _select_basic('coveredby')
     covers = _select_basic('covers')
     crosses = _select_basic('crosses')
-    disjoint = _select_basic('disjoint')
+    disjoint = _select_basic('disjoint', filtered=False)
     equals = _select_basic('equals')
     exact =  _select_basic('exact')
     intersects = _select_basic('intersects')
@@ -0,0 +1,193 @@
+__author__ = 'jeff'
+
+from ga_spatialnosql import app_settings as settings
+from ga_spatialnosql.utils import chunk
+from threading import Thread, Event
+from Queue import Queue, Full
+from logging import getLogger
+import json
+import re
+import time
+
+log = getLogger(__name__)
+
+# Streaming ingest of GeoJSON too large to hold in memory.  FeatureReader parses a FeatureCollection, or a GeoJSONSeq
+# of features separated by newlines or record separators, one feature at a time from a file-like object, so only the
+# feature being parsed and the unread part of the last chunk are held.  ingest() parses on a producer thread and hands
+# bounded batches to the calling thread over a queue that holds at most a few of them, so a slow database holds the
+# parser back rather than letting parsed features pile up.
+
+_WHITESPACE = re.compile(r'[ \t\n\r\x1e]*')
+
+class FeatureReader(object):
+    """Iterates over the features in a GeoJSON stream.  Members of a FeatureCollection other than its features are
+    collected in properties as they are passed; a crs has to come before the features to apply to them."""
+
+    def __init__(self, stream, read_size=None):
+        self.stream = stream
+        self.read_size = read_size or settings.INGEST_READ_SIZE
+        self.properties = {}
+        self._consumed = 0
+        self._buffer = ''
+        self._offset = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    @property
+    def position(self):
+        """Bytes of the stream parsed so far"""
+        return self._consumed + self._offset
+
+    def _read(self, size):
+        data = self.stream.read(size)
+        if not data:
+            self._eof = True
+            return False
+        if self._offset:
+            self._consumed += self._offset
+            self._buffer = self._buffer[self._offset:]
+            self._offset = 0
+        self._buffer += data
+        return True
+
+    def _peek(self):
+        """The next character that isn't whitespace or a record separator, or None at the end of the stream"""
+        while True:
+            self._offset = _WHITESPACE.match(self._buffer, self._offset).end()
+            if self._offset < len(self._buffer):
+                return self._buffer[self._offset]
+            if not self._read(self.read_size):
+                return None
+
+    def _expect(self, character):
+        if self._peek() != character:
+            raise ValueError('expected {c!r} at byte {p}'.format(c=character, p=self.position))
+        self._offset += 1
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._offset)
+                # a number can end at the end of the buffer without ending in the stream
+                if end < len(self._buffer) or self._eof:
+                    self._offset = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            # read at least as much again as is pending, so a large value is reparsed only a few times
+            self._read(max(self.read_size, len(self._buffer) - self._offset))
+
+    def _array(self):
+        self._expect('[')
+        if self._peek() == ']':
+            self._offset += 1
+            return
+        while True:
+            yield self._value()
+            if self._peek() == ',':
+                self._offset += 1
+            else:
+                self._expect(']')
+                return
+
+    def _object(self):
+        """Members of a top level object, streaming a features array rather than decoding it"""
+        self._expect('{')
+        members = {}
+        while self._peek() != '}':
+            if members:
+                self._expect(',')
+            key = self._value()
+            self._expect(':')
+            if key == 'features' and self._peek() == '[':
+                self.properties.update(members) # so a crs is known before the features it applies to
+                for feature in self._array():
+                    yield feature
+                members[key] = None
+            else:
+                members[key] = self._value()
+        self._offset += 1
+
+        if members.get('type') == 'Feature':
+            yield members
+        else:
+            self.properties.update((key, value) for key, value in members.items() if key != 'features')
+
+    def __iter__(self):
+        while self._peek() is not None:
+            for feature in self._object():
+                yield feature
+
+def _produce(reader, batch_size, queue, stopped):
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    try:
+        for batch in chunk(reader, batch_size):
+            if stopped.is_set(): # nobody is reading any more, so there's no point parsing the rest of the stream
+                return
+            put((batch, reader.properties.get('crs'), reader.position))
+    except Exception as e:
+        log.exception('failed to parse features')
+        put(e)
+    put(None)
+
+def ingest(collection, stream, batch_size=None, queue_batches=None, bulk_load=False, progress=None):
+    """Insert the features in a GeoJSON stream, or the file named by stream, into a GeoJSONCollection in batches
+    of batch_size.  progress, if given, is called with the running statistics after every batch, and the final
+    statistics are returned.  A FeatureCollection's own properties are added to the collection's at the end."""
+    if isinstance(stream, basestring):
+        with open(stream, 'rb') as f:
+            return ingest(collection, f, batch_size, queue_batches, bulk_load, progress)
+
+    if bulk_load:
+        with collection.index.bulk_load():
+            return ingest(collection, stream, batch_size, queue_batches, False, progress)
+
+    reader = FeatureReader(stream)
+    queue = Queue(queue_batches or settings.INGEST_QUEUE_BATCHES)
+    stopped = Event()
+    producer = Thread(target=_produce, args=(reader, batch_size or settings.INGEST_BATCH_SIZE, queue, stopped))
+    producer.daemon = True
+    producer.start()
+
+    started = time.time()
+    stats = {'features' : 0, 'batches' : 0, 'bytes' : 0, 'seconds' : 0.0, 'features_per_second' : 0.0}
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            features, crs, position = item
+            fc = {'type' : 'FeatureCollection', 'features' : features}
+            if crs is not None:
+                fc['crs'] = crs
+            collection.insert_features(fc)
+
+            stats['features'] += len(features)
+            stats['batches'] += 1
+            stats['bytes'] = position
+            stats['seconds'] = time.time() - started
+            stats['features_per_second'] = stats['features'] / stats['seconds'] if stats['seconds'] else 0.0
+            if progress:
+                progress(dict(stats))
+    finally:
+        stopped.set()
+
+    with collection.metadata_batch():
+        for key, value in reader.properties.items():
+            if key not in ('type', 'crs', 'features', 'bbox') and key not in collection:
+                collection[key] = value
+
+    log.info('ingested {features} features in {batches} batches ({features_per_second:.0f} features/sec)'.format(**stats))
+    return stats
@@ -0,0 +1,154 @@
+__author__ = 'jeff'
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.gis.geos import GEOSGeometry, Polygon
+from ga_spatialnosql.index import GeoIndex
+from ga_spatialnosql.wkb import geojson_to_wkb
+from optparse import make_option
+from tempfile import mkdtemp
+from threading import Thread
+import json
+import math
+import random
+import shutil
+import time
+
+def _box(x, y, size):
+    return Polygon(((x, y), (x, y + size), (x + size, y + size), (x + size, y), (x, y)))
+
+def _random_boxes(n, extent=1000.0, size=1.0):
+    return [(i, _box(random.uniform(0, extent - size), random.uniform(0, extent - size), size)) for i in xrange(n)]
+
+def _random_rings(n, vertices, extent=1000.0, radius=1.0):
+    """GeoJSON polygons, each a circle of vertices points"""
+    rings = []
+    for i in xrange(n):
+        x, y = random.uniform(radius, extent - radius), random.uniform(radius, extent - radius)
+        ring = [[x + radius * math.cos(2 * math.pi * k / vertices), y + radius * math.sin(2 * math.pi * k / vertices)] for k in xrange(vertices)]
+        rings.append({'type' : 'Polygon', 'coordinates' : [ring + ring[:1]]})
+    return rings
+
+def _timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return time.time() - start, result
+
+class Command(BaseCommand):
+    args = '<benchmark>'
+    help = 'Run a GeoIndex benchmark against synthetic data.  Available benchmarks: index, load, encode, commit'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', dest='sizes', default='1000,10000,100000', help='comma separated collection sizes'),
+        make_option('--queries', dest='queries', type='int', default=50, help='number of queries per size'),
+        make_option('--window', dest='window', type='float', default=50.0, help='query window edge length'),
+        make_option('--threads', dest='threads', type='int', default=16, help='concurrent writers for the commit benchmark'),
+        make_option('--vertices', dest='vertices', type='int', default=64, help='vertices per polygon for the encode benchmark'),
+        make_option('--seed', dest='seed', type='int', default=0),
+    )
+
+    def handle(self, *args, **options):
+        benchmark = args[0] if args else 'index'
+        if not hasattr(self, 'bench_' + benchmark):
+            raise CommandError('unknown benchmark {b}'.format(b=benchmark))
+
+        random.seed(options['seed'])
+        path = mkdtemp()
+        try:
+            getattr(self, 'bench_' + benchmark)(path, **options)
+        finally:
+            shutil.rmtree(path)
+
+    def bench_index(self, path, sizes, queries, window, **options):
+        """Compare full-scan predicate evaluation with the two-phase R-tree path as the collection grows."""
+        self.stdout.write('{0:>10} {1:>12} {2:>12} {3:>12} {4:>8}\n'.format('rows', 'operator', 'scan ms', 'indexed ms', 'speedup'))
+        for size in (int(s) for s in sizes.split(',')):
+            ix = GeoIndex(path, 'bench_{size}'.format(size=size), int, int, clear=True)
+            ix.bulk_insert(_random_boxes(size))
+            windows = [_box(random.uniform(0, 1000.0 - window), random.uniform(0, 1000.0 - window), window) for _ in xrange(queries)]
+
+            for operator in ('within', 'intersects', 'count'):
+                timings = []
+                for use_index in (False, True):
+                    ix.use_index = use_index
+                    if operator == 'count':
+                        run = lambda: [ix.count(w) for w in windows]
+                    else:
+                        run = lambda: [list(getattr(ix, operator)(w)) for w in windows]
+                    elapsed, _ = _timed(run)
+                    timings.append(elapsed * 1000.0 / queries)
+
+                self.stdout.write('{0:>10} {1:>12} {2:>12.3f} {3:>12.3f} {4:>7.1f}x\n'.format(
+                    size, operator, timings[0], timings[1], timings[0] / timings[1] if timings[1] else 0))
+
+            ix.close()
+            ix.drop()
+
+    def bench_load(self, path, sizes, **options):
+        """Compare ingest throughput of plain bulk_insert with bulk-load mode"""
+        self.stdout.write('{0:>10} {1:>16} {2:>16} {3:>8}\n'.format('rows', 'insert rows/s', 'bulk rows/s', 'speedup'))
+        for size in (int(s) for s in sizes.split(',')):
+            rows = _random_boxes(size)
+
+            ix = GeoIndex(path, 'bench_insert_{size}'.format(size=size), int, int, clear=True)
+            elapsed, _ = _timed(ix.bulk_insert, rows)
+            plain = size / elapsed if elapsed else 0
+            ix.close()
+            ix.drop()
+
+            ix = GeoIndex(path, 'bench_load_{size}'.format(size=size), int, int, clear=True)
+            with ix.bulk_load() as loader:
+                loader.insert(rows)
+            bulk = ix.last_load['rows_per_second']
+            ix.close()
+            ix.drop()
+
+            self.stdout.write('{0:>10} {1:>16.0f} {2:>16.0f} {3:>7.1f}x\n'.format(size, plain, bulk, bulk / plain if plain else 0))
+
+    def bench_encode(self, path, sizes, vertices, **options):
+        """Compare the cost of getting WKB and an envelope for GeoJSON features through json.dumps and GEOS with
+        encoding them directly"""
+        self.stdout.write('{0:>10} {1:>20} {2:>20} {3:>8}\n'.format('features', 'geos ms/M vertices', 'direct ms/M vertices', 'speedup'))
+        for size in (int(s) for s in sizes.split(',')):
+            geometries = _random_rings(size, vertices)
+            millions = size * (vertices + 1) / 1e6
+
+            def through_geos():
+                for g in geometries:
+                    geom = GEOSGeometry(json.dumps(g))
+                    geom.wkb, geom.extent
+
+            def direct():
+                for g in geometries:
+                    geojson_to_wkb(g)
+
+            geos, _ = _timed(through_geos)
+            encoded, _ = _timed(direct)
+            self.stdout.write('{0:>10} {1:>20.1f} {2:>20.1f} {3:>7.1f}x\n'.format(
+                size, geos * 1000.0 / millions, encoded * 1000.0 / millions, geos / encoded if encoded else 0))
+
+    def bench_commit(self, path, sizes, threads, **options):
+        """Compare single-row insert throughput from concurrent writers with and without group commit"""
+        self.stdout.write('{0:>10} {1:>8} {2:>16} {3:>16} {4:>8}\n'.format('rows', 'threads', 'plain rows/s', 'grouped rows/s', 'speedup'))
+        for size in (int(s) for s in sizes.split(',')):
+            rows = _random_boxes(size)
+            rates = []
+            for group_commit in (False, True):
+                name = 'bench_commit_{size}_{g}'.format(size=size, g=int(group_commit))
+                ix = GeoIndex(path, name, int, int, clear=True, group_commit=group_commit)
+
+                def write(part):
+                    for oid, geom in part:
+                        ix.insert(oid, geom)
+
+                writers = [Thread(target=write, args=(rows[i::threads],)) for i in range(threads)]
+                start = time.time()
+                for w in writers:
+                    w.start()
+                for w in writers:
+                    w.join()
+                elapsed = time.time() - start
+                rates.append(size / elapsed if elapsed else 0)
+                ix.close()
+                ix.drop()
+
+            self.stdout.write('{0:>10} {1:>8} {2:>16.0f} {3:>16.0f} {4:>7.1f}x\n'.format(size, threads, rates[0], rates[1], rates[1] / rates[0] if rates[0] else 0))
@@ -0,0 +1,490 @@
+__author__ = 'jeff'
+
+from array import array
+from itertools import islice
+from django.contrib.gis.geos import GEOSGeometry
+from ga_spatialnosql.rtree import PackedRTree, box_distance, expanded
+from ga_spatialnosql.hilbert import extent_of
+from ga_spatialnosql.utils import relation_needs_intersection, NullContext
+from logging import getLogger
+from threading import Lock, RLock
+from functools import wraps
+import cPickle
+import fcntl
+import os
+import time
+
+log = getLogger(__name__)
+
+# exact predicates, called as test(query, prepared query, stored geometry) and read as "stored <predicate> query",
+# matching the argument order GeoIndex passes to SpatiaLite.  Where GEOS offers a prepared form of the predicate in the
+# needed direction it is used, since the query geometry is tested against every candidate.
+
+_COVERS_PATTERNS = ('T*****FF*', '*T****FF*', '***T**FF*', '****T*FF*')
+
+def _covers(a, b):
+    return any(a.relate_pattern(b, pattern) for pattern in _COVERS_PATTERNS)
+
+PREDICATES = {
+    'within' : lambda q, p, s: p.contains(s),
+    'contained' : lambda q, p, s: p.contains(s),
+    'coveredby' : lambda q, p, s: p.covers(s),
+    'intersects' : lambda q, p, s: p.intersects(s),
+    'disjoint' : lambda q, p, s: not p.intersects(s),
+    'contains' : lambda q, p, s: s.contains(q),
+    'containsproperly' : lambda q, p, s: s.relate_pattern(q, 'T**FF*FF*'),
+    'covers' : lambda q, p, s: _covers(s, q),
+    'crosses' : lambda q, p, s: s.crosses(q),
+    'overlaps' : lambda q, p, s: s.overlaps(q),
+    'touches' : lambda q, p, s: s.touches(q),
+    'equals' : lambda q, p, s: s.equals(q),
+    'exact' : lambda q, p, s: s.equals_exact(q),
+}
+
+# predicates that only need the envelopes.  e is the stored extent, qe the query's
+ENVELOPE_PREDICATES = {
+    'mbrcontains' : lambda qe, e: e[0] <= qe[0] and e[1] <= qe[1] and e[2] >= qe[2] and e[3] >= qe[3],
+    'mbroverlaps' : lambda qe, e: e[0] <= qe[2] and e[1] <= qe[3] and e[2] >= qe[0] and e[3] >= qe[1],
+}
+
+def _select_basic(function, filtered=True):
+    def selection(self, geom, srid=None, candidates=None, rows=False, after=None, limit=None):
+        geom = self._with_srid(geom, srid)
+        slots = self._select(function, geom, filtered, candidates=candidates, rows=rows, after=after, limit=limit)
+        return slots if rows else self.ids_of(slots)
+
+    return selection
+
+# An index file is used by one process at a time, since each process would otherwise write its own copy of the index
+# over the others'.  The first index opened on a file takes an exclusive lock on it for the process; other indices in
+# the same process share that lock, and an index in another process can't be opened until it is released.
+_file_locks = {}
+_file_locks_lock = Lock()
+
+def _lock_file(path):
+    with _file_locks_lock:
+        if path in _file_locks:
+            f, users = _file_locks[path]
+            _file_locks[path] = (f, users + 1)
+            return
+        f = open(path + '.lock', 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            raise IOError('{path} is open in another process; a memory index can only be used by one'.format(path=path))
+        _file_locks[path] = (f, 1)
+
+def _unlock_file(path):
+    with _file_locks_lock:
+        f, users = _file_locks.pop(path)
+        if users > 1:
+            _file_locks[path] = (f, users - 1)
+        else:
+            f.close() # which releases the lock
+
+def _writes(method):
+    # a write is on disk by the time it returns, unless it is part of a bulk load, which writes the index when it ends
+    @wraps(method)
+    def write(self, *args, **kwargs):
+        with self._lock:
+            result = method(self, *args, **kwargs)
+            if not self._loading:
+                self.flush()
+            return result
+    return write
+
+class _MemoryBulkLoad(object):
+    def __init__(self, index, batch_size=50000):
+        self.index = index
+        self.batch_size = batch_size
+        self.rows = 0
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self.started = time.time()
+        with self.index._lock:
+            self.index._loading += 1
+        return self
+
+    def __exit__(self, extype, ex, val):
+        with self.index._lock:
+            self.index._loading -= 1
+            self.index._rebuild()
+            if not self.index._loading:
+                self.index.flush()
+        self.seconds = time.time() - self.started
+        self.index.last_load = self.stats()
+
+    @property
+    def rows_per_second(self):
+        elapsed = self.seconds or (time.time() - self.started)
+        return self.rows / elapsed if elapsed else 0.0
+
+    def stats(self):
+        return {
+            'rows' : self.rows,
+            'seconds' : self.seconds,
+            'rows_per_second' : self.rows_per_second
+        }
+
+    def insert(self, oids_and_geoms):
+        with self.index._lock:
+            for oid, geom in oids_and_geoms:
+                self.index._add(oid, geom)
+                self.rows += 1
+
+class MemoryGeoIndex(object):
+    """GeoIndex backend that keeps everything in process.  Envelopes live in a flat array indexed by a packed
+    Hilbert R-tree, exact predicates run against prepared GEOS geometries, and the whole index is pickled to
+    disk after every write.  Rows added since the tree was last packed are kept in a short pending list
+    that is scanned linearly until it is large enough to be worth repacking.
+
+    Rows are slots, which keep their numbers on disk too, emptied slots included, so page tokens outlive the
+    process.  Only compact() renumbers them, and it changes the row epoch stored with the file when it does.  An
+    index file can only be open in one process at a time (see _lock_file).  Writes, and repacking the tree, hold
+    the index's lock; reads don't need it."""
+
+    file_extension = '.rtree'
+    min_pending = 1024
+
+    def __init__(self, path, name, from_id, to_id, srid=4326, clear=False, cardinality=2, use_index=True):
+        self.index_path = os.path.join(path, name + self.file_extension)
+        self._from_id = from_id
+        self._to_id = to_id
+        self.srid = srid
+        self.cardinality = cardinality
+        self.use_index = use_index
+        self.last_load = None
+        self._discarded = False
+        self._locked = False
+        self._loading = 0
+        self._lock = RLock()
+
+        if clear:
+            self.drop()
+
+        self.open()
+
+    def open(self):
+        with self._lock:
+            if not self._locked:
+                _lock_file(self.index_path)
+                self._locked = True
+
+            self._oids = []
+            self._geoms = []
+            self._extents = array('d')
+            self._slots = {}
+            self._dirty = False
+            self._epoch = None
+
+            if os.path.exists(self.index_path):
+                with open(self.index_path, 'rb') as f:
+                    saved = cPickle.load(f)
+                self._oids = saved['oids']
+                self._geoms = saved['wkbs']
+                self._extents.fromstring(saved['extents'])
+                self._slots = dict((oid, slot) for slot, oid in enumerate(self._oids) if oid is not None)
+                self._epoch = saved.get('epoch')
+
+            if self._epoch is None: # a new file, or one written before slots were kept on disk
+                self._epoch = os.urandom(6).encode('hex')
+                self._dirty = True
+
+            self._rebuild()
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty or self._discarded:
+                return
+
+            tmp = self.index_path + '.tmp'
+            with open(tmp, 'wb') as f:
+                cPickle.dump({
+                    'srid' : self.srid,
+                    'epoch' : self._epoch,
+                    'oids' : self._oids,
+                    'wkbs' : [self._wkb(slot) if oid is not None else None for slot, oid in enumerate(self._oids)],
+                    'extents' : self._extents.tostring(),
+                }, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.index_path)
+            self._dirty = False
+            log.debug('wrote {n} rows to {path}'.format(n=len(self._slots), path=self.index_path))
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            if self._locked:
+                _unlock_file(self.index_path)
+                self._locked = False
+
+    def pinned(self):
+        return NullContext() # slots stay put while the index is open
+
+    def row_epoch(self):
+        return self._epoch # kept in the file, so it's the same in every process that opens it, until compact()
+
+    def discard(self):
+        """Never write this index to disk again.  For an index whose collection has been dropped or recreated, whose
+        rows would otherwise be flushed over the new collection's index when it is closed or collected."""
+        self._discarded = True
+        self._dirty = False
+
+    def drop(self):
+        with self._lock:
+            self._dirty = False
+            if self._locked:
+                _unlock_file(self.index_path)
+                self._locked = False
+            for path in (self.index_path, self.index_path + '.lock'):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    @classmethod
+    def destroy(cls, path, name):
+        """Delete the stored index called name, without opening it"""
+        index_path = os.path.join(path, name + cls.file_extension)
+        for p in (index_path, index_path + '.lock'):
+            if os.path.exists(p):
+                os.unlink(p)
+
+    def __del__(self):
+        if getattr(self, '_locked', False):
+            self.close()
+
+    @_writes
+    def clear(self):
+        self._oids = []
+        self._geoms = []
+        self._extents = array('d')
+        self._slots = {}
+        self._epoch = os.urandom(6).encode('hex')
+        self._dirty = True
+        self._rebuild()
+
+    @property
+    def bounds(self):
+        return extent_of(self._extents[slot * 4:slot * 4 + 4] for slot, oid in enumerate(self._oids) if oid is not None)
+
+    def envelopes(self, sample=None):
+        live = [slot for slot, oid in enumerate(self._oids) if oid is not None]
+        step = max(1, len(live) // sample) if sample else 1
+        return [self._extent(slot) for slot in live[::step]]
+
+    def _with_srid(self, geom, srid=None):
+        if srid:
+            geom.srid = srid
+        elif not hasattr(geom, 'srid'):
+            geom.srid = self.srid
+        elif not geom.srid or geom.srid == -1:
+            geom.srid = self.srid
+        return geom
+
+    def _wkb(self, slot):
+        geom = self._geoms[slot]
+        return geom if isinstance(geom, str) else str(geom.wkb)
+
+    def _geometry(self, slot):
+        geom = self._geoms[slot]
+        if not isinstance(geom, GEOSGeometry):
+            # stored WKB, or a WKBGeometry straight from ingest
+            geom = self._geoms[slot] = GEOSGeometry(buffer(self._wkb(slot)), srid=self.srid)
+        return geom
+
+    def _extent(self, slot):
+        return self._extents[slot * 4:slot * 4 + 4]
+
+    def _rebuild(self):
+        live = [slot for slot, oid in enumerate(self._oids) if oid is not None]
+        self._tree = PackedRTree.build((self._extent(slot) for slot in live), live)
+        self._packed = len(self._oids)
+
+    def _add(self, oid, geom):
+        key = self._from_id(oid)
+        if key in self._slots:
+            raise KeyError('{oid} is already in the index'.format(oid=key))
+
+        self._slots[key] = len(self._oids)
+        self._oids.append(key)
+        self._geoms.append(geom)
+        self._extents.extend(geom.extent)
+        self._dirty = True
+
+    def _remove(self, oid):
+        slot = self._slots.pop(self._from_id(oid), None)
+        if slot is not None:
+            self._oids[slot] = None
+            self._geoms[slot] = None
+            self._dirty = True
+
+    def _pack_pending(self):
+        if len(self._oids) - self._packed > max(self.min_pending, self._packed / 4):
+            with self._lock:
+                if len(self._oids) - self._packed > max(self.min_pending, self._packed / 4):
+                    self._rebuild()
+
+    def all_rows(self):
+        """Every live slot.  Slots are what the predicates return when called with rows=True"""
+        return [slot for slot, oid in enumerate(self._oids) if oid is not None]
+
+    def rows_of(self, oids):
+        slots = (self._slots.get(self._from_id(oid)) for oid in oids)
+        return [slot for slot in slots if slot is not None]
+
+    def ids_of(self, rows):
+        for slot in rows:
+            if self._oids[slot] is not None:
+                yield self._to_id(self._oids[slot])
+
+    def _candidates(self, extent, filtered=True, candidates=None, rows=False):
+        if candidates is not None:
+            for slot in (candidates if rows else self.rows_of(candidates)):
+                if self._oids[slot] is not None:
+                    yield slot
+            return
+
+        with self._lock: # the tree and the number of slots it covers, as they were together
+            self._pack_pending()
+            tree, packed, end = self._tree, self._packed, len(self._oids)
+
+        if not (filtered and self.use_index):
+            for slot, oid in enumerate(self._oids):
+                if oid is not None:
+                    yield slot
+            return
+
+        xmin, ymin, xmax, ymax = extent
+        for slot in tree.search(xmin, ymin, xmax, ymax):
+            if self._oids[slot] is not None:
+                yield slot
+
+        for slot in xrange(packed, end):
+            if self._oids[slot] is not None:
+                e = self._extent(slot)
+                if e[0] <= xmax and e[1] <= ymax and e[2] >= xmin and e[3] >= ymin:
+                    yield slot
+
+    def _paged(self, slots, test, after=None, limit=None):
+        # paging is in slot order, so the candidates are sorted before any exact tests and testing stops at limit
+        if after is not None or limit:
+            slots = sorted(slot for slot in slots if after is None or slot > after)
+        matched = (slot for slot in slots if test(slot))
+        return islice(matched, limit) if limit else matched
+
+    def _select(self, function, geom, filtered=True, test=None, candidates=None, rows=False, after=None, limit=None):
+        extent = geom.extent
+        slots = self._candidates(extent, filtered, candidates, rows)
+        if function in ENVELOPE_PREDICATES:
+            envelope_test = ENVELOPE_PREDICATES[function]
+            return self._paged(slots, lambda slot: envelope_test(extent, self._extent(slot)), after, limit)
+
+        test = test or PREDICATES[function]
+        prepared = geom.prepared
+        return self._paged(slots, lambda slot: test(geom, prepared, self._geometry(slot)), after, limit)
+
+    def bulk_load(self, batch_size=50000):
+        return _MemoryBulkLoad(self, batch_size)
+
+    @_writes
+    def bulk_insert(self, oids_and_geoms):
+        for oid, geom in oids_and_geoms:
+            self._add(oid, geom)
+
+    @_writes
+    def insert(self, oid, geom, srid=None):
+        self._add(oid, self._with_srid(geom, srid))
+
+    def exists(self, oid):
+        return self._from_id(oid) in self._slots
+
+    @_writes
+    def delete(self, oid):
+        self._remove(oid)
+
+    @_writes
+    def bulk_delete(self, oids):
+        for oid in oids:
+            self._remove(oid)
+
+    def tombstone(self, oids):
+        # removal here is already lazy: the slot is emptied and the tree repacked later
+        self.bulk_delete(oids)
+
+    def delete_region(self, geom, srid=None):
+        with self._lock:
+            oids = list(self.intersects(geom, srid))
+            self.bulk_delete(oids)
+        return oids
+
+    @_writes
+    def compact(self, batch_size=None):
+        """Drop emptied slots, renumbering the rest.  Page tokens from before it are refused."""
+        live = [slot for slot, oid in enumerate(self._oids) if oid is not None]
+        purged = len(self._oids) - len(live)
+        if purged:
+            extents = array('d')
+            for slot in live:
+                extents.extend(self._extent(slot))
+            self._oids = [self._oids[slot] for slot in live]
+            self._geoms = [self._geoms[slot] for slot in live]
+            self._extents = extents
+            self._slots = dict((oid, slot) for slot, oid in enumerate(self._oids))
+            self._epoch = os.urandom(6).encode('hex')
+            self._dirty = True
+        self._rebuild()
+        return purged
+
+    @_writes
+    def bulk_upsert(self, oids_and_geoms):
+        for oid, geom in oids_and_geoms:
+            self._remove(oid)
+            self._add(oid, geom)
+
+    def count(self, geom=None, srid=None):
+        if geom is None:
+            return len(self._slots)
+        geom = self._with_srid(geom, srid)
+        return sum(1 for _ in self._select('within', geom))
+
+    def relate(self, relation, geom, srid=None, candidates=None, rows=False, after=None, limit=None):
+        geom = self._with_srid(geom, srid)
+        test = lambda q, p, s: s.relate_pattern(q, relation)
+        slots = self._select('relate', geom, relation_needs_intersection(relation), test, candidates, rows, after, limit)
+        return slots if rows else self.ids_of(slots)
+
+    def dwithin(self, geom, distance, srid=None, candidates=None, rows=False, after=None, limit=None):
+        geom = self._with_srid(geom, srid)
+        extent = geom.extent
+        test = lambda slot: box_distance(extent, self._extent(slot)) <= distance and self._geometry(slot).distance(geom) <= distance
+        slots = self._paged(self._candidates(expanded(extent, distance), candidates=candidates, rows=rows), test, after, limit)
+        return slots if rows else self.ids_of(slots)
+
+    def nearest(self, geom, k=None, srid=None, with_distance=False):
+        geom = self._with_srid(geom, srid)
+        with self._lock:
+            self._pack_pending()
+            tree, packed, end = self._tree, self._packed, len(self._oids)
+        pending = [(self._extent(slot), slot) for slot in xrange(packed, end) if self._oids[slot] is not None]
+        distance = lambda slot: self._geometry(slot).distance(geom) if self._oids[slot] is not None else None
+
+        results = tree.nearest(geom.extent, distance, pending)
+        for slot, d in (islice(results, k) if k else results):
+            oid = self._to_id(self._oids[slot])
+            yield (oid, d) if with_distance else oid
+
+    bbcontains = _select_basic("mbrcontains")
+    bboverlaps = _select_basic('mbroverlaps')
+    contains = _select_basic('contains')
+    overlaps = _select_basic('overlaps')
+    contained = _select_basic('contained')
+    containsproperly = _select_basic('containsproperly')
+    coveredby = _select_basic('coveredby')
+    covers = _select_basic('covers')
+    crosses = _select_basic('crosses')
+    disjoint = _select_basic('disjoint', filtered=False)
+    equals = _select_basic('equals')
+    exact =  _select_basic('exact')
+    intersects = _select_basic('intersects')
+    touches = _select_basic('touches')
+    within = _select_basic('within')
@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 import hmac
 
 # Create your models here.
@@ -74,4 +75,75 @@ class ApiKeyAuthorization(object):
 
     @property
     def modify_properties(self):
-        return self.api_key.modify_properties
\ No newline at end of file
+        return self.api_key.modify_properties
+
+
+class IngestJob(models.Model):
+    """An import running in the background.  The upload is spooled to source, and the worker updates rows and
+    progress (the fraction of the input read) as it goes."""
+
+    GEOJSON = 'geojson'
+    OGR = 'ogr'
+    KINDS = ((GEOJSON, 'GeoJSON'), (OGR, 'OGR datasource'))
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = ((QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'))
+
+    user = models.ForeignKey(User, related_name='ingest_jobs')
+    kind = models.CharField(max_length=16, choices=KINDS)
+    source = models.CharField(max_length=1024)
+    source_name = models.CharField(max_length=255, blank=True, default='')
+    master_file = models.CharField(max_length=255, blank=True, default='')
+    database = models.CharField(max_length=255)
+    collection = models.CharField(max_length=255)
+    srid = models.IntegerField()
+
+    status = models.CharField(max_length=16, choices=STATUSES, default=QUEUED)
+    worker = models.CharField(max_length=255, blank=True, default='') # host:pid of the process whose pool has the job
+    rows = models.BigIntegerField(default=0)
+    progress = models.FloatField(default=0.0)
+    error = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return u"%s import into %s:%s (%s)" % (self.kind, self.database, self.collection, self.status)
+
+    @property
+    def seconds(self):
+        if not self.started:
+            return 0.0
+        delta = (self.finished or timezone.now()) - self.started
+        return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+    @property
+    def rows_per_second(self):
+        seconds = self.seconds
+        return self.rows / seconds if seconds else 0.0
+
+    @property
+    def eta(self):
+        """Seconds until the job is expected to finish, or None if there isn't enough progress to tell"""
+        if self.status != IngestJob.RUNNING or not 0 < self.progress < 1:
+            return None
+        return self.seconds * (1 - self.progress) / self.progress
+
+    def as_dict(self):
+        return {
+            'id' : self.pk,
+            'kind' : self.kind,
+            'collection' : self.collection,
+            'status' : self.status,
+            'rows' : self.rows,
+            'progress' : self.progress,
+            'rows_per_second' : self.rows_per_second,
+            'eta' : self.eta,
+            'error' : self.error,
+            'created' : self.created.isoformat() if self.created else None,
+            'started' : self.started.isoformat() if self.started else None,
+            'finished' : self.finished.isoformat() if self.finished else None,
+        }
@@ -0,0 +1,150 @@
+__author__ = 'jeff'
+
+from ga_spatialnosql.db.mongo import GeoJSONCollection
+from ga_spatialnosql.utils import chunk
+from ga_spatialnosql.pools import process_pool
+from ga_spatialnosql import app_settings
+from django.conf import settings
+from multiprocessing import cpu_count
+from osgeo import ogr, osr
+from tempfile import mkdtemp
+from logging import getLogger
+import json
+import os
+import re
+import tarfile
+import time
+import zipfile
+
+log = getLogger(__name__)
+
+# Imports OGR datasources into collections, one collection per layer.  Features are read from OGR a batch at a time and
+# written through the collection's FeatureCollection bulk path, so a layer is never held in memory whole.  Layers are
+# independent, so datasources with several of them import each layer in its own worker process, from a pool forked
+# by the pool process rather than by this one (see pools).
+
+def normalize(name):
+    name = re.sub('%', 'pct', name)
+    name = re.sub('[^A-z0-9_]', '_', name).lower()
+    if name[0] in '0123456789_':
+        name = 'x' + name
+    name = re.sub('__*', "_", name)
+    name = re.sub('__*$', '', name)
+    return name
+
+def mongo_connection():
+    return settings.MONGODB_CONNECTIONS['ga_spatialnosql'] if 'ga_spatialnosql' in settings.MONGODB_CONNECTIONS else settings.MONGODB_CONNECTIONS['default']
+
+_transforms = {}
+
+def _transformation(s_srs, srid):
+    """A cached CoordinateTransformation from a layer's reference system to srid, or None if the layer has none"""
+    if s_srs is None:
+        return None
+
+    key = (s_srs.ExportToWkt(), srid)
+    if key not in _transforms:
+        s_srs = s_srs.Clone()
+        t_srs = osr.SpatialReference()
+        t_srs.ImportFromEPSG(srid)
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'): # GDAL 3 otherwise uses lat, lon order for geographic systems
+            s_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            t_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        _transforms[key] = None if s_srs.IsSame(t_srs) else osr.CoordinateTransformation(s_srs, t_srs)
+    return _transforms[key]
+
+def _features(layer, transform):
+    layer.ResetReading()
+    feature = layer.GetNextFeature()
+    while feature is not None:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            log.warning('skipping feature {fid} of {layer}, which has no geometry'.format(fid=feature.GetFID(), layer=layer.GetName()))
+        else:
+            if transform:
+                geometry.Transform(transform)
+            yield json.loads(feature.ExportToJson())
+        feature = layer.GetNextFeature()
+
+def import_layer(db, path, layer_index, collection, srid, batch_size=None, index_path=None, progress=None):
+    """Import one layer of the datasource at path into a new collection, replacing any collection of that name.
+    progress, if given, is called with the number of features imported so far after each batch."""
+    started = time.time()
+    ds = ogr.Open(path)
+    layer = ds.GetLayer(layer_index)
+    coll = GeoJSONCollection(db=db, collection=collection, index_path=index_path or settings.INDEX_PATH, srid=srid, clear=True)
+
+    features = 0
+    with coll.index.bulk_load():
+        for batch in chunk(_features(layer, _transformation(layer.GetSpatialRef(), srid)), batch_size or app_settings.INGEST_BATCH_SIZE):
+            coll.insert_features({'type' : 'FeatureCollection', 'features' : batch})
+            features += len(batch)
+            if progress:
+                progress(features)
+    coll.index.close()
+
+    seconds = time.time() - started
+    log.info('imported {n} features from layer {layer} of {path} in {s:.1f}s'.format(n=features, layer=layer.GetName(), path=path, s=seconds))
+    return {
+        'layer' : layer.GetName(),
+        'collection' : collection,
+        'features' : features,
+        'seconds' : seconds,
+    }
+
+def _reconnect():
+    # a forked worker can't share the sockets it inherited, so its connections reconnect on first use
+    for connection in settings.MONGODB_CONNECTIONS.values():
+        connection.disconnect()
+
+def _import_layer(args):
+    database, path, layer_index, collection, srid, batch_size, index_path = args
+    return import_layer(mongo_connection()[database], path, layer_index, collection, srid, batch_size, index_path)
+
+def import_datasource(database, path, collection, srid, processes=None, batch_size=None, index_path=None, progress=None):
+    """Import every layer of the OGR datasource at path into the Mongo database named database, layer by layer in
+    up to processes worker processes.  Each layer becomes the collection collection__layername.  Returns the
+    statistics of each layer's import.  progress, if given, is called with the features imported so far and the
+    total OGR expects, after each batch when the import runs in this process and after each layer otherwise."""
+    ds = ogr.Open(path)
+    if ds is None:
+        raise ValueError('{path} is not a datasource OGR can read'.format(path=path))
+
+    layers = [(database, path, i, collection + '__' + normalize(ds.GetLayer(i).GetName()), srid, batch_size, index_path) for i in range(ds.GetLayerCount())]
+    total = sum(max(0, ds.GetLayer(i).GetFeatureCount()) for i in range(ds.GetLayerCount()))
+    ds = None
+
+    def report(features):
+        if progress:
+            progress({'features' : features, 'total' : total})
+
+    results = []
+    processes = min(len(layers), processes or app_settings.OGR_IMPORT_PROCESSES or cpu_count())
+    if processes <= 1:
+        for database, path, i, name, srid, batch_size, index_path in layers:
+            done = sum(r['features'] for r in results)
+            results.append(import_layer(mongo_connection()[database], path, i, name, srid, batch_size, index_path, lambda n: report(done + n)))
+        return results
+
+    pool = process_pool(processes, initializer=_reconnect)
+    try:
+        for stats in pool.imap_unordered(_import_layer, layers):
+            results.append(stats)
+            report(sum(r['features'] for r in results))
+        return results
+    finally:
+        pool.close()
+        pool.join()
+
+def extract(filename, name, master_file):
+    """The path OGR should open for an uploaded file, and the directory it was extracted into if it was an archive"""
+    if not (name.endswith('.zip') or name.endswith('.tar.gz') or name.endswith('.tar.bz2')):
+        return filename, None
+
+    dir = mkdtemp()
+    if name.endswith('.zip'):
+        archive = zipfile.ZipFile(filename)
+    else:
+        archive = tarfile.open(filename, 'r:gz' if name.endswith('.gz') else 'r:bz2')
+    archive.extractall(dir)
+    return os.path.join(dir, master_file), dir
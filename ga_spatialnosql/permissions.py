@@ -0,0 +1,114 @@
+__author__ = 'jeff'
+
+from django.contrib.auth.models import User, Group
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from ga_spatialnosql import app_settings as settings
+from collections import OrderedDict
+from threading import Lock
+import time
+
+# Permission decisions for the Authenticated* API views.  A decision depends on the user's groups, on which connection
+# the owner's database lives in, and on the permissions stored with the collection, and none of those change often, so
+# each is cached for PERMISSION_CACHE_TTL seconds and a repeat request is decided by a dictionary lookup.  Changes to
+# users and groups made in this process clear the caches through signals, and a collection invalidates the decisions
+# about it whenever its permissions are written or it is dropped.  Changes made in other processes are seen once the
+# entries expire.  Each cache holds at most PERMISSION_CACHE_ENTRIES entries and drops its oldest beyond that, which
+# keeps lookups free of the lock, as an LRU's reordering would not.
+
+ALL = 1
+AUTHENTICATED = 2
+OWNER = 3
+
+ADMIN_GROUP = 'admin_ga_spatialnosql'
+CONNECTION_GROUP_PREFIX = 'ga_spatialnosql_'
+
+class _TTLCache(object):
+    def __init__(self, max_entries=None):
+        self.max_entries = settings.PERMISSION_CACHE_ENTRIES if max_entries is None else max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, compute):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+        value = compute()
+        with self._lock:
+            self._entries.pop(key, None) # an entry that is refreshed counts as the newest
+            self._entries[key] = (time.time() + settings.PERMISSION_CACHE_TTL, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def discard(self, matches=None):
+        with self._lock:
+            if matches is None:
+                self._entries.clear()
+            else:
+                for key in [key for key in self._entries if matches(key)]:
+                    del self._entries[key]
+
+_groups = _TTLCache()
+_connection_groups = _TTLCache()
+_decisions = _TTLCache()
+
+def user_groups(user):
+    """The names of user's groups, as a frozenset"""
+    if not user.is_authenticated():
+        return frozenset()
+    return _groups.get(user.pk, lambda: frozenset(user.groups.values_list('name', flat=True)))
+
+def connection_group(username):
+    """The connection the database of the user named username lives in, from their ga_spatialnosql_ group"""
+    def find():
+        group = Group.objects.filter(user__username=username, name__startswith=CONNECTION_GROUP_PREFIX).values_list('name', flat=True)[:1]
+        if not group:
+            raise User.DoesNotExist('{user} is not in a {prefix} group'.format(user=username, prefix=CONNECTION_GROUP_PREFIX))
+        return group[0][len(CONNECTION_GROUP_PREFIX):]
+    return _connection_groups.get(username, find)
+
+def allowed(permissions, permission, user, owner, groups):
+    """Whether user, a member of groups, may exercise permission on something of owner's carrying permissions.  A
+    permission is ALL, AUTHENTICATED, OWNER (or None, meaning OWNER), or a list of 'user:name' and 'group:name'."""
+    if user.is_superuser or ADMIN_GROUP in groups:
+        return True
+
+    rule = permissions.get(permission)
+    if rule == ALL:
+        return True
+    if rule == AUTHENTICATED:
+        return user.is_authenticated()
+    if rule in (OWNER, None):
+        return user.is_authenticated() and user.username == owner
+    if isinstance(rule, (list, tuple)):
+        return ('user:' + user.username) in rule or any(('group:' + name) in rule for name in groups)
+    return False
+
+def check(user, permission, owner, collection, permissions):
+    """Whether user may exercise permission on owner's collection (their database, if collection is None).
+    permissions is called for the permissions stored with it only when the decision isn't cached."""
+    key = (user.pk, permission, owner, collection)
+    return _decisions.get(key, lambda: allowed(permissions(), permission, user, owner, user_groups(user)))
+
+def invalidate(owner=None, collection=None):
+    """Forget decisions about owner's collection, all of owner's things if collection is None, or everything"""
+    if owner is None:
+        _decisions.discard()
+    elif collection is None:
+        _decisions.discard(lambda key: key[2] == owner)
+    else:
+        _decisions.discard(lambda key: key[2:] == (owner, collection))
+
+def _users_changed(sender, **kwargs):
+    # membership, superuser status and group names all feed into decisions, and they change rarely enough that
+    # starting over is simplest.  Logging in saves the user too, but changes nothing that matters here.
+    if kwargs.get('update_fields') and set(kwargs['update_fields']) <= set(['last_login']):
+        return
+    _groups.discard()
+    _connection_groups.discard()
+    _decisions.discard()
+
+m2m_changed.connect(_users_changed, sender=User.groups.through, dispatch_uid='ga_spatialnosql.permissions.membership')
+for model in (User, Group):
+    post_save.connect(_users_changed, sender=model, dispatch_uid='ga_spatialnosql.permissions.save.' + model.__name__)
+    post_delete.connect(_users_changed, sender=model, dispatch_uid='ga_spatialnosql.permissions.delete.' + model.__name__)
@@ -0,0 +1,165 @@
+__author__ = 'jeff'
+
+from ga_spatialnosql.hilbert import extent_of
+from ga_spatialnosql.rtree import expanded
+from ga_spatialnosql.utils import relation_needs_intersection
+from ga_spatialnosql import app_settings as settings
+from logging import getLogger
+import time
+
+log = getLogger(__name__)
+
+# Plans for queries that have both a geo_spec and an attribute spec:
+#
+#   spatial    search the index, then fetch the matches from Mongo in $in chunks filtered by the spec
+#   attribute  fetch the _ids matching the spec, then test only those geometries in the index
+#   intersect  fetch the spec's _ids on a thread while the index is searched, and fetch only ids both sides matched
+
+SPATIAL, ATTRIBUTE, INTERSECT = 'spatial', 'attribute', 'intersect'
+
+class EnvelopeHistogram(object):
+    """Counts of envelope centres on a cells x cells grid over the index bounds, used to estimate how many rows the
+    R-tree filter passes for a query window.  An envelope overlaps the window when its centre falls inside the window
+    grown by half the envelope's size, so the window is grown by the mean half size and the counts of the cells it
+    covers are summed, pro rata for partly covered cells."""
+
+    def __init__(self, envelopes, total=None, cells=32):
+        envelopes = list(envelopes)
+        self.cells = cells
+        self.sampled = len(envelopes)
+        self.total = self.sampled if total is None else total
+        self.counts = [0] * (cells * cells)
+        self.bounds = extent_of(envelopes)
+        if not envelopes:
+            return
+
+        xmin, ymin, xmax, ymax = self.bounds
+        self.cell_width = (xmax - xmin) / cells or 1.0
+        self.cell_height = (ymax - ymin) / cells or 1.0
+        self.half_width = sum(e[2] - e[0] for e in envelopes) / (2.0 * self.sampled)
+        self.half_height = sum(e[3] - e[1] for e in envelopes) / (2.0 * self.sampled)
+
+        for e in envelopes:
+            i, j = self._cell((e[0] + e[2]) / 2.0, (e[1] + e[3]) / 2.0)
+            self.counts[j * cells + i] += 1
+
+    def _cell(self, x, y):
+        last = self.cells - 1
+        i = int((x - self.bounds[0]) / self.cell_width)
+        j = int((y - self.bounds[1]) / self.cell_height)
+        return max(0, min(last, i)), max(0, min(last, j))
+
+    def estimate(self, extent):
+        """Expected number of rows whose envelopes overlap extent"""
+        if not self.sampled:
+            return 0
+
+        qxmin, qymin, qxmax, qymax = extent[0] - self.half_width, extent[1] - self.half_height, extent[2] + self.half_width, extent[3] + self.half_height
+        x0, y0 = self._cell(qxmin, qymin)
+        x1, y1 = self._cell(qxmax, qymax)
+
+        found = 0.0
+        for j in xrange(y0, y1 + 1):
+            cymin = self.bounds[1] + j * self.cell_height
+            dy = min(qymax, cymin + self.cell_height) - max(qymin, cymin)
+            if dy <= 0:
+                continue
+            for i in xrange(x0, x1 + 1):
+                count = self.counts[j * self.cells + i]
+                if count:
+                    cxmin = self.bounds[0] + i * self.cell_width
+                    dx = min(qxmax, cxmin + self.cell_width) - max(qxmin, cxmin)
+                    if dx > 0:
+                        found += count * min(1.0, dx / self.cell_width) * min(1.0, dy / self.cell_height)
+
+        return int(round(found * self.total / self.sampled))
+
+def _query_extent(operator, args):
+    """The extent the index filters a geo_spec operator on, or None if the operator is not limited by one"""
+    geoms = [arg for arg in args if hasattr(arg, 'extent')]
+    if not geoms or operator == 'disjoint':
+        return None
+    if operator == 'relate' and not relation_needs_intersection(args[0]):
+        return None
+    if operator == 'dwithin':
+        return expanded(geoms[0].extent, args[1])
+    return geoms[0].extent
+
+class QueryPlanner(object):
+    """Chooses how to run a query that combines a geo_spec with an attribute spec.  Spatial selectivity comes from
+    an EnvelopeHistogram over a sample of the index, rebuilt when it is older than ttl seconds or when the rows
+    written since it was built come to more than stale_fraction of the rows it was built from.  Attribute selectivity
+    comes from counting the spec's matches in Mongo, which is cheap when the spec hits an index, capped at probe so an
+    unselective spec never costs a full count."""
+
+    def __init__(self, index, coll, probe=None, ttl=None, sample=None, cells=None, stale_fraction=None):
+        self.index = index
+        self.coll = coll
+        self.probe = probe or settings.PLANNER_ATTRIBUTE_PROBE
+        self.ttl = settings.PLANNER_STATISTICS_TTL if ttl is None else ttl
+        self.sample = sample or settings.PLANNER_SAMPLE_SIZE
+        self.cells = cells or settings.PLANNER_HISTOGRAM_CELLS
+        self.stale_fraction = settings.PLANNER_STALE_FRACTION if stale_fraction is None else stale_fraction
+        self._histogram = None
+        self._built = 0
+        self._written = 0
+
+    def invalidate(self):
+        self._histogram = None
+
+    def wrote(self, rows=1):
+        """Count rows written to the index, which wears the statistics out sooner than their ttl"""
+        self._written += rows
+
+    def _stale(self):
+        histogram = self._histogram
+        return histogram is None or time.time() - self._built > self.ttl or self._written > histogram.total * self.stale_fraction
+
+    def histogram(self):
+        if self._stale():
+            self._written = 0
+            self._histogram = EnvelopeHistogram(self.index.envelopes(self.sample), self.index.count(), self.cells)
+            self._built = time.time()
+        return self._histogram
+
+    def estimate(self, geo_spec):
+        """Rows a geo_spec is expected to match.  Its terms are ANDed, so the most selective one bounds the estimate."""
+        estimates = [self.term_estimate(operator, args) for operator, args in geo_spec.items()]
+        return min(estimates) if estimates else self.histogram().total
+
+    def term_estimate(self, operator, args):
+        """Rows one geo_spec term is expected to match.  '$or' adds up its alternatives, '$and' takes the most
+        selective, and '$not' is assumed to match everything."""
+        operator = operator.lstrip('$')
+        total = self.histogram().total
+        if operator == 'or':
+            return min(total, sum(self.estimate(alternative) for alternative in args))
+        if operator == 'and':
+            return min([self.estimate(term) for term in args] or [total])
+        if operator == 'not':
+            return total
+
+        extent = _query_extent(operator, args if isinstance(args, (list, tuple)) else [args])
+        return total if extent is None else self.histogram().estimate(extent)
+
+    def attribute_estimate(self, spec):
+        """Documents matching spec, counted up to probe + 1"""
+        return self.coll.find(spec, fields=['_id']).limit(self.probe + 1).count(True)
+
+    def plan(self, geo_spec, spec):
+        spatial = self.estimate(geo_spec)
+        attribute = self.attribute_estimate(spec)
+
+        if attribute <= self.probe and attribute <= spatial:
+            strategy = ATTRIBUTE
+        elif spatial <= self.probe or attribute <= self.probe:
+            strategy = SPATIAL
+        else:
+            strategy = INTERSECT
+
+        return {
+            'strategy' : strategy,
+            'spatial_estimate' : spatial,
+            'attribute_estimate' : attribute,
+            'attribute_capped' : attribute > self.probe,
+        }
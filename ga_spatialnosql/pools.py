@@ -0,0 +1,42 @@
+__author__ = 'jeff'
+
+from multiprocessing.managers import SyncManager
+from threading import Lock, active_count
+from logging import getLogger
+
+log = getLogger(__name__)
+
+# Worker process pools, for geometry encoding and OGR imports.  multiprocessing forks its workers, and a process forked
+# while other threads are running carries every lock those threads held at that moment (logging's, SQLite's,
+# pymongo's) into a child with no thread left to release them.  Python 2 has no spawn or forkserver start method, so
+# pools are forked from a dedicated process instead: a SyncManager server, whose only threads are its own.  It is
+# forked once, ideally before the web process starts any threads, and pools live in it and are driven through
+# proxies, so work and results cross one extra pipe.
+
+_manager = None
+_lock = Lock()
+
+def start():
+    """Start the process pools are forked from, if it isn't running.  Call it from the settings or WSGI module so it
+    is forked before the web process runs any threads; otherwise it is started when a pool is first wanted."""
+    global _manager
+    with _lock:
+        if _manager is None:
+            if active_count() > 1:
+                log.warning('starting the pool process with {n} threads running; call ga_spatialnosql.pools.start() at startup'.format(n=active_count()))
+            manager = SyncManager()
+            manager.start()
+            _manager = manager
+        return _manager
+
+def process_pool(processes, initializer=None, initargs=()):
+    """A multiprocessing Pool of processes workers, forked from the pool process and used through a proxy"""
+    return start().Pool(processes, initializer, initargs)
+
+def shutdown():
+    """Stop the pool process and every pool in it.  The next pool wanted starts it again."""
+    global _manager
+    with _lock:
+        manager, _manager = _manager, None
+    if manager is not None:
+        manager.shutdown()
@@ -0,0 +1,138 @@
+__author__ = 'jeff'
+
+from ga_spatialnosql import app_settings as settings
+from django.contrib.gis.geos import GEOSGeometry
+from collections import OrderedDict
+from threading import Lock
+from hashlib import sha1
+from bson import BSON
+import time
+
+# Results of spatial queries, shared by every collection in the process.  Entries are keyed by the collection, its
+# write generation and the normalised query, so a write to a collection makes its earlier entries unreachable and
+# they age out of the LRU.  Results are held BSON encoded: that is what their size is counted in, and each hit decodes
+# fresh documents, so a caller changing a feature can't change the cached copy.  Writes from other processes don't
+# bump the generation, so entries also expire after QUERY_CACHE_TTL seconds.
+#
+# Generations are kept here rather than on collection handles, so that every handle on a collection sees the writes
+# made through the others.  A write bumps the generation as it starts and again once it is done: a query that runs
+# alongside it files its result under a generation that no query after the write looks up.
+
+_generations = {}
+_generations_lock = Lock()
+
+def write_generation(collection):
+    """The write generation of collection, a (database name, collection name, created) tuple"""
+    return _generations.get(collection, 0)
+
+def wrote(collection):
+    """Bump the write generation of collection"""
+    with _generations_lock:
+        _generations[collection] = _generations.get(collection, 0) + 1
+
+def normalized(value):
+    """value as something hashable, with geometries reduced to a hash of their WKB"""
+    if isinstance(value, GEOSGeometry):
+        return ('geometry', sha1(str(value.wkb)).hexdigest(), value.srid)
+    if isinstance(value, dict):
+        return tuple(sorted((key, normalized(v)) for key, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(normalized(v) for v in value)
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return repr(value)
+
+class QueryCache(object):
+    def __init__(self, max_entries=None, max_bytes=None, max_result_bytes=None, ttl=None):
+        self.max_entries = settings.QUERY_CACHE_ENTRIES if max_entries is None else max_entries
+        self.max_bytes = max_bytes or settings.QUERY_CACHE_BYTES
+        self.max_result_bytes = max_result_bytes or settings.QUERY_CACHE_RESULT_BYTES
+        self.ttl = settings.QUERY_CACHE_TTL if ttl is None else ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, as_class=None):
+        """The cached documents for key and the page token stored with them, or None"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                self.bytes -= entry[3]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry # most recently used
+            self.hits += 1
+
+        _, documents, page, size = entry
+        return [BSON(document).decode(as_class=as_class or dict) for document in documents], page
+
+    def collector(self):
+        return _Collector(self.max_result_bytes)
+
+    def put(self, key, collector, page=None):
+        if collector.overflowed or not self.max_entries:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[3]
+            self._entries[key] = (time.time(), collector.documents, page, collector.bytes)
+            self.bytes += collector.bytes
+            while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+                _, (_, _, _, size) = self._entries.popitem(last=False)
+                self.bytes -= size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries' : len(self._entries),
+            'bytes' : self.bytes,
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'evictions' : self.evictions,
+            'hit_rate' : float(self.hits) / lookups if lookups else 0.0,
+        }
+
+class _Collector(object):
+    """Encodes a result's documents as they are yielded, giving up once they outgrow what one entry may hold"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.documents = []
+        self.bytes = 0
+        self.overflowed = False
+
+    def add(self, document):
+        if self.overflowed:
+            return
+        encoded = BSON.encode(document)
+        self.bytes += len(encoded)
+        if self.bytes > self.max_bytes:
+            self.overflowed = True
+            self.documents = None
+        else:
+            self.documents.append(encoded)
+
+_cache = None
+_cache_lock = Lock()
+
+def query_cache():
+    """The process-wide QueryCache"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = QueryCache()
+        return _cache
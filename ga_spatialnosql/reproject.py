@@ -0,0 +1,89 @@
+__author__ = 'jeff'
+
+from array import array
+from itertools import chain
+from threading import local
+from django.contrib.gis.gdal import CoordTransform, OGRGeometry, SpatialReference
+import struct
+import sys
+
+# Reprojects GeoJSON geometries in bulk.  Every x, y in a batch of geometries is gathered into one array of doubles,
+# handed to OGR as a single LineString so PROJ transforms them all in one call, and scattered back into the GeoJSON.
+# Z values are carried through untouched.
+
+_NUMBER = (int, long, float)
+_LINESTRING = struct.Struct('=BII')
+_BYTE_ORDER = 1 if sys.byteorder == 'little' else 0
+
+_cache = local()
+
+def _srs(srs):
+    return srs if isinstance(srs, SpatialReference) else SpatialReference(srs)
+
+def _key(srs):
+    return srs.wkt if isinstance(srs, SpatialReference) else srs
+
+def transformation(source, target):
+    """A CoordTransform from source to target, each an srid or a SpatialReference.  Transformations are cached per
+    pair, and per thread since OGR transformations can't be shared between threads."""
+    transforms = getattr(_cache, 'transforms', None)
+    if transforms is None:
+        transforms = _cache.transforms = {}
+
+    key = (_key(source), _key(target))
+    if key not in transforms:
+        transforms[key] = CoordTransform(_srs(source), _srs(target))
+    return transforms[key]
+
+def transform_coordinates(xy, transform):
+    """Transform an array('d') of x, y pairs with one OGR call"""
+    n = len(xy) // 2
+    if not n:
+        return xy
+
+    line = OGRGeometry(buffer(_LINESTRING.pack(_BYTE_ORDER, 2, n) + xy.tostring()))
+    line.transform(transform)
+    line.coord_dim = 2
+    transformed = array('d')
+    transformed.fromstring(str(line.wkb)[_LINESTRING.size:])
+    return transformed
+
+def _parts(geometry):
+    if geometry['type'] == 'GeometryCollection':
+        return chain.from_iterable(_parts(member) for member in geometry['geometries'])
+    return [geometry]
+
+def _gather(coordinates, xy):
+    if not coordinates:
+        return
+    if isinstance(coordinates[0], _NUMBER):
+        xy.extend(coordinates[:2])
+    elif coordinates[0] and isinstance(coordinates[0][0], _NUMBER):
+        xy.extend(chain.from_iterable(position[:2] for position in coordinates))
+    else:
+        for c in coordinates:
+            _gather(c, xy)
+
+def _scatter(coordinates, xy):
+    if coordinates and isinstance(coordinates[0], _NUMBER):
+        return [next(xy), next(xy)] + list(coordinates[2:])
+    return [_scatter(c, xy) for c in coordinates]
+
+def reproject_geojson(geometries, source, target):
+    """Reproject GeoJSON geometry dicts in place from source to target, srids or SpatialReferences"""
+    parts = []
+    seen = set()
+    for geometry in geometries:
+        for part in _parts(geometry):
+            if id(part) not in seen:
+                seen.add(id(part))
+                parts.append(part)
+
+    xy = array('d')
+    for part in parts:
+        _gather(part['coordinates'], xy)
+
+    transformed = iter(transform_coordinates(xy, transformation(source, target)))
+    for part in parts:
+        part['coordinates'] = _scatter(part['coordinates'], transformed)
+    return geometries
@@ -0,0 +1,329 @@
+__author__ = 'jeff'
+
+from array import array
+from ga_spatialnosql.hilbert import hilbert_keys, extent_of
+import heapq
+import math
+import mmap
+import os
+import struct
+import sys
+
+# A static, packed R-tree stored in flat arrays.  Entries are sorted along a Hilbert curve and packed node_size to a
+# node, bottom up, so the whole tree is two arrays: the boxes of every entry (leaves first, root last) as
+# xmin, ymin, xmax, ymax quadruples, and for each entry either the item number (leaves) or the position of its first
+# child (internal nodes).
+
+NODE_SIZE = 16
+
+def _overlaps(box, xmin, ymin, xmax, ymax):
+    return box[0] <= xmax and box[1] <= ymax and box[2] >= xmin and box[3] >= ymin
+
+def box_distance(a, b):
+    """Smallest distance between two (xmin, ymin, xmax, ymax) boxes, a lower bound on the distance of anything in them"""
+    dx = max(a[0] - b[2], b[0] - a[2], 0.0)
+    dy = max(a[1] - b[3], b[1] - a[3], 0.0)
+    return math.hypot(dx, dy)
+
+def expanded(box, distance):
+    return box[0] - distance, box[1] - distance, box[2] + distance, box[3] + distance
+
+# entry kinds for best_first, ordered so that at equal distances refined results come out before anything that could
+# only tie them
+EXACT, ITEM, NODE = 0, 1, 2
+
+def best_first(extent, entries, expand, distance):
+    """Best-first nearest neighbour search over any R-tree.  entries are the starting (box, kind, ref) triples, expand(ref)
+    yields the same triples for the children of a NODE, and distance(ref) is the exact distance of an ITEM.  Yields
+    (item, distance) pairs in increasing distance; box distances only decide what to look at next, and every item is
+    refined to its exact distance before it can be returned."""
+    heap = [(box_distance(box, extent), kind, ref) for box, kind, ref in entries]
+    heapq.heapify(heap)
+    while heap:
+        d, kind, ref = heapq.heappop(heap)
+        if kind == EXACT:
+            yield ref, d
+        elif kind == ITEM:
+            exact = distance(ref)
+            if exact is not None:
+                heapq.heappush(heap, (exact, EXACT, ref))
+        else:
+            for box, kind, child in expand(ref):
+                heapq.heappush(heap, (box_distance(box, extent), kind, child))
+
+class PackedRTree(object):
+    def __init__(self, boxes, indices, level_bounds, node_size=NODE_SIZE):
+        self.boxes = boxes
+        self.indices = indices
+        self.level_bounds = level_bounds
+        self.node_size = node_size
+
+    @classmethod
+    def build(cls, extents, items=None, node_size=NODE_SIZE):
+        """Pack a tree over a sequence of (xmin, ymin, xmax, ymax) extents.  Leaves point at the integer items[i], or at i if
+        no items are given."""
+        extents = list(extents)
+        items = range(len(extents)) if items is None else list(items)
+        if not extents:
+            return cls(array('d'), array('l'), [], node_size)
+
+        keys = hilbert_keys(extents)
+        order = sorted(xrange(len(extents)), key=keys.__getitem__)
+
+        boxes = array('d')
+        indices = array('l')
+        for i in order:
+            boxes.extend(extents[i])
+            indices.append(items[i])
+
+        level_bounds = [len(indices)]
+        start = 0
+        while level_bounds[-1] - start > 1:
+            end = level_bounds[-1]
+            for first in xrange(start, end, node_size):
+                last = min(first + node_size, end)
+                boxes.extend(extent_of(boxes[i * 4:i * 4 + 4] for i in xrange(first, last)))
+                indices.append(first)
+            start = end
+            level_bounds.append(len(indices))
+
+        return cls(boxes, indices, level_bounds, node_size)
+
+    def __len__(self):
+        return self.level_bounds[0] if self.level_bounds else 0
+
+    @property
+    def bounds(self):
+        if not self.level_bounds:
+            return None
+        return self.box(self.level_bounds[-1] - 1)
+
+    def box(self, pos):
+        return tuple(self.boxes[pos * 4:pos * 4 + 4])
+
+    def children(self, pos, level):
+        """Positions of the entries one level below the internal node at pos, which sits at level"""
+        first = self.indices[pos]
+        return xrange(first, min(first + self.node_size, self.level_bounds[level - 1]))
+
+    def root(self):
+        return self.level_bounds[-1] - 1, len(self.level_bounds) - 1
+
+    def search(self, xmin, ymin, xmax, ymax):
+        """Yield the items whose boxes overlap the query box"""
+        if not self.level_bounds:
+            return
+
+        pos, level = self.root()
+        if not _overlaps(self.box(pos), xmin, ymin, xmax, ymax):
+            return
+
+        stack = [(pos, level)]
+        while stack:
+            pos, level = stack.pop()
+            if level == 0:
+                yield self.indices[pos]
+                continue
+            for child in self.children(pos, level):
+                if _overlaps(self.box(child), xmin, ymin, xmax, ymax):
+                    stack.append((child, level - 1))
+
+    def _entry(self, pos, level):
+        if level == 0:
+            return self.box(pos), ITEM, self.indices[pos]
+        return self.box(pos), NODE, (pos, level)
+
+    def nearest(self, extent, distance, extra=()):
+        """Items in increasing exact distance from the query extent.  extra is a sequence of (box, item) pairs that
+        are not in the tree but should be searched along with it."""
+        entries = [(box, ITEM, item) for box, item in extra]
+        if self.level_bounds:
+            entries.append(self._entry(*self.root()))
+
+        expand = lambda (pos, level): (self._entry(child, level - 1) for child in self.children(pos, level))
+        return best_first(extent, entries, expand, distance)
+
+    def write(self, f):
+        """Write the boxes as little-endian doubles followed by the indices as little-endian 64 bit integers,
+        the layout MappedRTree reads back in place."""
+        boxes, indices = self.boxes, self.indices
+        if sys.byteorder != 'little':
+            boxes = array('d', boxes)
+            boxes.byteswap()
+        f.write(boxes.tostring())
+
+        if indices.itemsize == 8 and sys.byteorder == 'little':
+            f.write(indices.tostring())
+        else:
+            f.write(struct.pack('<{n}q'.format(n=len(indices)), *indices))
+
+    def items(self):
+        """Yield every (item, box) pair in the leaves, in Hilbert order"""
+        for pos in xrange(len(self)):
+            yield self.indices[pos], self.box(pos)
+
+
+class _MappedArray(object):
+    def __init__(self, buf, offset, length, fmt):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+        self.item = struct.Struct('<' + fmt)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        return self.item.unpack_from(self.buf, self.offset + i * self.item.size)[0]
+
+class MappedRTree(PackedRTree):
+    """A PackedRTree read in place from a buffer laid out by PackedRTree.write, typically an mmap shared between
+    processes.  Nothing is copied up front; boxes are unpacked as the search touches them."""
+
+    _box = struct.Struct('<4d')
+
+    def __init__(self, buf, offset, level_bounds, node_size=NODE_SIZE):
+        entries = level_bounds[-1] if level_bounds else 0
+        PackedRTree.__init__(self, None, _MappedArray(buf, offset + entries * self._box.size, entries, 'q'), level_bounds, node_size)
+        self.buf = buf
+        self.offset = offset
+
+    @classmethod
+    def size(cls, level_bounds):
+        return (level_bounds[-1] if level_bounds else 0) * (cls._box.size + 8)
+
+    def box(self, pos):
+        return self._box.unpack_from(self.buf, self.offset + pos * self._box.size)
+
+# Snapshot files hold a packed tree together with the ids and WKB of every item, so any number of processes can mmap
+# the same file and answer queries from one shared copy in the page cache.  Layout, all little-endian:
+#
+#   header        magic, item count, node size, number of levels, oid width, srid
+#   level bounds  one uint64 per level
+#   tree          PackedRTree.write layout.  Leaf i refers to item i, so items are stored in Hilbert order
+#   oids          count fixed width, NUL padded records, padded to 8 bytes
+#   oid order     count int64 item numbers sorted by oid, for lookups by id
+#   wkb offsets   count + 1 uint64 offsets into the wkb section
+#   wkb           the geometries
+
+SNAPSHOT_MAGIC = 'GASNAP01'
+SNAPSHOT_HEADER = struct.Struct('<8sQIIIi')
+
+def _pad(n):
+    return (8 - n % 8) % 8
+
+def write_snapshot(path, rows, srid, node_size=NODE_SIZE):
+    """Write (oid, wkb, extent) rows to a snapshot file.  The file is written beside path and renamed over it, so
+    readers that have the previous snapshot mapped keep a consistent view until they reopen."""
+    oids = []
+    wkbs = []
+    extents = []
+    for oid, wkb, extent in rows:
+        oids.append(str(oid))
+        wkbs.append(wkb)
+        extents.append(tuple(extent))
+
+    tree = PackedRTree.build(extents, node_size=node_size)
+    order = [tree.indices[pos] for pos in xrange(len(tree))]
+    for pos in xrange(len(tree)):
+        tree.indices[pos] = pos
+    oids = [oids[i] for i in order]
+
+    count = len(oids)
+    oid_width = max(len(oid) for oid in oids) if oids else 0
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, count, node_size, len(tree.level_bounds), oid_width, srid or 0))
+        f.write(struct.pack('<{n}Q'.format(n=len(tree.level_bounds)), *tree.level_bounds))
+        tree.write(f)
+
+        f.write(''.join(oid.ljust(oid_width, '\0') for oid in oids))
+        f.write('\0' * _pad(count * oid_width))
+        f.write(struct.pack('<{n}q'.format(n=count), *sorted(xrange(count), key=oids.__getitem__)))
+
+        offset = 0
+        offsets = [0]
+        for i in order:
+            offset += len(wkbs[i])
+            offsets.append(offset)
+        f.write(struct.pack('<{n}Q'.format(n=count + 1), *offsets))
+        for i in order:
+            f.write(wkbs[i])
+
+    os.rename(tmp, path)
+    return path
+
+class Snapshot(object):
+    """Read-only view of a snapshot file through a shared, read-only mmap"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        info = os.fstat(self._file.fileno())
+        self.identity = (info.st_ino, info.st_mtime, info.st_size)
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, count, node_size, levels, oid_width, srid = SNAPSHOT_HEADER.unpack_from(self._map, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('{path} is not an index snapshot'.format(path=path))
+
+        self.count = count
+        self.srid = srid
+        self.oid_width = oid_width
+
+        offset = SNAPSHOT_HEADER.size
+        level_bounds = list(struct.unpack_from('<{n}Q'.format(n=levels), self._map, offset))
+        offset += 8 * levels
+        self.tree = MappedRTree(self._map, offset, level_bounds, node_size)
+        offset += MappedRTree.size(level_bounds)
+
+        self._oids_offset = offset
+        offset += count * oid_width + _pad(count * oid_width)
+        self._oid_order = _MappedArray(self._map, offset, count, 'q')
+        offset += count * 8
+        self._wkb_offsets = _MappedArray(self._map, offset, count + 1, 'Q')
+        self._wkb_offset = offset + (count + 1) * 8
+
+    def __len__(self):
+        return self.count
+
+    def changed(self):
+        """True if the file at path has been replaced since this snapshot was opened"""
+        try:
+            info = os.stat(self.path)
+        except OSError:
+            return True
+        return (info.st_ino, info.st_mtime, info.st_size) != self.identity
+
+    def oid(self, i):
+        start = self._oids_offset + i * self.oid_width
+        return self._map[start:start + self.oid_width].rstrip('\0')
+
+    def wkb(self, i):
+        start = self._wkb_offsets[i]
+        return buffer(self._map, self._wkb_offset + start, self._wkb_offsets[i + 1] - start)
+
+    def extent(self, i):
+        return self.tree.box(i)
+
+    def find(self, oid):
+        """Item number of oid, or None"""
+        oid = str(oid)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.oid(self._oid_order[mid]) < oid:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.oid(self._oid_order[lo]) == oid:
+            return self._oid_order[lo]
+        return None
+
+    def search(self, xmin, ymin, xmax, ymax):
+        return self.tree.search(xmin, ymin, xmax, ymax)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
@@ -0,0 +1,425 @@
+__author__ = 'jeff'
+
+from django.contrib.gis.geos import GEOSGeometry
+from ga_spatialnosql.index import GeoIndex, BulkLoad, IntegrityError
+from ga_spatialnosql.memindex import PREDICATES, ENVELOPE_PREDICATES
+from ga_spatialnosql.rtree import Snapshot, write_snapshot, box_distance, expanded
+from ga_spatialnosql.hilbert import extent_of
+from ga_spatialnosql.utils import relation_needs_intersection
+from ga_spatialnosql import app_settings as settings
+from logging import getLogger
+from itertools import islice
+from threading import local
+from hashlib import sha1
+import heapq
+import os
+
+log = getLogger(__name__)
+
+def _select_basic(function, method, filtered=True):
+    def selection(self, geom, srid=None, candidates=None, rows=False, after=None, limit=None):
+        geom = self._with_srid(geom, srid)
+        delta_select = lambda candidates, rows, after=None, limit=None: getattr(self.delta, method)(geom, candidates=candidates, rows=rows, after=after, limit=limit)
+        return self._query(function, geom, filtered, delta_select, candidates=candidates, rows=rows, after=after, limit=limit)
+
+    return selection
+
+class _SnapshotBulkLoad(BulkLoad):
+    def __init__(self, index, batch_size=50000):
+        BulkLoad.__init__(self, index.delta, batch_size)
+        self.snapshot_index = index
+
+    def __exit__(self, extype, ex, val):
+        BulkLoad.__exit__(self, extype, ex, val)
+        self.snapshot_index.merge()
+
+class _Pinned(object):
+    """Holds a thread to one snapshot, and one read transaction on the delta, until the outermost pin ends"""
+
+    def __init__(self, index):
+        self.index = index
+        self.transaction = index.delta.cursor()
+
+    def __enter__(self):
+        pins = self.index._pins
+        self.transaction.__enter__()
+        if not getattr(pins, 'depth', 0):
+            # the delta is read first: merge() writes its new snapshot before emptying the delta, so a delta from
+            # before a merge is seen with the snapshot from before or after it, and either is hidden correctly
+            try:
+                self.transaction.execute('select count(*) from snapshot_deleted').fetchone()
+                pins.snapshot = self.index._latest()
+            except:
+                self.transaction.__exit__(None, None, None)
+                raise
+            pins.depth = 0
+        pins.depth += 1
+        return self
+
+    def __exit__(self, extype, ex, val):
+        pins = self.index._pins
+        pins.depth -= 1
+        if not pins.depth:
+            pins.snapshot = None
+        self.transaction.__exit__(extype, ex, val)
+
+class SnapshotGeoIndex(object):
+    """GeoIndex backend for read-mostly collections served by many processes.  The bulk of the index is a static
+    packed Hilbert R-tree file that every process mmaps read-only, so they all share one copy in the page cache and
+    opening it costs nothing.  Writes go to a small SpatiaLite delta index beside it; deletes of snapshot rows are
+    recorded there as well.  merge() folds the delta into a new snapshot, which readers pick up on their next query."""
+
+    file_extension = '.snapshot'
+
+    def __init__(self, path, name, from_id, to_id, srid=4326, clear=False, cardinality=2, use_index=True, merge_threshold=None):
+        self.path = path
+        self.name = name
+        self.index_path = os.path.join(path, name + self.file_extension)
+        self._from_id = from_id
+        self._to_id = to_id
+        self.srid = srid
+        self.cardinality = cardinality
+        self.use_index = use_index
+        self.merge_threshold = merge_threshold or settings.SNAPSHOT_MERGE_THRESHOLD
+        self.last_load = None
+        self.snapshot = None
+        self._pins = local()
+
+        if clear:
+            self.drop()
+
+        self.delta = GeoIndex(path, name + '__delta', from_id, to_id, srid=srid, cardinality=cardinality, use_index=use_index)
+        self.open()
+
+    def open(self):
+        with self.delta.transaction() as c:
+            c.execute('create table if not exists snapshot_deleted (oid text unique not null primary key)')
+
+        if not os.path.exists(self.index_path):
+            # seed the first snapshot from the collection's SpatiaLite index if it has one
+            if os.path.exists(os.path.join(self.path, self.name + '.spatialite')):
+                source = GeoIndex(self.path, self.name, self._from_id, self._to_id, srid=self.srid)
+                source.export_snapshot(self.index_path)
+                source.close()
+            else:
+                write_snapshot(self.index_path, [], self.srid)
+
+        self.snapshot = Snapshot(self.index_path)
+
+    def close(self):
+        if self.snapshot:
+            self.snapshot.close()
+            self.snapshot = None
+        self.delta.close()
+
+    def discard(self):
+        pass # every write is committed as it is made, so nothing is held back to throw away
+
+    def drop(self):
+        if hasattr(self, 'delta'):
+            self.delta.drop()
+        else:
+            GeoIndex.destroy(self.path, self.name + '__delta')
+        if os.path.exists(self.index_path):
+            os.unlink(self.index_path)
+
+    @classmethod
+    def destroy(cls, path, name):
+        """Delete the stored snapshot and delta called name, without opening them"""
+        GeoIndex.destroy(path, name + '__delta')
+        index_path = os.path.join(path, name + cls.file_extension)
+        if os.path.exists(index_path):
+            os.unlink(index_path)
+
+    def clear(self):
+        write_snapshot(self.index_path, [], self.srid)
+        with self.delta.transaction() as c:
+            c.execute('delete from spatialindex_geometry')
+            c.execute('delete from snapshot_deleted')
+
+    def _latest(self):
+        if self.snapshot.changed():
+            # the previous snapshot is unmapped once the queries still pinned to it let go of it
+            self.snapshot = Snapshot(self.index_path)
+        return self.snapshot
+
+    def _current(self):
+        pinned = getattr(self._pins, 'snapshot', None)
+        return pinned if pinned is not None else self._latest()
+
+    def pinned(self):
+        """A context for the whole of a query that deals in row numbers, which merge() renumbers.  The thread keeps
+        the snapshot and the delta it started with until the context ends."""
+        return _Pinned(self)
+
+    def row_epoch(self):
+        return sha1(repr(self._current().identity)).hexdigest()[:12]
+
+    def _deleted(self):
+        with self.delta.cursor() as c:
+            c.execute('select oid from snapshot_deleted')
+            return set(row[0] for row in c)
+
+    def _hidden(self):
+        """Snapshot oids that are deleted or superseded by the delta"""
+        with self.delta.cursor() as c:
+            c.execute('select oid from spatialindex_geometry')
+            hidden = set(row[0] for row in c)
+        return hidden | self._deleted()
+
+    def _with_srid(self, geom, srid=None):
+        return self.delta._with_srid(geom, srid)
+
+    def envelopes(self, sample=None):
+        snapshot = self._current()
+        step = max(1, len(snapshot) // sample) if sample else 1
+        return [snapshot.extent(i) for i in xrange(0, len(snapshot), step)] + self.delta.envelopes(sample)
+
+    @property
+    def bounds(self):
+        extents = [self._current().tree.bounds, self.delta.bounds]
+        return extent_of(e for e in extents if e and None not in e)
+
+    def _snapshot_select(self, snapshot, function, geom, filtered=True, test=None, distance=None, candidates=None, after=None, ordered=False):
+        """Yield the numbers of snapshot items matching, out of the item numbers in candidates if it is given.  With
+        ordered, or after, they come out in increasing order and only those greater than after."""
+        extent = geom.extent
+        if candidates is not None:
+            if distance is not None:
+                candidates = (i for i in candidates if box_distance(extent, snapshot.extent(i)) <= distance)
+        elif distance is not None:
+            candidates = (i for i in snapshot.search(*expanded(extent, distance)) if box_distance(extent, snapshot.extent(i)) <= distance)
+        elif filtered and self.use_index:
+            candidates = snapshot.search(*extent)
+        else:
+            candidates = xrange(len(snapshot))
+
+        if ordered or after is not None:
+            candidates = sorted(i for i in candidates if after is None or i > after)
+
+        if function in ENVELOPE_PREDICATES:
+            envelope_test = ENVELOPE_PREDICATES[function]
+            for i in candidates:
+                if envelope_test(extent, snapshot.extent(i)):
+                    yield i
+        else:
+            test = test or PREDICATES[function]
+            prepared = geom.prepared
+            for i in candidates:
+                if test(geom, prepared, GEOSGeometry(snapshot.wkb(i), srid=self.srid)):
+                    yield i
+
+    def _query(self, function, geom, filtered, delta_select, test=None, distance=None, candidates=None, rows=False, after=None, limit=None):
+        # rows are snapshot item numbers, followed by delta rowids offset by the size of the snapshot.  They are only
+        # meaningful until the next merge(), unless the query is pinned().  Paging is always done in row order.
+        if rows or after is not None or limit:
+            if candidates is not None and not rows:
+                candidates = self.rows_of(candidates)
+            selected = self._select_rows(function, geom, filtered, delta_select, test, distance, candidates, after, limit)
+            return selected if rows else self.ids_of(selected)
+
+        if candidates is not None:
+            candidates = list(candidates)
+        return self._select(function, geom, filtered, delta_select(candidates, False), test, distance, candidates)
+
+    def _select_rows(self, function, geom, filtered, delta_select, test=None, distance=None, candidates=None, after=None, limit=None):
+        snapshot = self._current()
+        n = len(snapshot)
+        delta_candidates = None
+        if candidates is not None:
+            candidates = list(candidates)
+            delta_candidates = [row - n for row in candidates if row >= n]
+            candidates = [row for row in candidates if row < n]
+
+        found = 0
+        if after is None or after < n:
+            hidden = self._hidden()
+            for i in self._snapshot_select(snapshot, function, geom, filtered, test, distance, candidates, after, bool(limit)):
+                if snapshot.oid(i) not in hidden:
+                    yield i
+                    found += 1
+                    if found == limit:
+                        return
+
+        delta_after = after - n if after is not None and after >= n else None
+        for rowid in delta_select(delta_candidates, True, delta_after, limit and limit - found):
+            yield n + rowid
+
+    def all_rows(self):
+        snapshot = self._current()
+        hidden = self._hidden()
+        rows = [i for i in xrange(len(snapshot)) if snapshot.oid(i) not in hidden]
+        return rows + [len(snapshot) + rowid for rowid in self.delta.all_rows()]
+
+    def rows_of(self, oids):
+        snapshot = self._current()
+        hidden = self._hidden()
+        oids = list(oids)
+        rows = [snapshot.find(key) for key in (self._from_id(oid) for oid in oids) if key not in hidden]
+        return [i for i in rows if i is not None] + [len(snapshot) + rowid for rowid in self.delta.rows_of(oids)]
+
+    def ids_of(self, rows):
+        snapshot = self._current()
+        n = len(snapshot)
+        delta_rows = []
+        for row in rows:
+            if row < n:
+                yield self._to_id(snapshot.oid(row))
+            else:
+                delta_rows.append(row - n)
+        for oid in self.delta.ids_of(delta_rows):
+            yield oid
+
+    def _select(self, function, geom, filtered, delta_results, test=None, distance=None, candidates=None):
+        # the delta is small and always wins over the snapshot, which also hides rows that a concurrent merge() has
+        # already written into a new snapshot but not yet removed from the delta.
+        snapshot = self._current()
+        if candidates is not None:
+            candidates = [i for i in (snapshot.find(self._from_id(oid)) for oid in candidates) if i is not None]
+        seen = set()
+        for oid in delta_results:
+            seen.add(self._from_id(oid))
+            yield oid
+
+        deleted = self._deleted()
+        for i in self._snapshot_select(snapshot, function, geom, filtered, test, distance, candidates):
+            key = snapshot.oid(i)
+            if key not in seen and key not in deleted:
+                yield self._to_id(key)
+
+    def _in_snapshot(self, key):
+        with self.delta.cursor() as c:
+            c.execute('select 1 from snapshot_deleted where oid = ?', (key,))
+            if c.fetchone():
+                return False
+        return self._latest().find(key) is not None
+
+    def merge(self):
+        """Write a new snapshot holding the current snapshot plus the delta, then empty the delta.  Runs inside a
+        write transaction on the delta so concurrent writers wait for it."""
+        with self.delta.transaction() as c:
+            c.execute('BEGIN IMMEDIATE')  # take the write lock before reading the delta
+            # and the snapshot: a merge that held the lock first has already emptied the delta into a new one
+            snapshot = self._latest()
+            deleted = set(row[0] for row in c.execute('select oid from snapshot_deleted').fetchall())
+            delta_rows = c.execute('select oid, AsBinary(geom), MbrMinX(geom), MbrMinY(geom), MbrMaxX(geom), MbrMaxY(geom) from spatialindex_geometry').fetchall()
+            replaced = set(row[0] for row in delta_rows)
+
+            def rows():
+                for i in xrange(len(snapshot)):
+                    key = snapshot.oid(i)
+                    if key not in deleted and key not in replaced:
+                        yield key, snapshot.wkb(i), snapshot.extent(i)
+                for oid, wkb, xmin, ymin, xmax, ymax in delta_rows:
+                    yield oid, wkb, (xmin, ymin, xmax, ymax)
+
+            write_snapshot(self.index_path, rows(), self.srid)
+            c.execute('delete from spatialindex_geometry')
+            c.execute('delete from snapshot_deleted')
+
+        log.info('merged {n} delta rows and {d} deletes into {path}'.format(n=len(delta_rows), d=len(deleted), path=self.index_path))
+        self._latest()
+
+    def _maybe_merge(self):
+        if not self.delta._bulk_load and self.delta.count() >= self.merge_threshold:
+            self.merge()
+
+    def bulk_load(self, batch_size=50000):
+        return _SnapshotBulkLoad(self, batch_size)
+
+    def bulk_insert(self, oids_and_geoms):
+        self.delta.bulk_insert(oids_and_geoms)
+        self._maybe_merge()
+
+    def insert(self, oid, geom, srid=None):
+        if self._in_snapshot(self._from_id(oid)):
+            raise IntegrityError('{oid} is already in the index'.format(oid=oid))
+        self.delta.insert(oid, geom, srid)
+        self._maybe_merge()
+
+    def exists(self, oid):
+        return self.delta.exists(oid) or self._in_snapshot(self._from_id(oid))
+
+    def delete(self, oid):
+        self.bulk_delete([oid])
+
+    def bulk_delete(self, oids):
+        snapshot = self._latest()
+        keys = [self._from_id(oid) for oid in oids]
+        with self.delta.transaction() as c:
+            c.executemany('delete from spatialindex_geometry where oid=?', ((key,) for key in keys))
+            c.executemany('insert or ignore into snapshot_deleted (oid) values (?)', ((key,) for key in keys if snapshot.find(key) is not None))
+
+    def tombstone(self, oids):
+        # snapshot rows are only ever deleted by hiding them until the next merge
+        self.bulk_delete(oids)
+
+    def delete_region(self, geom, srid=None):
+        oids = list(self.intersects(geom, srid))
+        self.bulk_delete(oids)
+        return oids
+
+    def tombstones(self):
+        return len(self._deleted())
+
+    def compact(self, batch_size=None):
+        purged = self.tombstones()
+        self.merge()
+        return purged
+
+    def bulk_upsert(self, oids_and_geoms):
+        # replaced snapshot rows are hidden as deleted, and their new geometries go in the delta
+        oids_and_geoms = list(oids_and_geoms)
+        self.bulk_delete(oid for oid, geom in oids_and_geoms)
+        self.bulk_insert(oids_and_geoms)
+
+    def count(self, geom=None, srid=None):
+        if geom is None:
+            return len(self._current()) - len(self._deleted()) + self.delta.count()
+        geom = self._with_srid(geom, srid)
+        return sum(1 for _ in self.within(geom))
+
+    def relate(self, relation, geom, srid=None, candidates=None, rows=False, after=None, limit=None):
+        geom = self._with_srid(geom, srid)
+        test = lambda q, p, s: s.relate_pattern(q, relation)
+        delta_select = lambda candidates, rows, after=None, limit=None: self.delta.relate(relation, geom, candidates=candidates, rows=rows, after=after, limit=limit)
+        return self._query('relate', geom, relation_needs_intersection(relation), delta_select, test, candidates=candidates, rows=rows, after=after, limit=limit)
+
+    def dwithin(self, geom, distance, srid=None, candidates=None, rows=False, after=None, limit=None):
+        geom = self._with_srid(geom, srid)
+        test = lambda q, p, s: s.distance(q) <= distance
+        delta_select = lambda candidates, rows, after=None, limit=None: self.delta.dwithin(geom, distance, candidates=candidates, rows=rows, after=after, limit=limit)
+        return self._query('dwithin', geom, True, delta_select, test, distance, candidates, rows, after, limit)
+
+    def nearest(self, geom, k=None, srid=None, with_distance=False):
+        geom = self._with_srid(geom, srid)
+        snapshot = self._current()
+        hidden = self._hidden()
+
+        def distance(i):
+            if snapshot.oid(i) in hidden:
+                return None
+            return GEOSGeometry(snapshot.wkb(i), srid=self.srid).distance(geom)
+
+        # both sides come out in distance order, so merging them keeps it
+        from_snapshot = ((d, self._to_id(snapshot.oid(i))) for i, d in snapshot.tree.nearest(geom.extent, distance))
+        from_delta = ((d, oid) for oid, d in self.delta.nearest(geom, with_distance=True))
+        results = heapq.merge(from_delta, from_snapshot)
+        for d, oid in (islice(results, k) if k else results):
+            yield (oid, d) if with_distance else oid
+
+    bbcontains = _select_basic("mbrcontains", 'bbcontains')
+    bboverlaps = _select_basic('mbroverlaps', 'bboverlaps')
+    contains = _select_basic('contains', 'contains')
+    overlaps = _select_basic('overlaps', 'overlaps')
+    contained = _select_basic('contained', 'contained')
+    containsproperly = _select_basic('containsproperly', 'containsproperly')
+    coveredby = _select_basic('coveredby', 'coveredby')
+    covers = _select_basic('covers', 'covers')
+    crosses = _select_basic('crosses', 'crosses')
+    disjoint = _select_basic('disjoint', 'disjoint', filtered=False)
+    equals = _select_basic('equals', 'equals')
+    exact =  _select_basic('exact', 'exact')
+    intersects = _select_basic('intersects', 'intersects')
+    touches = _select_basic('touches', 'touches')
+    within = _select_basic('within', 'within')
@@ -1 +1,149 @@
 __author__ = 'jeff'
+
+from ga_spatialnosql.models import IngestJob
+from ga_spatialnosql.db.mongo import open_collection
+from ga_spatialnosql.ogr_import import import_datasource, mongo_connection, extract
+from ga_spatialnosql import app_settings
+from django.conf import settings
+from django.db import connection, transaction
+from django.core.signals import request_started
+from django.utils import timezone
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from tempfile import NamedTemporaryFile
+from logging import getLogger
+import traceback
+import shutil
+import socket
+import errno
+import time
+import os
+
+log = getLogger(__name__)
+
+# Imports run on a pool of worker threads in this process rather than in the request that submitted them.  The job
+# record in the database is the only thing the request and the worker share, so its status can be read from any
+# process.  Each job records the process whose pool holds it; a job left queued or running by a process on this host
+# that has since stopped is picked up again when the pool starts, which it does on the process's first request.
+
+_pool = None
+_pool_lock = Lock()
+
+def _workers():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(app_settings.INGEST_WORKERS)
+            try:
+                recover(_pool)
+            except Exception:
+                log.exception('could not recover ingest jobs left by stopped processes')
+        return _pool
+
+def _start(sender, **kwargs):
+    request_started.disconnect(_start, dispatch_uid='ga_spatialnosql.tasks.start')
+    _workers()
+
+request_started.connect(_start, dispatch_uid='ga_spatialnosql.tasks.start')
+
+def _worker_name():
+    return '{host}:{pid}'.format(host=socket.gethostname(), pid=os.getpid())
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def recover(pool):
+    """Queue again, on pool, the jobs that processes on this host left queued or running when they stopped.  Jobs
+    whose upload is gone are marked failed."""
+    host = socket.gethostname()
+    for job in IngestJob.objects.filter(status__in=(IngestJob.QUEUED, IngestJob.RUNNING), worker__startswith=host + ':'):
+        pid = job.worker.rsplit(':', 1)[1]
+        if not pid.isdigit() or _alive(int(pid)):
+            continue
+        # processes starting together may both find the job; only the one whose update lands takes it
+        if not IngestJob.objects.filter(pk=job.pk, worker=job.worker).update(worker=_worker_name(), status=IngestJob.QUEUED):
+            continue
+        if os.path.exists(job.source):
+            log.warning('requeueing {job}, left by stopped process {worker}'.format(job=job, worker=job.worker))
+            pool.apply_async(run_job, (job.pk, job.source))
+        else:
+            IngestJob.objects.filter(pk=job.pk).update(status=IngestJob.FAILED, error='the process running the import stopped, and its upload is gone', finished=timezone.now())
+
+def spool(chunks, suffix=''):
+    """Write an upload's chunks to a file in the spool directory that outlives the request, and return its path"""
+    f = NamedTemporaryFile(dir=app_settings.INGEST_SPOOL_PATH, suffix=suffix, delete=False)
+    with f:
+        for c in chunks:
+            f.write(c)
+    return f.name
+
+def submit(job):
+    """Queue a saved IngestJob on the worker pool.  Workers read the job through their own database connections, so
+    it is only queued once the transaction that saved it has committed."""
+    IngestJob.objects.filter(pk=job.pk).update(worker=_worker_name())
+    queue = lambda: _workers().apply_async(run_job, (job.pk, job.source))
+    if hasattr(transaction, 'on_commit'): # Django 1.9 and later
+        transaction.on_commit(queue)
+    else:
+        if transaction.is_managed():
+            transaction.commit()
+        queue()
+    return job
+
+def _reporter(job, total=None):
+    """A progress callback that records rows and progress on the job, at most once every INGEST_PROGRESS_INTERVAL"""
+    last = [0.0]
+
+    def report(stats):
+        now = time.time()
+        if now - last[0] < app_settings.INGEST_PROGRESS_INTERVAL:
+            return
+        last[0] = now
+        if total:
+            progress = float(stats['bytes']) / total
+        else:
+            progress = float(stats['features']) / stats['total'] if stats.get('total') else 0.0
+        IngestJob.objects.filter(pk=job.pk).update(rows=stats['features'], progress=min(progress, 1.0))
+    return report
+
+def _run_geojson(job):
+    db = mongo_connection()[job.database]
+    # through the registry, so requests in this process query the handle being loaded rather than one left over
+    collection = open_collection(db, job.collection, index_path=settings.INDEX_PATH, srid=job.srid, clear=True)
+    return collection.insert_stream(job.source, bulk_load=True, progress=_reporter(job, os.path.getsize(job.source)))['features']
+
+def _run_ogr(job):
+    path, dir = extract(job.source, job.source_name, job.master_file)
+    try:
+        return sum(layer['features'] for layer in import_datasource(job.database, path, job.collection, job.srid, progress=_reporter(job)))
+    finally:
+        if dir:
+            shutil.rmtree(dir)
+
+def run_job(job_id, source=None):
+    """Run the IngestJob job_id, whose upload is spooled at source.  Nothing a job does is raised from here: the pool
+    discards what its workers return, so failures are logged and recorded on the job."""
+    job = None
+    try:
+        job = IngestJob.objects.get(pk=job_id)
+        source = job.source
+        IngestJob.objects.filter(pk=job.pk).update(status=IngestJob.RUNNING, started=timezone.now())
+        rows = (_run_ogr if job.kind == IngestJob.OGR else _run_geojson)(job)
+        IngestJob.objects.filter(pk=job.pk).update(status=IngestJob.DONE, rows=rows, progress=1.0, finished=timezone.now())
+        log.info('{job} finished with {rows} rows'.format(job=job, rows=rows))
+    except IngestJob.DoesNotExist:
+        log.error('ingest job {id} was deleted before it could run'.format(id=job_id))
+    except Exception:
+        log.exception('{job} failed'.format(job=job or job_id))
+        if job is not None:
+            IngestJob.objects.filter(pk=job.pk).update(status=IngestJob.FAILED, error=traceback.format_exc(), finished=timezone.now())
+    finally:
+        try:
+            if source and os.path.exists(source):
+                os.unlink(source)
+        finally:
+            connection.close() # worker threads each hold their own database connection
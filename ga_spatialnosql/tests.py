@@ -6,13 +6,46 @@ Replace this with more appropriate tests for your application.
 """
 
 from django.test import TestCase
-from unittest import skip
-from ga_spatialnosql.db.mongo import GeoJSONCollection
-from ga_spatialnosql.index import GeoIndex
-from django.contrib.gis.geos import Polygon
-from pyspatialite.dbapi2 import IntegrityError
+from django.test.client import RequestFactory
+from unittest import skip, skipUnless
+from ga_spatialnosql.db.mongo import GeoJSONCollection, ValidationError, open_collection, _touches_geometry, GEOMETRY_HASH
+from ga_spatialnosql.memindex import MemoryGeoIndex
+from ga_spatialnosql.rtree import PackedRTree, Snapshot, write_snapshot
+from ga_spatialnosql.planner import EnvelopeHistogram, QueryPlanner
+from ga_spatialnosql.hilbert import hilbert_index, hilbert_sort
+from ga_spatialnosql.bitmap import Bitmap
+from ga_spatialnosql.wkb import geojson_to_wkb, is_empty, WKBGeometry, encode_geometries
+from ga_spatialnosql.reproject import reproject_geojson
+from ga_spatialnosql.ingest import FeatureReader
+from ga_spatialnosql.querycache import QueryCache, normalized, write_generation, wrote
+from ga_spatialnosql.ogr_import import normalize
+from ga_spatialnosql.models import IngestJob
+from ga_spatialnosql.tasks import spool, run_job, recover
+from ga_spatialnosql import permissions
+from django.contrib.auth.models import User, AnonymousUser
+from django.utils import timezone
+from datetime import timedelta
+from ga_spatialnosql.api import _stream_features, _features_response, STREAM_FORMATS
+from django.contrib.gis.geos import GEOSGeometry, Polygon, Point
+from StringIO import StringIO
+from threading import Thread
 import pymongo
+import socket
+import fcntl
 import json
+import os
+
+try:
+    from pyspatialite.dbapi2 import IntegrityError
+    from ga_spatialnosql.index import GeoIndex
+    from ga_spatialnosql.snapshot import SnapshotGeoIndex
+    SPATIALITE = True
+except ImportError:
+    SPATIALITE = False
+
+def setUpModule():
+    if not os.path.isdir('./test_indices'):
+        os.makedirs('./test_indices')
 
 poly0 = Polygon( ((1000,1000), (1000, 1001), (1001, 1001), (1001, 1000), (1000, 1000)) )
 poly1 = Polygon( ((0.0, 0.0), (0.0, 50.0), (50.0, 50.0), (50.0, 0.0), (0.0, 0.0)) )
@@ -122,12 +155,633 @@ class GeoIndexTests(TestCase):
         except IntegrityError:
             pass
 
+        self.assertRaises(IntegrityError, ix.bulk_insert, [(2, poly1), (2, poly1)])
+        self.assertFalse(ix.exists(2)) # the batch was rolled back whole
+
         ix.drop()
 
-mongo = pymongo.Connection()
+@skipUnless(SPATIALITE, 'needs pyspatialite')
+class SpatialiteIndexTests(TestCase):
+    def test_index_filter_matches_scan(self):
+        ix = GeoIndex('./test_indices', 'test_index_filter', int, int, clear=True)
+        ix.bulk_insert([(1, poly1), (2, poly2), (3, poly3)])
+
+        for use_index in (False, True):
+            ix.use_index = use_index
+            self.assertEqual(sorted(ix.intersects(poly1)), [1,2,3])
+            self.assertEqual(sorted(ix.disjoint(poly0)), [1,2,3], "disjoint must not be limited to the query MBR")
+            self.assertEqual(list(ix.relate('T********', poly0)), [])
+            self.assertEqual(ix.count(cover), 3)
+
+        ix.drop()
+
+    def test_nearest(self):
+        ix = GeoIndex('./test_indices', 'test_nearest', int, int, clear=True)
+        ix.bulk_insert([(1, poly1), (2, poly2), (3, poly3), (4, poly0)])
+
+        self.assertEqual(list(ix.nearest(Point(200, 200), k=2)), [3, 1])
+        self.assertEqual(list(ix.nearest(Point(-20, -20))), [2, 1, 3, 4])
+        distances = [d for _, d in ix.nearest(Point(-20, -20), with_distance=True)]
+        self.assertEqual(distances, sorted(distances))
+
+        ix.drop()
+
+    def test_dwithin(self):
+        ix = GeoIndex('./test_indices', 'test_dwithin', int, int, clear=True)
+        ix.bulk_insert([(1, poly1), (2, poly2), (3, poly3), (4, poly0)])
+
+        self.assertEqual(sorted(ix.dwithin(Point(160, 100), 10)), [3])
+        self.assertEqual(sorted(ix.dwithin(Point(160, 100), 10.5)), [3])
+        self.assertEqual(sorted(ix.dwithin(Point(-60, 0), 10)), [2])
+        self.assertEqual(sorted(ix.dwithin(Point(170, 170), 25)), [])
+
+        ix.drop()
+
+    def test_drop(self):
+        ix = GeoIndex('./test_indices', 'test_drop', int, int, clear=True)
+        ix.bulk_insert([(1, poly1)])
+        list(ix.within(cover)) # leaves a reader connection open
+        self.assertTrue(os.path.exists(ix.index_path + '-wal'))
+
+        ix.drop()
+        for suffix in ('', '-wal', '-shm'):
+            self.assertFalse(os.path.exists(ix.index_path + suffix))
+        self.assertEqual(GeoIndex('./test_indices', 'test_drop', int, int).count(), 0)
+        GeoIndex.destroy('./test_indices', 'test_drop')
+
+    def test_envelopes(self):
+        ix = GeoIndex('./test_indices', 'test_envelopes', int, int, clear=True)
+        ix.bulk_insert([(1, poly1), (2, poly2), (3, poly3)])
+        ix.tombstone([2])
+        self.assertEqual(sorted(ix.envelopes()), sorted(tuple(float(v) for v in p.extent) for p in (poly1, poly3)))
+
+        with ix.bulk_load() as load: # which drops the R-tree until it ends
+            load.insert([(4, poly0)])
+            self.assertEqual(len(ix.envelopes()), 2)
+            self.assertEqual(len(ix.bounds), 4)
+        self.assertEqual(len(ix.envelopes()), 3)
+        ix.drop()
+
+    def test_candidates(self):
+        ix = GeoIndex('./test_indices', 'test_candidates', int, int, clear=True)
+        ix.bulk_insert([(1, poly1), (2, poly2), (3, poly3)])
+
+        self.assertEqual(sorted(ix.within(cover, candidates=[1, 3, 4])), [1,3])
+        self.assertEqual(sorted(ix.disjoint(poly0, candidates=[2])), [2])
+        self.assertEqual(sorted(ix.dwithin(Point(160, 100), 10, candidates=[1, 2])), [])
+        self.assertEqual(list(ix.within(cover, candidates=[])), [])
+        self.assertEqual(len(ix.envelopes()), 3)
+
+        rows = ix.rows_of(range(1, 600))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(sorted(ix.within(cover, candidates=range(1, 600))), [1,2,3], "long candidate lists go through a temp table")
+        self.assertEqual(list(ix.ids_of(sorted(ix.intersects(poly3, candidates=rows, rows=True)))), [1,3])
+
+        first, second = sorted(ix.within(cover, rows=True))[:2]
+        self.assertEqual(list(ix.within(cover, rows=True, limit=1)), [first])
+        self.assertEqual(list(ix.within(cover, rows=True, after=first, limit=1)), [second])
+
+        ix.drop()
+
+    def test_bulk_load(self):
+        ix = GeoIndex('./test_indices', 'test_bulk_load', int, int, clear=True, group_commit=False)
+        boxes = [Polygon(((i, i), (i, i + 1), (i + 1, i + 1), (i + 1, i), (i, i))) for i in range(300)]
+        with ix.bulk_load(batch_size=64) as loader:
+            loader.insert((oid, boxes[oid]) for oid in reversed(range(300)))
+        self.assertEqual(ix.last_load['rows'], 300)
+
+        with ix.cursor() as c: # both indices dropped for the load are back, and the R-tree holds every row
+            c.execute("select name from sqlite_master where name in ('idx_spatialindex_geometry_geom', 'forward_index')")
+            self.assertEqual(sorted(name for name, in c.fetchall()), ['forward_index', 'idx_spatialindex_geometry_geom'])
+            c.execute('select count(*) from idx_spatialindex_geometry_geom')
+            self.assertEqual(c.fetchone()[0], 300)
+
+        ix.use_index = True
+        window = Polygon(((9.5, 9.5), (9.5, 20.5), (20.5, 20.5), (20.5, 9.5), (9.5, 9.5)))
+        self.assertEqual(sorted(ix.within(window)), range(10, 20))
+        self.assertEqual(ix.count(), 300)
+        self.assertTrue(ix.exists(150))
+        self.assertRaises(IntegrityError, ix.insert, 150, boxes[150])
+        ix.insert(300, poly0) # and the triggers keep the R-tree up to date after the load
+        self.assertEqual(list(ix.equals(poly0)), [300])
+        ix.drop()
+
+    def test_group_commit(self):
+        ix = GeoIndex('./test_indices', 'test_group_commit', int, int, clear=True, group_commit=True)
+        boxes = [Polygon(((i, i), (i, i + 1), (i + 1, i + 1), (i + 1, i), (i, i))) for i in range(200)]
+
+        def write(part):
+            for oid in part:
+                ix.insert(oid, boxes[oid])
+        writers = [Thread(target=write, args=(range(k, 200, 8),)) for k in range(8)]
+        for w in writers:
+            w.start()
+        for w in writers:
+            w.join()
+
+        self.assertEqual(ix.count(), 200)
+        self.assertRaises(IntegrityError, ix.insert, 0, boxes[0])
+        ix.delete(0)
+        self.assertEqual(ix.count(), 199)
+        ix.drop()
+
+    def test_bulk_load_holds_writes(self):
+        ix = GeoIndex('./test_indices', 'test_bulk_load_writes', int, int, clear=True, group_commit=True)
+        writer = Thread(target=ix.insert, args=(1000, poly0))
+        with ix.bulk_load() as loader:
+            writer.start() # a group commit would go through the writer while it runs without fsyncs
+            writer.join(0.5)
+            self.assertTrue(writer.is_alive())
+            loader.insert([(1, poly1)])
+        writer.join()
+
+        self.assertEqual(ix.count(), 2)
+        self.assertNotEqual(ix.db.execute('PRAGMA synchronous').fetchone()[0], 0) # back to fsyncing
+        ix.drop()
+
+    def test_tombstones(self):
+        ix = GeoIndex('./test_indices', 'test_tombstones', int, int, clear=True, group_commit=False)
+        boxes = [Polygon(((i, i), (i, i + 1), (i + 1, i + 1), (i + 1, i), (i, i))) for i in range(100)]
+        ix.bulk_insert((oid, boxes[oid]) for oid in range(100))
+
+        ix.tombstone(range(0, 10))
+        self.assertEqual(ix.count(), 90)
+        self.assertFalse(ix.exists(0))
+        self.assertEqual(list(ix.intersects(boxes[5])), [])
+        ix.insert(0, boxes[0]) # a tombstoned id can be reused
+        self.assertTrue(ix.exists(0))
+
+        region = Polygon(((50.5, 50.5), (50.5, 59.5), (59.5, 59.5), (59.5, 50.5), (50.5, 50.5)))
+        self.assertEqual(sorted(ix.delete_region(region)), range(50, 60))
+        self.assertEqual(ix.count(), 81)
+        self.assertEqual(ix.tombstones(), 19)
+
+        self.assertEqual(ix.compact(batch_size=4), 19)
+        self.assertEqual(ix.tombstones(), 0)
+        self.assertEqual(ix.count(), 81)
+        ix.drop()
+
+    def test_concurrent_reads(self):
+        ix = GeoIndex('./test_indices', 'test_concurrent_reads', int, int, clear=True, group_commit=False)
+        boxes = [Polygon(((i, i), (i, i + 1), (i + 1, i + 1), (i + 1, i), (i, i))) for i in range(400)]
+        ix.bulk_insert((oid, boxes[oid]) for oid in range(200))
+        everything = Polygon(((-1, -1), (-1, 500), (500, 500), (500, -1), (-1, -1)))
+        counts = []
+
+        def read():
+            for _ in range(20):
+                with ix.cursor(): # one snapshot, so the writer can't change the count between the two reads
+                    counts.append((ix.count(), len(list(ix.within(everything)))))
+        readers = [Thread(target=read) for k in range(8)]
+        for r in readers:
+            r.start()
+        for oid in range(200, 400):
+            ix.insert(oid, boxes[oid])
+        for r in readers:
+            r.join()
+
+        self.assertEqual(len(counts), 160)
+        self.assertTrue(all(n == m and 200 <= n <= 400 for n, m in counts))
+        self.assertEqual(ix.count(), 400)
+        ix.drop()
+
+class EnvelopeHistogramTests(TestCase):
+    def test_estimate(self):
+        envelopes = [(float(x), float(y), x + 1.0, y + 1.0) for x in range(100) for y in range(100)]
+        histogram = EnvelopeHistogram(envelopes, cells=10)
+
+        self.assertEqual(histogram.estimate((-10, -10, 110, 110)), 10000)
+        self.assertEqual(histogram.estimate((500, 500, 600, 600)), 0)
+        self.assertTrue(2000 < histogram.estimate((0, 0, 49, 49)) < 3000)
+        self.assertEqual(EnvelopeHistogram([]).estimate((0, 0, 1, 1)), 0)
+
+class QueryPlannerTests(TestCase):
+    def test_statistics_wear_out(self):
+        ix = MemoryGeoIndex('./test_indices', 'test_planner', int, int, clear=True)
+        ix.bulk_insert((i, Polygon(((i, 0), (i, 1), (i + 1, 1), (i + 1, 0), (i, 0)))) for i in range(100))
+        planner = QueryPlanner(ix, None, ttl=300, stale_fraction=0.1)
+        histogram = planner.histogram()
+
+        planner.wrote(10)
+        self.assertIs(planner.histogram(), histogram) # writes up to the fraction leave the statistics be
+        planner.wrote()
+        self.assertIsNot(planner.histogram(), histogram)
+        ix.drop()
+
+class HilbertTests(TestCase):
+    def test_index(self):
+        # the first order curve visits the cells of a 2x2 grid up, across and back down
+        self.assertEqual([hilbert_index(x, y, 1) for x, y in ((0, 0), (0, 1), (1, 1), (1, 0))], [0, 1, 2, 3])
+        self.assertEqual(sorted(hilbert_index(x, y, 3) for x in range(8) for y in range(8)), range(64))
+
+    def test_sort(self):
+        corners = [('c', (2, 2, 2, 2)), ('a', (0, 0, 0, 0)), ('d', (2, 0, 2, 0)), ('b', (0, 2, 0, 2))]
+        extent = lambda (name, e): e
+        self.assertEqual([name for name, _ in hilbert_sort(corners, extent, order=1)], ['a', 'b', 'c', 'd'])
+        self.assertEqual([name for name, _ in hilbert_sort(corners, extent)], ['a', 'b', 'c', 'd'])
+        self.assertEqual(hilbert_sort([], extent), [])
+
+class BitmapTests(TestCase):
+    def test_set_operations(self):
+        a = Bitmap.from_rows([1, 5, 9, 1000])
+        b = Bitmap.from_rows([5, 1000, 2000])
+
+        self.assertEqual(list(a), [1, 5, 9, 1000])
+        self.assertEqual(list(a & b), [5, 1000])
+        self.assertEqual(list(a | b), [1, 5, 9, 1000, 2000])
+        self.assertEqual(list(a - b), [1, 9])
+        self.assertEqual(len(a), 4)
+        self.assertTrue(9 in a and 10 not in a)
+        self.assertFalse(Bitmap.from_rows([]))
+
+class WKBTests(TestCase):
+    def test_matches_geos(self):
+        geometries = [
+            json.loads(poly1.json),
+            {'type' : 'MultiPolygon', 'coordinates' : [json.loads(poly2.json)['coordinates'], json.loads(poly3.json)['coordinates']]},
+            {'type' : 'GeometryCollection', 'geometries' : [json.loads(Point(3, 4).json), {'type' : 'LineString', 'coordinates' : [[0, 0], [2, 7]]}]},
+        ]
+        for g in geometries:
+            wkb, extent = geojson_to_wkb(g)
+            geom = GEOSGeometry(json.dumps(g))
+            self.assertTrue(GEOSGeometry(buffer(wkb)).equals_exact(geom))
+            self.assertEqual(extent, geom.extent)
+
+        self.assertEqual(WKBGeometry.from_geojson(geometries[0], 4326).geos.srid, 4326)
+        self.assertRaises(ValueError, geojson_to_wkb, {'type' : 'Circle', 'coordinates' : [0, 0]})
+
+    def test_mixed_dimensions(self):
+        flat = geojson_to_wkb({'type' : 'LineString', 'coordinates' : [[0, 0], [1, 1], [2, 3]]})
+        self.assertEqual(geojson_to_wkb({'type' : 'LineString', 'coordinates' : [[0, 0], [1, 1, 5], [2, 3]]}), flat)
+        self.assertEqual(geojson_to_wkb({'type' : 'LineString', 'coordinates' : [[0, 0, 5], [1, 1], [2, 3]]}), flat)
+
+    def test_empty(self):
+        empties = [
+            {'type' : 'Point', 'coordinates' : []},
+            {'type' : 'MultiPolygon', 'coordinates' : [[], [[]]]},
+            {'type' : 'GeometryCollection', 'geometries' : [{'type' : 'LineString', 'coordinates' : []}]},
+        ]
+        for g in empties:
+            self.assertTrue(is_empty(g))
+            self.assertRaises(ValueError, geojson_to_wkb, g)
+        self.assertFalse(is_empty({'type' : 'MultiPolygon', 'coordinates' : [[], json.loads(poly1.json)['coordinates']]}))
+
+    def test_parallel(self):
+        geometries = [json.loads(Point(i, -i).json) for i in range(50)] + [poly1]
+        serial = list(encode_geometries(geometries, 4326))
+        parallel = list(encode_geometries(geometries, 4326, processes=2, batch_size=8))
+
+        self.assertEqual([str(g.wkb) for g in parallel[:-1]], [str(g.wkb) for g in serial[:-1]])
+        self.assertEqual([g.extent for g in parallel[:-1]], [(i, -i, i, -i) for i in range(50)])
+        self.assertTrue(parallel[-1] is poly1)
+
+class ReprojectTests(TestCase):
+    def test_matches_geos(self):
+        geometries = [json.loads(poly1.json), {'type' : 'GeometryCollection', 'geometries' : [json.loads(Point(3, 4).json)]}]
+        reproject_geojson(geometries, 4326, 3857)
+
+        expected = GEOSGeometry(poly1.wkt, 4326).transform(3857, clone=True)
+        self.assertTrue(GEOSGeometry(json.dumps(geometries[0])).equals_exact(expected, 1e-6))
+        self.assertTrue(GEOSGeometry(json.dumps(geometries[1])).equals_exact(Point(3, 4, srid=4326).transform(3857, clone=True), 1e-6))
+
+class FeatureReaderTests(TestCase):
+    def test_read(self):
+        features = [{'type' : 'Feature', 'geometry' : json.loads(Point(i, i).json), 'properties' : {'n' : i}} for i in range(10)]
+        document = json.dumps({'type' : 'FeatureCollection', 'crs' : 'EPSG:3857', 'features' : features, 'name' : 'points'}, indent=2)
+
+        reader = FeatureReader(StringIO(document), read_size=16)
+        self.assertEqual(list(reader), features)
+        self.assertEqual(reader.properties['crs'], 'EPSG:3857')
+        self.assertEqual(reader.properties['name'], 'points')
+        self.assertEqual(reader.position, len(document))
+
+        sequence = ''.join('\x1e' + json.dumps(f) + '\n' for f in features)
+        self.assertEqual(list(FeatureReader(StringIO(sequence), read_size=16)), features)
+        self.assertRaises(ValueError, list, FeatureReader(StringIO('{"type": "FeatureCollection", "features": [{"a": 1},')))
+
+class UpdateTests(TestCase):
+    def test_touches_geometry(self):
+        self.assertFalse(_touches_geometry({'$set' : {'properties.name' : 'x'}, '$inc' : {'properties.n' : 1}}))
+        self.assertTrue(_touches_geometry({'$set' : {'geometry.coordinates' : [0, 0]}}))
+        self.assertTrue(_touches_geometry({'$rename' : {'properties.shape' : 'geometry'}}))
+        self.assertTrue(_touches_geometry({'$unset' : {'crs' : 1}}))
+        self.assertTrue(_touches_geometry({'type' : 'Feature', 'properties' : {}}))
+
+class QueryCacheTests(TestCase):
+    def _put(self, cache, key, documents):
+        collector = cache.collector()
+        for doc in documents:
+            collector.add(doc)
+        cache.put(key, collector, None)
+
+    def test_lru(self):
+        cache = QueryCache(max_entries=2, max_bytes=1024 * 1024, max_result_bytes=1024, ttl=60)
+        self._put(cache, 'a', [{'n' : 1}])
+        self._put(cache, 'b', [{'n' : 2}])
+        self.assertEqual(cache.get('a'), ([{'n' : 1}], None))
+        self._put(cache, 'c', [{'n' : 3}]) # evicts b, the least recently used
+        self.assertIsNone(cache.get('b'))
+
+        documents, _ = cache.get('a')
+        documents[0]['n'] = 10 # hits decode their own copies
+        self.assertEqual(cache.get('a'), ([{'n' : 1}], None))
+
+        self._put(cache, 'big', [{'s' : 'x' * 2048}]) # too big to cache
+        self.assertIsNone(cache.get('big'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['hits'], 3)
+
+    def test_bytes(self):
+        cache = QueryCache(max_entries=100, max_bytes=300, max_result_bytes=200, ttl=60)
+        for key in range(5):
+            self._put(cache, key, [{'s' : 'x' * 100}])
+        self.assertEqual(cache.stats()['entries'], 2)
+        self.assertTrue(cache.stats()['bytes'] <= 300)
+
+    def test_generations(self):
+        collection = ('test', 'test_generations', 1)
+        before = write_generation(collection)
+        wrote(collection)
+        self.assertEqual(write_generation(collection), before + 1)
+        self.assertEqual(write_generation(('test', 'test_generations', 2)), 0)
+
+    def test_normalized(self):
+        self.assertEqual(normalized({'$within' : [Polygon(poly1.coords)]}), normalized({'$within' : [poly1]}))
+        self.assertNotEqual(normalized({'$within' : [poly1]}), normalized({'$within' : [poly2]}))
+
+class OGRImportTests(TestCase):
+    def test_normalize(self):
+        self.assertEqual(normalize('Roads 2012'), 'roads_2012')
+        self.assertEqual(normalize('10% sample'), 'x10pct_sample')
+        self.assertEqual(normalize('_parcels__'), 'x_parcels')
+
+class PermissionTests(TestCase):
+    def test_allowed(self):
+        owner, other, anonymous = User(pk=1, username='owner'), User(pk=2, username='other'), AnonymousUser()
+        rules = {'read' : permissions.ALL, 'write' : permissions.OWNER, 'delete' : ['user:other', 'group:editors']}
+
+        self.assertTrue(permissions.allowed(rules, 'read', anonymous, 'owner', frozenset()))
+        self.assertTrue(permissions.allowed(rules, 'write', owner, 'owner', frozenset()))
+        self.assertFalse(permissions.allowed(rules, 'write', other, 'owner', frozenset()))
+        self.assertTrue(permissions.allowed(rules, 'write', other, 'owner', frozenset([permissions.ADMIN_GROUP])))
+        self.assertTrue(permissions.allowed(rules, 'delete', other, 'owner', frozenset()))
+        self.assertFalse(permissions.allowed(rules, 'delete', owner, 'owner', frozenset()))
+        self.assertTrue(permissions.allowed(rules, 'delete', User(pk=3, username='third'), 'owner', frozenset(['editors'])))
+
+    def test_cache(self):
+        loads = []
+        def rules():
+            loads.append(1)
+            return {'read' : permissions.OWNER}
+        user = AnonymousUser()
+
+        self.assertFalse(permissions.check(user, 'read', 'owner', 'cached', rules))
+        self.assertFalse(permissions.check(user, 'read', 'owner', 'cached', rules))
+        self.assertEqual(len(loads), 1)
+        permissions.invalidate('owner', 'cached')
+        permissions.check(user, 'read', 'owner', 'cached', rules)
+        self.assertEqual(len(loads), 2)
+
+    def test_cache_bounded(self):
+        cache = permissions._TTLCache(max_entries=2)
+        for key in 'abc':
+            cache.get(key, lambda: key)
+        self.assertEqual(list(cache._entries), ['b', 'c'])
+        self.assertEqual(cache.get('a', lambda: 'again'), 'again') # dropped, so computed again
+        self.assertEqual(list(cache._entries), ['c', 'a'])
+
+class IngestJobTests(TestCase):
+    def test_status(self):
+        job = IngestJob(kind=IngestJob.GEOJSON, status=IngestJob.RUNNING, rows=5000, progress=0.25, started=timezone.now() - timedelta(seconds=10))
+        self.assertTrue(450 < job.rows_per_second <= 500)
+        self.assertTrue(29 < job.eta < 32)
+
+        job.status = IngestJob.DONE
+        self.assertEqual(job.eta, None)
+        self.assertEqual(IngestJob(status=IngestJob.QUEUED).rows_per_second, 0.0)
+
+    def job(self, **kwargs):
+        user = User.objects.create(username='ingest_{n}'.format(n=User.objects.count()))
+        return IngestJob.objects.create(user=user, kind=IngestJob.GEOJSON, source=spool(['{}'], suffix='.json'), database='test', collection='test_ingest', srid=4326, **kwargs)
+
+    def test_missing_job(self):
+        job = self.job()
+        job.delete()
+        worker = Thread(target=run_job, args=(job.pk, job.source)) # as the pool runs it, since it closes its db connection
+        worker.start()
+        worker.join()
+        self.assertFalse(os.path.exists(job.source))
+
+    def test_recover(self):
+        stopped = '{host}:{pid}'.format(host=socket.gethostname(), pid=2**31 - 1)
+        kept = self.job(status=IngestJob.RUNNING, worker=stopped)
+        lost = self.job(status=IngestJob.QUEUED, worker=stopped)
+        os.unlink(lost.source)
+        live = self.job(status=IngestJob.RUNNING, worker='{host}:{pid}'.format(host=socket.gethostname(), pid=os.getpid()))
+
+        queued = []
+        class Pool(object):
+            def apply_async(self, function, args):
+                queued.append(args)
+        recover(Pool())
+
+        self.assertEqual(queued, [(kept.pk, kept.source)])
+        self.assertEqual(IngestJob.objects.get(pk=kept.pk).status, IngestJob.QUEUED)
+        self.assertEqual(IngestJob.objects.get(pk=lost.pk).status, IngestJob.FAILED)
+        self.assertEqual(IngestJob.objects.get(pk=live.pk).status, IngestJob.RUNNING)
+        os.unlink(kept.source)
+        os.unlink(live.source)
+
+class PackedRTreeTests(TestCase):
+    def test_search_matches_scan(self):
+        extents = [(float(x), float(y), x + 1.5, y + 1.5) for x in range(0, 100, 3) for y in range(0, 100, 7)]
+        tree = PackedRTree.build(extents)
+        for query in ((0, 0, 10, 10), (50, 50, 50, 50), (-10, -10, -1, -1), (0, 0, 200, 200)):
+            expected = [i for i, e in enumerate(extents) if e[0] <= query[2] and e[1] <= query[3] and e[2] >= query[0] and e[3] >= query[1]]
+            self.assertEqual(sorted(tree.search(*query)), expected)
+
+    def test_snapshot_round_trip(self):
+        rows = [('oid{i}'.format(i=i), 'wkb{i}'.format(i=i), (float(i), float(i), i + 1.0, i + 1.0)) for i in range(100)]
+        write_snapshot('./test_indices/test_round_trip.snapshot', rows, 4326)
+        snapshot = Snapshot('./test_indices/test_round_trip.snapshot')
+
+        self.assertEqual(len(snapshot), 100)
+        i = snapshot.find('oid42')
+        self.assertEqual(str(snapshot.wkb(i)), 'wkb42')
+        self.assertEqual(tuple(snapshot.extent(i)), (42.0, 42.0, 43.0, 43.0))
+        self.assertEqual(sorted(snapshot.oid(i) for i in snapshot.search(10.5, 10.5, 11.5, 11.5)), ['oid10', 'oid11'])
+        self.assertEqual(snapshot.find('missing'), None)
+        snapshot.close()
+
+@skipUnless(SPATIALITE, 'needs pyspatialite')
+class SnapshotGeoIndexTests(TestCase):
+    def test_delta_and_merge(self):
+        ix = SnapshotGeoIndex('./test_indices', 'test_snapshot', int, int, clear=True)
+        ix.bulk_insert([(1, poly1), (2, poly2)])
+        self.assertEqual(sorted(ix.within(cover)), [1,2])
+
+        ix.merge()
+        ix.insert(3, poly3)
+        ix.delete(1)
+        self.assertEqual(sorted(ix.within(cover)), [2,3])
+        self.assertEqual(ix.count(), 2)
+
+        reader = SnapshotGeoIndex('./test_indices', 'test_snapshot', int, int)
+        ix.merge()
+        self.assertEqual(sorted(reader.within(cover)), [2,3])
+        self.assertEqual(reader.delta.count(), 0)
+
+        reader.close()
+        ix.drop()
+
+    def test_concurrent_merges(self):
+        SnapshotGeoIndex('./test_indices', 'test_snapshot_merges', int, int, clear=True).close()
+        boxes = [Polygon(((i, i), (i, i + 1), (i + 1, i + 1), (i + 1, i), (i, i))) for i in range(100)]
+
+        def merge(oids):
+            # each thread has its own handle, and so its own connections, as separate processes would
+            ix = SnapshotGeoIndex('./test_indices', 'test_snapshot_merges', int, int)
+            for batch in range(0, len(oids), 5):
+                ix.bulk_insert((oid, boxes[oid]) for oid in oids[batch:batch + 5])
+                ix.merge()
+            ix.close()
+        mergers = [Thread(target=merge, args=(range(k, 100, 2),)) for k in range(2)]
+        for m in mergers:
+            m.start()
+        for m in mergers:
+            m.join()
+
+        ix = SnapshotGeoIndex('./test_indices', 'test_snapshot_merges', int, int)
+        self.assertEqual(ix.delta.count(), 0)
+        self.assertEqual(sorted(ix.within(Polygon(((-1, -1), (-1, 101), (101, 101), (101, -1), (-1, -1))))), range(100))
+        ix.drop()
+
+    def test_pinned_across_merge(self):
+        ix = SnapshotGeoIndex('./test_indices', 'test_snapshot_pinned', int, int, clear=True)
+        ix.bulk_insert([(1, poly1), (2, poly2), (3, poly3)])
+        ix.merge()
+        epoch = ix.row_epoch()
+
+        with ix.pinned():
+            rows = sorted(ix.within(cover, rows=True))
+            def merge():
+                ix.bulk_delete([1])
+                ix.insert(4, poly1)
+                ix.merge()
+            merger = Thread(target=merge)
+            merger.start()
+            merger.join()
+            self.assertEqual(ix.row_epoch(), epoch)
+            self.assertEqual(sorted(ix.ids_of(rows)), [1,2,3])
+
+        self.assertNotEqual(ix.row_epoch(), epoch)
+        self.assertEqual(sorted(ix.within(cover)), [2,3,4])
+        ix.drop()
+
+class MemoryGeoIndexTests(TestCase):
+    def test_predicates(self):
+        ix = MemoryGeoIndex('./test_indices', 'test_memory_predicates', int, int, clear=True)
+        ix.bulk_insert([(1, poly1), (2, poly2), (3, poly3)])
+
+        self.assertEqual(sorted(ix.within(cover)), [1,2,3])
+        self.assertEqual(list(ix.equals(poly2)), [2])
+        self.assertEqual(sorted(ix.intersects(poly1)), [1,2,3])
+        self.assertEqual(sorted(ix.disjoint(poly0)), [1,2,3])
+        self.assertEqual(ix.count(cover), 3)
+
+        self.assertEqual(list(ix.nearest(Point(200, 200), k=2)), [3, 1])
+
+        ix.delete(2)
+        self.assertEqual(sorted(ix.within(cover)), [1,3])
+        ix.drop()
+
+    def test_bulk_upsert(self):
+        ix = MemoryGeoIndex('./test_indices', 'test_memory_upsert', int, int, clear=True)
+        ix.bulk_insert([(1, poly1), (2, poly2)])
+        ix.bulk_upsert([(2, poly3), (3, poly1)])
+
+        self.assertEqual(ix.count(), 3)
+        self.assertEqual(sorted(ix.equals(poly1)), [1, 3])
+        self.assertEqual(list(ix.equals(poly3)), [2])
+        ix.drop()
+
+    def test_persists_on_close(self):
+        ix = MemoryGeoIndex('./test_indices', 'test_memory_persist', int, int, clear=True)
+        ix.bulk_insert([(1, poly1), (2, poly2)])
+        ix.close()
+
+        ix = MemoryGeoIndex('./test_indices', 'test_memory_persist', int, int)
+        self.assertEqual(ix.count(), 2)
+        self.assertEqual(list(ix.equals(poly1)), [1])
+        ix.drop()
+
+    def test_row_epoch(self):
+        ix = MemoryGeoIndex('./test_indices', 'test_memory_epoch', int, int, clear=True)
+        ix.bulk_insert([(1, poly1), (2, poly2)])
+        epoch = ix.row_epoch()
+        ix.delete(1)
+        self.assertEqual(ix.row_epoch(), epoch)
+
+        ix.close()
+        ix.open() # slots keep their numbers on disk
+        self.assertEqual(ix.row_epoch(), epoch)
+        self.assertEqual(ix.rows_of([2]), [1])
+
+        self.assertEqual(ix.compact(), 1) # and only compacting renumbers them
+        self.assertNotEqual(ix.row_epoch(), epoch)
+        self.assertEqual(ix.rows_of([2]), [0])
+        self.assertEqual(list(ix.ids_of(ix.all_rows())), [2])
+        ix.drop()
+
+    def test_writes_flushed(self):
+        ix = MemoryGeoIndex('./test_indices', 'test_memory_flushed', int, int, clear=True)
+        ix.insert(1, poly1)
+        boxes = [Polygon(((i, i), (i, i + 1), (i + 1, i + 1), (i + 1, i), (i, i))) for i in range(2, 202)]
+
+        def write(part):
+            for oid in part:
+                ix.insert(oid, boxes[oid - 2])
+        def read():
+            for _ in range(50):
+                list(ix.intersects(cover))
+        threads = [Thread(target=write, args=(range(k, 202, 4),)) for k in range(2, 6)] + [Thread(target=read) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(ix.count(), 201)
+        self.assertEqual(MemoryGeoIndex('./test_indices', 'test_memory_flushed', int, int).count(), 201) # without a close
+        ix.drop()
+
+    def test_one_process(self):
+        ix = MemoryGeoIndex('./test_indices', 'test_memory_process', int, int, clear=True)
+        with open(ix.index_path + '.lock') as f: # as another process would see it
+            self.assertRaises(IOError, fcntl.flock, f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        ix.close()
+        with open(ix.index_path + '.lock') as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        ix.drop()
+
+    def test_discard(self):
+        ix = MemoryGeoIndex('./test_indices', 'test_memory_discard', int, int, clear=True)
+        ix.bulk_insert([(1, poly1)])
+        ix.flush()
+        ix.discard()
+        ix.insert(2, poly2)
+        ix.close()
+
+        self.assertEqual(MemoryGeoIndex('./test_indices', 'test_memory_discard', int, int).count(), 1)
+        ix.drop()
+
+try:
+    mongo = pymongo.Connection()
+except pymongo.errors.ConnectionFailure:
+    mongo = None
+
+class _CollectionFixture(object):
+    """A SpatiaLite-indexed collection of three polygons, made afresh for each test"""
 
-@skip('skipping mongodb tests for now')
-class GeoMongoTests(TestCase):
     def setUp(self):
         self.collection = GeoJSONCollection(mongo.test, 'test_collection', './test_indices', srid=4326, clear=True)
         self.collection.insert_features({
@@ -143,6 +797,118 @@ class GeoMongoTests(TestCase):
     def tearDown(self):
         self.collection.drop()
 
+@skipUnless(mongo and SPATIALITE, 'needs a running mongod and pyspatialite')
+class GeoCollectionTests(_CollectionFixture, TestCase):
+    def test_insert_stream(self):
+        features = [{'type' : 'Feature', 'geometry' : json.loads(Point(i, i).json), 'properties' : {'name' : 'point{i}'.format(i=i)}} for i in range(25)]
+        document = StringIO(json.dumps({'type' : 'FeatureCollection', 'property4' : 4, 'features' : features}))
+
+        progress = []
+        stats = self.collection.insert_stream(document, batch_size=10, progress=progress.append)
+        self.assertEquals(stats['features'], 25)
+        self.assertEquals([p['features'] for p in progress], [10, 20, 25])
+        self.assertEquals(self.collection.count(), 28)
+        self.assertEquals(self.collection['property4'], 4)
+
+    def test_update_reindexes_changed_geometry(self):
+        moved = {'type' : 'Feature', 'geometry' : json.loads(poly3.json), 'properties' : {'name' : 'poly1'}}
+        self.collection.update({'properties.name' : 'poly1'}, {'$set' : {'properties.tag' : 1}}, multi=True)
+        self.assertEquals(self.collection.coll.find_one({'properties.name' : 'poly1'}).get(GEOMETRY_HASH), None)
+
+        self.collection.update({'properties.name' : 'poly1'}, {'$set' : {'geometry' : moved['geometry']}})
+        feature = self.collection.coll.find_one({'properties.name' : 'poly1'})
+        self.assertTrue(feature[GEOMETRY_HASH])
+        self.assertEquals(self.collection.count(), 3)
+        self.assertEquals(len(list(self.collection.index.equals(poly3))), 2)
+
+    def test_delete_region(self):
+        self.assertEquals(self.collection.delete_region(poly1), 3) # the others touch it
+        self.assertEquals(self.collection.count(), 0)
+        self.assertEquals(self.collection.coll.count(), 0)
+        self.collection.compact()
+
+    def test_query_cache(self):
+        misses = self.collection.cache_stats()['misses']
+        first = list(self.collection.find_features(geo_spec={'$within' : cover}))
+        second = list(self.collection.find_features(geo_spec={'$within' : Polygon(cover.coords)}))
+        self.assertEquals(first, second)
+        self.assertEquals(self.collection.cache_stats()['misses'], misses + 1)
+
+        self.collection.insert_features({'type' : 'Feature', 'geometry' : json.loads(Point(1, 1).json), 'properties' : {}})
+        self.assertEquals(len(list(self.collection.find_features(geo_spec={'$within' : cover}))), 4)
+        self.assertEquals(self.collection.cache_stats()['misses'], misses + 2)
+
+    def test_metadata_batch(self):
+        version = self.collection.meta['_version']
+        with self.collection.metadata_batch():
+            self.collection['property5'] = 5
+            self.collection['property6'] = {'nested' : [6]}
+            del self.collection['property3']
+        self.assertEquals(self.collection.meta['_version'], version + 1)
+
+        stored = mongo.test.geojson__meta.find_one('test_collection')
+        self.assertEquals(stored['_version'], version + 1)
+        self.assertEquals(stored['properties']['property6'], {'nested' : [6]})
+        self.assertNotIn('property3', stored['properties'])
+
+    def test_open_collection(self):
+        handle = open_collection(mongo.test, 'test_collection', './test_indices', srid=4326)
+        self.assertIs(open_collection(mongo.test, 'test_collection', './test_indices', srid=4326), handle)
+        self.assertEquals(handle.count(), 3)
+
+        # recreating the collection, as an import would, replaces the shared handle
+        GeoJSONCollection(mongo.test, 'test_collection', './test_indices', srid=4326, clear=True)
+        self.assertIsNot(open_collection(mongo.test, 'test_collection', './test_indices', srid=4326), handle)
+
+        cleared = open_collection(mongo.test, 'test_collection', './test_indices', srid=4326, clear=True)
+        self.assertIs(open_collection(mongo.test, 'test_collection', './test_indices', srid=4326), cleared)
+        self.assertEquals(cleared.count(), 0)
+
+    def test_query_plan(self):
+        result = list(self.collection.find_features(geo_spec={'$within' : cover}, spec={'properties.name' : 'poly2'}))
+        self.assertEquals([r['properties']['name'] for r in result], ['poly2'])
+        self.assertEquals(self.collection.last_plan['strategy'], 'attribute')
+        self.assertEquals(self.collection.last_plan['attribute_estimate'], 1)
+
+        plan = self.collection.plan({'$within' : poly0}, {'properties.name' : {'$exists' : True}})
+        self.assertEquals(plan['spatial_estimate'], 0)
+        self.assertEquals(plan['strategy'], 'spatial')
+
+    def test_boolean_geo_spec(self):
+        result = list(self.collection.find_features(geo_spec={'$or' : [{'$equals' : poly1}, {'$equals' : poly3}]}))
+        self.assertEquals(sorted(r['properties']['name'] for r in result), ['poly1', 'poly3'])
+
+        result = list(self.collection.find_features(geo_spec={'$within' : cover, '$not' : {'$intersects' : poly3}}))
+        self.assertEquals([r['properties']['name'] for r in result], ['poly2'])
+
+        result = list(self.collection.find_features(geo_spec={'$not' : {'$equals' : poly2}}))
+        self.assertEquals([r['properties']['name'] for r in result], ['poly1', 'poly3'])
+
+    def test_paging(self):
+        for geo_spec in ({'$within' : cover}, None):
+            page = {}
+            first = list(self.collection.find_features(geo_spec=geo_spec, limit=2, page=page))
+            self.assertEquals(len(first), 2)
+            self.assertTrue(page['next'])
+
+            rest = list(self.collection.find_features(geo_spec=geo_spec, limit=2, after=page['next'], page=page))
+            self.assertEquals(len(rest), 1)
+            self.assertEquals(page['next'], None)
+            self.assertEquals(sorted(r['properties']['name'] for r in first + rest), ['poly1', 'poly2', 'poly3'])
+
+        result = list(self.collection.find_features(geo_spec={'$within' : cover}, spec={'properties.name' : {'$ne' : 'poly1'}}, skip=1, limit=1))
+        self.assertEquals(len(result), 1)
+
+    def test_prefetch(self):
+        expected = [r['properties']['name'] for r in self.collection.find_features(geo_spec={'$within' : cover}, prefetch=0)]
+        for prefetch in (1, 4):
+            result = self.collection.find_features(geo_spec={'$within' : cover}, prefetch=prefetch)
+            self.assertEquals([r['properties']['name'] for r in result], expected)
+            result = self.collection.find_features(geo_spec={'$within' : cover}, prefetch=prefetch, ordered=False)
+            self.assertEquals(sorted(r['properties']['name'] for r in result), sorted(expected))
+
+@skip('skipping mongodb tests for now')
+class GeoMongoTests(_CollectionFixture, TestCase):
     def test_load(self):
         """Test loading with a few features"""
         self.assertEquals(self.collection.count(), 3, 'count() failed basic test')
@@ -168,6 +934,17 @@ class GeoMongoTests(TestCase):
         self.assertEquals(result[0]['properties']['name'], 'poly1')
         self.assertEquals(len(result2), 3)
 
+    def test_nearest_query(self):
+        result = list(self.collection.find_features(query={
+            'type' : 'Feature',
+            'geometry' : { 'type' : 'Point', 'coordinates' : [200, 200] },
+            'properties' : { 'geographic_operator' : 'nearest', 'k' : 2 }
+        }))
+        self.assertEquals([r['properties']['name'] for r in result], ['poly3', 'poly1'])
+
+        result = list(self.collection.find_features(geo_spec={'$nearest' : [Point(200, 200), 1]}, spec={'properties.name' : 'poly2'}))
+        self.assertEquals([r['properties']['name'] for r in result], ['poly2'])
+
     def test_empty_resultset(self):
         """Make a query that comes out with nothing"""
         result1 = list(self.collection.find_features(spec={'properties.name' : 'nonexistent'}))
@@ -180,14 +957,12 @@ class GeoMongoTests(TestCase):
         self.assertEquals([], result3)
         self.assertEquals([], result4)
 
-
     def test_insert_individual_features(self):
         """Test the insertion of individual features instead of feature collection"""
         self.collection.insert_features([{ 'type' : 'Feature', 'geometry' : json.loads(poly1.json), 'properties' : {'name' : 'poly4'} }])
         result = list(self.collection.find_features(spec={'properties.name' : 'poly4'}))
         self.assertEqual(len(result), 1)
 
-
     def test_properties(self):
         """Test loading a feature-collection with extra properties."""
         self.collection['property1'] = 1
@@ -216,6 +991,124 @@ class GeoMongoTests(TestCase):
         self.assertEquals([], result2)
 
 
+@skipUnless(mongo, 'needs a running mongod')
+class MemoryCollectionTests(TestCase):
+    """Collection queries over the in-process index backend, which need Mongo but not SpatiaLite"""
+
+    def setUp(self):
+        self.collection = GeoJSONCollection(mongo.test, 'test_memory_collection', './test_indices', srid=4326, clear=True, index_backend='memory')
+        self.collection.insert_features({
+            'type' : "FeatureCollection",
+            "features" : [
+                { 'type' : 'Feature', 'geometry' : json.loads(poly1.json), 'properties' : {'name' : 'poly1'} },
+                { 'type' : 'Feature', 'geometry' : json.loads(poly2.json), 'properties' : {'name' : 'poly2'} },
+                { 'type' : 'Feature', 'geometry' : json.loads(poly3.json), 'properties' : {'name' : 'poly3'} }
+            ]
+        })
+
+    def tearDown(self):
+        self.collection.drop()
+
+    def names(self, **kwargs):
+        return [r['properties']['name'] for r in self.collection.find_features(**kwargs)]
+
+    def test_nearest_paging(self):
+        nearest = {'$nearest' : Point(200, 200)}
+        self.assertEquals(self.names(geo_spec=nearest), ['poly3', 'poly1', 'poly2'])
+        self.assertEquals(self.names(geo_spec=nearest, limit=2), ['poly3', 'poly1'])
+        self.assertEquals(self.names(geo_spec=nearest, skip=2, limit=2), ['poly2'])
+        self.assertEquals(self.names(geo_spec=nearest, skip=1), ['poly1', 'poly2'])
+        self.assertEquals(self.names(geo_spec=nearest, skip=3, limit=2), [])
+
+    def test_sorted_spatial(self):
+        within = {'$within' : cover}
+        self.assertEquals(self.names(geo_spec=within, sort=[('properties.name', -1)]), ['poly3', 'poly2', 'poly1'])
+        self.assertEquals(self.names(geo_spec=within, sort='properties.name', skip=1, limit=1), ['poly2'])
+        self.assertRaises(ValidationError, self.names, geo_spec={'$nearest' : Point(0, 0)}, sort=[('properties.name', 1)])
+
+    def test_stale_page_token(self):
+        page = {}
+        self.assertEquals(len(self.names(geo_spec={'$within' : cover}, limit=2, page=page)), 2)
+        self.assertEquals(len(self.names(geo_spec={'$within' : cover}, limit=2, after=page['next'])), 1)
+
+        self.collection.index.close()
+        self.collection.index.open() # rows keep their numbers on disk
+        self.assertEquals(len(self.names(geo_spec={'$within' : cover}, limit=2, after=page['next'])), 1)
+
+        self.collection.delete_features(spec={'properties.name' : 'poly1'})
+        self.collection.compact() # which renumbers them
+        self.assertRaises(ValidationError, self.names, geo_spec={'$within' : cover}, limit=2, after=page['next'])
+
+    @skipUnless(SPATIALITE, 'needs pyspatialite')
+    def test_clear_drops_stored_backend(self):
+        path = self.collection.index.index_path
+        self.collection.index.close()
+        self.collection = GeoJSONCollection(mongo.test, 'test_memory_collection', './test_indices', srid=4326, clear=True, index_backend='spatialite')
+        self.assertFalse(os.path.exists(path)) # the memory index the collection was made with
+        self.assertEquals(self.collection.index.count(), 0)
+
+    def test_empty_geometry_refused(self):
+        empty = {'type' : 'Feature', 'geometry' : {'type' : 'Polygon', 'coordinates' : []}, 'properties' : {'name' : 'empty'}}
+        self.assertRaises(ValidationError, self.collection.insert_features, empty)
+        self.assertRaises(ValidationError, self.collection.insert_features, {'type' : 'FeatureCollection', 'features' : [
+            { 'type' : 'Feature', 'geometry' : json.loads(poly0.json), 'properties' : {'name' : 'poly0'} }, empty
+        ]})
+        self.assertEquals(self.collection.count(), 3)
+        self.assertEquals(self.collection.coll.count(), 3)
+
+    def test_update_matches_reindexed_features(self):
+        moved = json.loads(poly0.json)
+        self.collection.update({'properties.name' : {'$in' : ['poly1', 'poly2']}}, {'$set' : {'geometry' : moved}})
+        self.assertEquals(self.collection.coll.find({'geometry' : moved}).count(), 1)
+        self.assertEquals(len(list(self.collection.index.equals(poly0))), 1)
+
+        self.collection.update({'properties.name' : {'$in' : ['poly1', 'poly2']}}, {'$set' : {'geometry' : moved}}, multi=True)
+        self.assertEquals(self.collection.coll.find({'geometry' : moved}).count(), 2)
+        self.assertEquals(len(list(self.collection.index.equals(poly0))), 2)
+        self.assertEquals(self.names(geo_spec={'$within' : cover}), ['poly3'])
+
+    def test_metadata_batch_per_thread(self):
+        stored = lambda: mongo.test.geojson__meta.find_one('test_memory_collection')['properties']
+        with self.collection.metadata_batch():
+            self.collection['held'] = 1
+            def write():
+                self.collection['other'] = 2
+            writer = Thread(target=write)
+            writer.start()
+            writer.join()
+
+            self.assertEquals(stored().get('other'), 2)
+            self.assertNotIn('held', stored())
+        self.assertEquals(stored()['held'], 1)
+
+    def test_property_names(self):
+        for key, value in (('a.b', 1), ('$where', 1), ('ok', {'a.b' : 1}), ('ok', [{'$inc' : 1}])):
+            self.assertRaises(ValidationError, self.collection.__setitem__, key, value)
+        self.assertNotIn('ok', self.collection)
+        self.collection['ok'] = {'nested' : [{'fine' : 1}]}
+        self.assertEquals(mongo.test.geojson__meta.find_one('test_memory_collection')['properties']['ok'], {'nested' : [{'fine' : 1}]})
+
+    def test_permissions_invalidated(self):
+        loads = []
+        def rules():
+            loads.append(1)
+            return self.collection['permissions'] if 'permissions' in self.collection else {}
+        check = lambda: permissions.check(AnonymousUser(), 'read', 'test', 'test_memory_collection', rules)
+
+        self.assertFalse(check())
+        self.collection['permissions'] = {'read' : permissions.ALL}
+        self.assertTrue(check())
+        self.collection.insert_features({'type' : 'FeatureCollection', 'features' : []}, replace=True)
+        self.assertFalse(check())
+        self.assertEquals(len(loads), 3)
+
+    def test_handles_share_generation(self):
+        other = GeoJSONCollection(mongo.test, 'test_memory_collection', './test_indices', srid=4326)
+        generation = other.generation
+        self.assertEquals(self.collection.generation, generation)
+        self.collection.insert_features({'type' : 'Feature', 'geometry' : json.loads(Point(1, 1).json), 'properties' : {'name' : 'point'}})
+        self.assertEquals(other.generation, generation + 2)
+
 class BasicApiTests(TestCase):
     def test_db_list(self):
         db_list = self.client.get('/base/test_connection/')
@@ -241,6 +1134,10 @@ class BasicApiTests(TestCase):
         r2 = self.client.post('/base/test_connection/test_db/', data= {'collection' : 'test_collection2'})
         self.assertEqual(r2.status_code, 200, r2.content)
 
+        # an index backend that isn't registered is refused
+        bad = self.client.post('/base/test_connection/test_db/', data={'collection' : 'test_collection_bad', 'index_backend' : 'bogus'})
+        self.assertEqual(bad.status_code, 400, bad.content)
+
         # create a collection as a GET incidentally
         r3 = self.client.get('/base/test_connection/test_db/test_collection3/')
         self.assertEqual(r3.status_code, 200, r3.content)
@@ -301,3 +1198,33 @@ class BasicApiTests(TestCase):
         self.assertEqual(db_list.status_code, 200, db_list.content)
         dbs = json.loads(db_list.content)
         self.assertNotIn('test_db',dbs)
+
+class StreamingTests(TestCase):
+    def test_stream_formats(self):
+        features = [{'type' : 'Feature', 'properties' : {'n' : i}} for i in range(3)]
+        for output in ('json', 'geojson'):
+            mimetype, head, separator, tail = STREAM_FORMATS[output]
+            body = ''.join(_stream_features(iter(features), head, separator, tail))
+            parsed = json.loads(body)
+            self.assertEqual(parsed if output == 'json' else parsed['features'], features)
+
+            body = ''.join(_stream_features(iter([]), head, separator, tail, callback='cb'))
+            self.assertEqual(json.loads(body[3:-1]), [] if output == 'json' else {'type' : 'FeatureCollection', 'features' : []})
+
+        mimetype, head, separator, tail = STREAM_FORMATS['ndjson']
+        body = ''.join(_stream_features(iter(features), head, separator, tail))
+        self.assertEqual([json.loads(line) for line in body.splitlines()], features)
+        self.assertEqual(''.join(_stream_features(iter([]), head, separator, tail)), '')
+
+    def test_bad_query_refused(self):
+        class Refusing(object):
+            def find_features(self, query=None, after=None, page=None):
+                raise ValidationError('page token has expired')
+                yield
+
+        for query in ('{}', '{"properties" : {"limit" : 2}}'): # streamed, and read before the response
+            response = _features_response(RequestFactory().get('/', {'after' : 'r2.x'}), Refusing(), query)
+            self.assertEqual(response.status_code, 400, response.content)
+
+        response = _features_response(RequestFactory().get('/'), Refusing(), '{not json')
+        self.assertEqual(response.status_code, 400)
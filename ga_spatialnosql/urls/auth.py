@@ -4,6 +4,8 @@ from django.conf.urls import patterns, include, url
 from ga_spatialnosql import views, api
 
 urlpatterns = patterns('',
+    url(r'^jobs/$', api.IngestJobView.as_view()),
+    url(r'^jobs/(?P<job>\d+)/$', api.IngestJobView.as_view()),
     url(r'^my/$', api.AuthenticatedDBView.as_view()),
     url(r'^my/(?P<collection>[^/]*)/$', api.AuthenticatedCollectionView.as_view()),
     url(r'^my/(?P<collection>[^/]*)/properties/$', api.CollectionPropertiesView.as_view()),
@@ -3,6 +3,8 @@ from ga_spatialnosql import views, api
 
 urlpatterns = patterns('',
     url(r'^$', api.UniverseView.as_view()),
+    url(r'^jobs/$', api.IngestJobView.as_view()),
+    url(r'^jobs/(?P<job>\d+)/$', api.IngestJobView.as_view()),
     url(r'^(?P<connection>[^/]*)/$', api.ConnectionView.as_view()),
     url(r'^(?P<connection>[^/]*)/(?P<db>[^/]*)/$', api.DBView.as_view()),
     url(r'^(?P<connection>[^/]*)/(?P<db>[^/]*)/(?P<collection>[^/]*)/$', api.CollectionView.as_view()),
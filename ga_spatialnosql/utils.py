@@ -7,9 +7,37 @@ def file_contents(filename):
     return contents
 
 
+class NullContext(object):
+    """A context manager that does nothing, for code that only sometimes needs one"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, extype, ex, val):
+        pass
+
 def aif(test, then_clause, else_clause):
     k = test()
     if k:
         then_clause(k)
     else:
-        else_clause()
\ No newline at end of file
+        else_clause()
+
+def chunk(seq, size=1000):
+    """Split an iterable into lists of at most size items without materializing the whole iterable"""
+    batch = []
+    for it in seq:
+        batch.append(it)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# positions of II, IB, BI and BB in a DE-9IM pattern.  If any of them must be non-empty the geometries intersect, so a
+# query for the pattern can safely be narrowed to candidates whose bounding boxes overlap.
+_INTERSECTING_CELLS = (0, 1, 3, 4)
+
+def relation_needs_intersection(relation):
+    return any(relation[i] in 'T012' for i in _INTERSECTING_CELLS if i < len(relation))
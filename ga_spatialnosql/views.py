@@ -1,27 +1,11 @@
-import shutil
-from ga_spatialnosql.db.mongo import GeoJSONCollection
+from ga_spatialnosql.ogr_import import normalize
+from ga_spatialnosql.models import IngestJob
+from ga_spatialnosql.tasks import spool, submit
 from django.http import HttpResponseRedirect
 from django.views import generic as g
 from django import forms as f
 from django.forms import widgets as w
-from tempfile import NamedTemporaryFile, mkdtemp
-from osgeo import ogr, osr
-from django.conf import settings
-import shutil
 import os
-import zipfile
-import tarfile
-import json
-import re
-
-def normalize(name):
-    name = re.sub('%', 'pct', name)
-    name = re.sub('[^A-z0-9_]', '_', name).lower()
-    if name[0] in '0123456789_':
-        name = 'x' + name
-    name = re.sub('__*', "_", name)
-    name = re.sub('__*$', '', name)
-    return name
 
 class UploadFileForm(f.Form):
     collection_name = f.CharField()
@@ -41,16 +25,15 @@ class SubmitJSONView(g.FormView):
     success_url = '.'
 
     def form_valid(self, form):
-        conn = settings.MONGODB_CONNECTIONS['ga_spatialnosql'] if 'ga_spatialnosql' in settings.MONGODB_CONNECTIONS else settings.MONGODB_CONNECTIONS['default']
-        db = conn[self.request.user.username]
-        fc = json.loads(form.cleaned_data['geojson'])
-        GeoJSONCollection(
-            db=db,
+        job = IngestJob.objects.create(
+            user=self.request.user,
+            kind=IngestJob.GEOJSON,
+            source=spool([form.cleaned_data['geojson'].encode('utf-8')], suffix='.json'),
+            database=self.request.user.username,
             collection=form.cleaned_data['collection_name'],
             srid=form.cleaned_data['srid'],
-            fc=fc,
-            clear=True
         )
+        submit(job)
         return HttpResponseRedirect(self.success_url)
 
 class UploadOGRView(g.FormView):
@@ -59,84 +42,18 @@ class UploadOGRView(g.FormView):
     success_url = '.'
 
     def form_valid(self, form):
-        conn = settings.MONGODB_CONNECTIONS['ga_spatialnosql'] if 'ga_spatialnosql' in settings.MONGODB_CONNECTIONS else settings.MONGODB_CONNECTIONS['default']
-        db = conn[self.request.user.username]
-
-        tf = NamedTemporaryFile()
-        for chunk in form.cleaned_data['uploaded_file'].chunks():
-            tf.write(chunk)
-        tf.flush()
-        filename = tf.name
-
-        dir = None
-        if form.cleaned_data['uploaded_file'].name.endswith('.zip'):
-            pwd = os.getcwd()
-            dir = mkdtemp()
-            os.chdir(dir)
-            archive = zipfile.ZipFile(filename)
-            archive.extractall()
-            ds = ogr.Open(form.cleaned_data['master_file'])
-            os.chdir(pwd)
-        elif form.cleaned_data['uploaded_file'].name.endswith('.tar.gz'):
-            pwd = os.getcwd()
-            dir = mkdtemp()
-            os.chdir(dir)
-            archive = tarfile.TarFile.gzopen(filename)
-            archive.extractall()
-            ds = ogr.Open(form.cleaned_data['master_file'])
-            os.chdir(pwd)
-        elif form.cleaned_data['uploaded_file'].name.endswith('.tar.bz2'):
-            pwd = os.getcwd()
-            dir = mkdtemp()
-            os.chdir(dir)
-            archive = tarfile.TarFile.bz2open(filename)
-            archive.extractall()
-            ds = ogr.Open(form.cleaned_data['master_file'])
-            os.chdir(pwd)
-        else:
-            ds = ogr.Open(filename)
-
-        t_srs = osr.SpatialReference()
-        t_srs.ImportFromEPSG(form.cleaned_data['srid'])
-
-        if ds.GetLayerCount() == 1:
-            layer = ds.GetLayer(0)
-            s_srs = layer.GetSpatialRef()
-            crx = osr.CoordinateTransformation(s_srs, t_srs)
-            l = [f for f in layer]
-            for f in l:
-                print ""
-                print f.geometry().ExportToWkt()
-                f.geometry().Transform(crx)
-                print f.geometry().ExportToWkt()
-            name = normalize(layer.GetName())
-            GeoJSONCollection(
-                index_path=settings.INDEX_PATH,
-                db=db,
-                collection = form.cleaned_data['collection_name'] + '__' + name,
-                srid=form.cleaned_data['srid'],
-                fc={ "type" : "FeatureCollection", 'features' : [json.loads(f.ExportToJson()) for f in l] },
-                clear=True
-            )
-        else:
-            for layer in (ds.GetLayerByIndex(i) for i in range(ds.GetLayerCount())):
-                name = normalize(layer.GetName())
-                s_srs = layer.GetSpatialRef()
-                crx = osr.CoordinateTransformation(s_srs, t_srs)
-                l = [f for f in layer]
-                for f in l:
-                    f.geometry().Transform(crx)
-                GeoJSONCollection(
-                    index_path=settings.INDEX_PATH,
-                    db=db,
-                    collection = form.cleaned_data['collection_name'] + '__' + name,
-                    srid=form.cleaned_data['srid'],
-                    fc=(json.loads(f.ExportToJson()) for f in l),
-                    clear=True
-                )
-
-        if dir:
-            shutil.rmtree(dir)
+        upload = form.cleaned_data['uploaded_file']
+        job = IngestJob.objects.create(
+            user=self.request.user,
+            kind=IngestJob.OGR,
+            source=spool(upload.chunks(), suffix=os.path.splitext(upload.name)[1]),
+            source_name=upload.name,
+            master_file=form.cleaned_data['master_file'],
+            database=self.request.user.username,
+            collection=form.cleaned_data['collection_name'],
+            srid=form.cleaned_data['srid'],
+        )
+        submit(job)
         return HttpResponseRedirect(self.success_url)
 
 
@@ -0,0 +1,190 @@
+__author__ = 'jeff'
+
+from array import array
+from collections import deque
+from itertools import chain, izip
+from threading import Lock
+from django.contrib.gis.geos import GEOSGeometry
+from ga_spatialnosql.hilbert import extent_of
+from ga_spatialnosql.utils import chunk
+from ga_spatialnosql.pools import process_pool
+from ga_spatialnosql import app_settings as settings
+import atexit
+import struct
+import sys
+
+# Encodes GeoJSON geometry dicts straight into little-endian 2D WKB, working out the envelope on the way.  Each
+# coordinate sequence is flattened into one array of doubles, which is both the WKB payload and what the envelope is
+# taken from, so there is no per-vertex Python work beyond the flattening itself.  Z values are dropped, as they are
+# from GEOSGeometry.wkb.
+
+_HEADER = struct.Struct('<BI')
+_COUNT = struct.Struct('<I')
+_POINT = struct.Struct('<BIdd')
+_XY = frozenset([2])
+_NAN = float('nan')
+
+WKB_TYPES = {
+    'Point' : 1,
+    'LineString' : 2,
+    'Polygon' : 3,
+    'MultiPoint' : 4,
+    'MultiLineString' : 5,
+    'MultiPolygon' : 6,
+    'GeometryCollection' : 7,
+}
+
+def _flatten(positions):
+    if set(map(len, positions)) == _XY: # every position is plain x, y
+        coordinates = array('d', chain.from_iterable(positions))
+    else:
+        coordinates = array('d', chain.from_iterable((p[0], p[1]) for p in positions))
+    if sys.byteorder != 'little':
+        swapped = array('d', coordinates)
+        swapped.byteswap()
+        return coordinates, swapped.tostring()
+    return coordinates, coordinates.tostring()
+
+def _sequence(positions, parts, extents):
+    coordinates, packed = _flatten(positions)
+    parts.append(_COUNT.pack(len(positions)))
+    parts.append(packed)
+    if coordinates:
+        xs, ys = coordinates[0::2], coordinates[1::2]
+        extents.append((min(xs), min(ys), max(xs), max(ys)))
+
+def _point(position, parts, extents):
+    if not position: # POINT EMPTY, which WKB writes as a point at NaN, NaN
+        parts.append(_POINT.pack(1, WKB_TYPES['Point'], _NAN, _NAN))
+        return
+    x, y = position[0], position[1]
+    parts.append(_POINT.pack(1, WKB_TYPES['Point'], x, y))
+    extents.append((x, y, x, y))
+
+def _encode(geometry, parts, extents):
+    kind = geometry['type']
+    if kind not in WKB_TYPES:
+        raise ValueError('{kind} is not a GeoJSON geometry type'.format(kind=kind))
+
+    if kind == 'Point':
+        return _point(geometry['coordinates'], parts, extents)
+
+    if kind == 'GeometryCollection':
+        members = geometry['geometries']
+        parts.append(_HEADER.pack(1, WKB_TYPES[kind]) + _COUNT.pack(len(members)))
+        for member in members:
+            _encode(member, parts, extents)
+        return
+
+    coordinates = geometry['coordinates']
+    parts.append(_HEADER.pack(1, WKB_TYPES[kind]))
+    if kind == 'LineString':
+        _sequence(coordinates, parts, extents)
+    elif kind == 'Polygon':
+        parts.append(_COUNT.pack(len(coordinates)))
+        for ring in coordinates:
+            _sequence(ring, parts, extents)
+    elif kind == 'MultiPoint':
+        parts.append(_COUNT.pack(len(coordinates)))
+        for position in coordinates:
+            _point(position, parts, extents)
+    elif kind == 'MultiLineString':
+        parts.append(_COUNT.pack(len(coordinates)))
+        for line in coordinates:
+            parts.append(_HEADER.pack(1, WKB_TYPES['LineString']))
+            _sequence(line, parts, extents)
+    else:
+        parts.append(_COUNT.pack(len(coordinates)))
+        for polygon in coordinates:
+            parts.append(_HEADER.pack(1, WKB_TYPES['Polygon']) + _COUNT.pack(len(polygon)))
+            for ring in polygon:
+                _sequence(ring, parts, extents)
+
+def geojson_to_wkb(geometry):
+    """WKB and (xmin, ymin, xmax, ymax) envelope of a GeoJSON geometry dict.  An empty geometry has no envelope for
+    an index to file it under, and raises ValueError."""
+    parts = []
+    extents = []
+    _encode(geometry, parts, extents)
+    if not extents:
+        raise ValueError('{kind} has no coordinates; empty geometries can\'t be indexed'.format(kind=geometry['type']))
+    return ''.join(parts), extent_of(extents)
+
+def _has_position(coordinates):
+    if not coordinates:
+        return False
+    if isinstance(coordinates[0], (list, tuple)):
+        return any(_has_position(c) for c in coordinates)
+    return True
+
+def is_empty(geometry):
+    """Whether a GeoJSON geometry dict has no coordinates at all, found without encoding it"""
+    if geometry['type'] == 'GeometryCollection':
+        return all(is_empty(member) for member in geometry['geometries'])
+    return not _has_position(geometry['coordinates'])
+
+class WKBGeometry(object):
+    """A geometry held as WKB plus its envelope.  It has the wkb, extent and srid that the index backends read from
+    a GEOSGeometry on insert, so features can be indexed without GEOS ever parsing them; geos builds the GEOS
+    geometry when one is really needed."""
+
+    def __init__(self, wkb, extent, srid=None):
+        self.wkb = buffer(wkb)
+        self.extent = extent
+        self.srid = srid
+
+    @classmethod
+    def from_geojson(cls, geometry, srid=None):
+        wkb, extent = geojson_to_wkb(geometry)
+        return cls(wkb, extent, srid)
+
+    @property
+    def geos(self):
+        return GEOSGeometry(self.wkb, srid=self.srid)
+
+def geos_geometry(geometry, srid=None):
+    """A GEOSGeometry for a GeoJSON geometry dict, decoded from WKB rather than from re-serialised JSON"""
+    return GEOSGeometry(buffer(geojson_to_wkb(geometry)[0]), srid=srid)
+
+# Encoding can be spread over a pool of worker processes (see pools for where they are forked from).  Batches of
+# GeoJSON dicts go to the workers and only WKB strings and envelope tuples come back, which are the cheapest things to
+# pickle, and imap keeps the results in the order the geometries were given so they stay aligned with the ids they
+# are inserted under.
+_pools = {}
+_pools_lock = Lock()
+
+def _encoders(processes):
+    with _pools_lock:
+        if processes not in _pools:
+            _pools[processes] = process_pool(processes)
+        return _pools[processes]
+
+def close_encoders():
+    """Stop the encoding pools.  The next parallel encode starts new ones."""
+    with _pools_lock:
+        pools = _pools.values()
+        _pools.clear()
+    for pool in pools:
+        pool.terminate()
+
+atexit.register(close_encoders)
+
+def _encode_batch(geometries):
+    return [geojson_to_wkb(g) if g is not None else None for g in geometries]
+
+def _decoded(results, pending, srid):
+    for encoded in results:
+        for geometry, e in izip(pending.popleft(), encoded):
+            yield geometry if e is None else WKBGeometry(e[0], e[1], srid)
+
+def encode_geometries(geometries, srid=None, processes=0, batch_size=None):
+    """WKBGeometry objects for an iterable of GeoJSON geometry dicts, in the same order.  Anything else, such as a
+    GEOSGeometry, is passed through as it is.  With processes, the encoding runs on a pool of that many worker
+    processes, starting straight away so it overlaps with whatever the caller does before reading the results."""
+    if not processes:
+        return (WKBGeometry.from_geojson(g, srid) if isinstance(g, dict) else g for g in geometries)
+
+    # the pool is driven through a proxy, which can't be handed a generator, so the batches are made up front
+    pending = deque(chunk(geometries, batch_size or settings.ENCODE_BATCH_SIZE))
+    batches = [[g if isinstance(g, dict) else None for g in batch] for batch in pending]
+    return _decoded(_encoders(processes).imap(_encode_batch, batches), pending, srid)